@@ -1,5 +1,6 @@
 from flask import (
     Flask,
+    send_file,
     render_template,
     request,
     redirect,
@@ -7,13 +8,27 @@ from flask import (
     session,
     flash,
     jsonify,
-    abort
+    abort,
+    g,
+    has_app_context,
+    make_response,
+    has_request_context,
+    Response,
+    stream_with_context,
+    stream_template,
+    send_from_directory
 )
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from datetime import datetime
+from datetime import datetime, timedelta
+from decimal import Decimal
 import hashlib
+import csv
+import io
+import itertools
+import tempfile
 from functools import wraps
+from collections import OrderedDict
 import json
 import os
 import pytz
@@ -57,13 +72,8 @@ def get_nome_reale(user_id):
 # CONTROLLO PERMESSO SU MODELLI
 # =====================================
 def check_permesso_modelli():
-    """Blocca l'accesso se l'utente non è tra quelli autorizzati"""
-    utenti_autorizzati = [
-        "G.AS_Giuseppe.Palladino",
-        "G.AS_Gianluca.Scala"
-    ]
-    username = get_nome_reale(session['user_id'])  # prende l'username reale dell'utente loggato
-    if username not in utenti_autorizzati:
+    """Blocca l'accesso se l'utente non ha il permesso 'modelli'"""
+    if not ha_permesso("modelli"):
         flash("Accesso negato: non hai i permessi per modificare i modelli.")
         return redirect(url_for('lista_modelli'))  # ritorna alla lista modelli
     return None  # tutto ok
@@ -73,14 +83,18 @@ def check_permesso_modelli():
 # =====================================
 import requests
 
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
+# Backend del database: "postgres" (Supabase, produzione) oppure "sqlite" (locale, offline)
+DB_BACKEND = os.environ.get("DB_BACKEND", "postgres").strip().lower()
+if DB_BACKEND not in ("postgres", "sqlite"):
+    raise RuntimeError(f"❌ ERRORE: DB_BACKEND non valido: '{DB_BACKEND}' (usa 'postgres' o 'sqlite')")
+
+SUPABASE_URL = os.environ.get("SUPABASE_URL", "")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY", "").strip()
 
-if not SUPABASE_URL or not SUPABASE_KEY:
+# In locale (sqlite) lo storage Supabase è facoltativo
+if DB_BACKEND == "postgres" and (not SUPABASE_URL or not SUPABASE_KEY):
     raise RuntimeError("❌ ERRORE: Variabili SUPABASE_URL o SUPABASE_KEY non trovate nel .env")
 
-# URL base dello storage Supabase
-SUPABASE_STORAGE_URL = f"{SUPABASE_URL}/storage/v1/object"
 
 # =====================================
 # FLASK APP
@@ -122,30 +136,1784 @@ import psycopg2
 from urllib.parse import urlparse
 
 import os
+import re
 import psycopg2
 import socket
+import sqlite3
+import atexit
+import queue
+import threading
+import time
+from datetime import date
 
 from dotenv import load_dotenv
 load_dotenv()
 
+# Host del pooler Supabase (sovrascrivibile da .env)
+DB_HOST = os.environ.get("DB_HOST") or "aws-1-eu-central-1.pooler.supabase.com"
 
-def get_db_connection():
+# Parametri del pool di connessioni
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 2))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+# Dopo quanti secondi di inattività una connessione viene verificata prima del riuso
+DB_POOL_VERIFICA_DOPO = float(os.environ.get("DB_POOL_VERIFICA_DOPO", 30))
+# Durata della cache DNS dell'host del database (secondi)
+DB_DNS_TTL = float(os.environ.get("DB_DNS_TTL", 300))
+
+_dns_cache = {"ip": None, "scadenza": 0.0}
+_dns_lock = threading.Lock()
+
+
+def _risolvi_host_db():
+    """Risolve l'host del database in IPv4, con cache di DB_DNS_TTL secondi."""
+    ora = time.monotonic()
+    with _dns_lock:
+        if _dns_cache["ip"] and _dns_cache["scadenza"] > ora:
+            return _dns_cache["ip"]
     try:
-        # Risolvi l'host in IPv4 per evitare problemi di connessione
-        host_ipv4 = socket.gethostbyname("aws-1-eu-central-1.pooler.supabase.com")
-        conn = psycopg2.connect(
-            dbname=os.environ.get("DB_NAME", "postgres"),
-            user=os.environ.get("DB_USER", "postgres.cwuzhmfktymgmjolykgs"),
-            password=os.environ.get("DB_PASSWORD", ""),
-            host=host_ipv4,
-            port=os.environ.get("DB_PORT", 6543),
-            sslmode='require'
-        )
+        ip = socket.gethostbyname(DB_HOST)
+    except OSError:
+        # DNS momentaneamente irraggiungibile: riusa l'ultimo indirizzo noto
+        if _dns_cache["ip"]:
+            return _dns_cache["ip"]
+        raise
+    with _dns_lock:
+        _dns_cache["ip"] = ip
+        _dns_cache["scadenza"] = ora + DB_DNS_TTL
+    return ip
+
+
+def _nuova_connessione_postgres(porta=None):
+    # Risolvi l'host in IPv4 per evitare problemi di connessione
+    return psycopg2.connect(
+        dbname=os.environ.get("DB_NAME", "postgres"),
+        user=os.environ.get("DB_USER", "postgres.cwuzhmfktymgmjolykgs"),
+        password=os.environ.get("DB_PASSWORD", ""),
+        host=_risolvi_host_db(),
+        port=porta or os.environ.get("DB_PORT", 6543),
+        sslmode='require',
+        connect_timeout=10,
+        # keepalive TCP: il pooler non chiude le connessioni inattive del pool
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3
+    )
+
+
+class PoolConnessioni:
+    """
+    Pool thread-safe di connessioni già aperte (handshake TLS già fatto).
+    Se tutte le connessioni sono in uso e il massimo è raggiunto,
+    acquisisci() attende fino a `timeout` secondi.
+    """
+
+    def __init__(self, crea, minimo, massimo, timeout):
+        self._crea = crea
+        self._minimo = minimo
+        self._massimo = max(massimo, 1)
+        self._timeout = timeout
+        self._libere = []      # (connessione, istante ultimo rilascio) - LIFO
+        self._aperte = 0
+        self._cond = threading.Condition()
+        self._stat = {
+            "checkout": 0,
+            "checkout_con_attesa": 0,
+            "attesa_totale_ms": 0.0,
+            "attesa_max_ms": 0.0,
+            "timeout": 0,
+            "connessioni_create": 0,
+            "connessioni_scartate": 0,
+        }
+
+    def _verifica(self, conn, inattiva_da):
+        if conn.closed:
+            return False
+        if inattiva_da < DB_POOL_VERIFICA_DOPO:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _scarta(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._aperte -= 1
+            self._stat["connessioni_scartate"] += 1
+            self._cond.notify()
+
+    def _apri(self):
+        try:
+            conn = self._crea()
+        except Exception:
+            with self._cond:
+                self._aperte -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stat["connessioni_create"] += 1
         return conn
+
+    def acquisisci(self):
+        inizio = time.monotonic()
+        scadenza = inizio + self._timeout
+        atteso = False
+        while True:
+            conn = None
+            da_creare = False
+            with self._cond:
+                while not self._libere and self._aperte >= self._massimo:
+                    restante = scadenza - time.monotonic()
+                    if restante <= 0:
+                        self._stat["timeout"] += 1
+                        raise RuntimeError("Pool di connessioni esaurito: nessuna connessione libera.")
+                    atteso = True
+                    self._cond.wait(restante)
+                if self._libere:
+                    conn, rilasciata = self._libere.pop()
+                else:
+                    self._aperte += 1
+                    da_creare = True
+
+            if da_creare:
+                conn = self._apri()
+            elif not self._verifica(conn, time.monotonic() - rilasciata):
+                self._scarta(conn)
+                continue
+
+            attesa_ms = (time.monotonic() - inizio) * 1000
+            with self._cond:
+                self._stat["checkout"] += 1
+                if atteso:
+                    self._stat["checkout_con_attesa"] += 1
+                self._stat["attesa_totale_ms"] += attesa_ms
+                self._stat["attesa_max_ms"] = max(self._stat["attesa_max_ms"], attesa_ms)
+            return conn
+
+    def rilascia(self, conn):
+        # Annulla eventuali transazioni lasciate aperte prima del riuso
+        try:
+            if conn.closed:
+                raise RuntimeError("connessione chiusa")
+            conn.rollback()
+        except Exception:
+            self._scarta(conn)
+            return
+        with self._cond:
+            self._libere.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def riscalda(self):
+        """Apre in anticipo le connessioni minime, così le prime richieste non pagano il TLS."""
+        aperte = []
+        try:
+            while True:
+                with self._cond:
+                    if self._aperte >= self._minimo:
+                        break
+                    self._aperte += 1
+                aperte.append(self._apri())
+        except Exception:
+            app.logger.warning("Riscaldamento pool database non riuscito.", exc_info=True)
+        for conn in aperte:
+            self.rilascia(conn)
+
+    def statistiche(self):
+        with self._cond:
+            stat = dict(self._stat)
+            stat["dimensione"] = self._aperte
+            stat["libere"] = len(self._libere)
+            stat["in_uso"] = self._aperte - len(self._libere)
+            stat["minimo"] = self._minimo
+            stat["massimo"] = self._massimo
+        stat["attesa_media_ms"] = round(stat["attesa_totale_ms"] / stat["checkout"], 3) if stat["checkout"] else 0.0
+        stat["attesa_totale_ms"] = round(stat["attesa_totale_ms"], 3)
+        stat["attesa_max_ms"] = round(stat["attesa_max_ms"], 3)
+        return stat
+
+
+# =====================================
+# BACKEND LOCALE SQLITE (DB_BACKEND=sqlite)
+# =====================================
+# Percorso del file SQLite usato in locale (profilazione, test di carico, sviluppo offline)
+DB_SQLITE_PATH = os.environ.get("DB_SQLITE_PATH") or os.path.join(os.path.dirname(__file__), "gestionale_locale.db")
+
+def _converti_timestamp(valore):
+    return datetime.fromisoformat(valore.decode())
+
+
+def _converti_timestamptz(valore):
+    ts = datetime.fromisoformat(valore.decode())
+    # valori senza fuso (scritti a mano o da strumenti esterni): ora italiana
+    return ts if ts.tzinfo else pytz.timezone("Europe/Rome").localize(ts)
+
+
+def _testo_timestamp(valore):
+    # formato fisso con i microsecondi: SQLite confronta i timestamp come testo
+    return valore.isoformat(sep=" ", timespec="microseconds")
+
+
+sqlite3.register_adapter(datetime, _testo_timestamp)
+sqlite3.register_adapter(date, lambda v: v.isoformat())
+sqlite3.register_converter("TIMESTAMP", _converti_timestamp)
+sqlite3.register_converter("TIMESTAMPTZ", _converti_timestamptz)
+sqlite3.register_converter("DATE", lambda v: date.fromisoformat(v.decode()[:10]))
+sqlite3.register_converter("BOOLEAN", lambda v: v not in (b"0", b""))
+
+_RE_ILIKE = re.compile(r"\bILIKE\b", re.IGNORECASE)
+_RE_CAST_DATE = re.compile(r"([\w.]+)::date\b")
+# SQLite ha un solo scrittore alla volta: i lock di riga non servono
+_RE_FOR_UPDATE = re.compile(r"\s+FOR\s+UPDATE(\s+OF\s+\w+)?\b", re.IGNORECASE)
+_sql_tradotte = {}
+
+
+def _traduci_sql_sqlite(query):
+    """Adatta il dialetto Postgres usato dalle route a SQLite (placeholder, ILIKE, ::date, FOR UPDATE)."""
+    tradotta = _sql_tradotte.get(query)
+    if tradotta is None:
+        tradotta = query.replace("%s", "?")
+        tradotta = _RE_ILIKE.sub("LIKE", tradotta)
+        # giorno locale del valore: date() convertirebbe in UTC i timestamp con fuso
+        tradotta = _RE_CAST_DATE.sub(r"substr(\1, 1, 10)", tradotta)
+        tradotta = _RE_FOR_UPDATE.sub("", tradotta)
+        _sql_tradotte[query] = tradotta
+    return tradotta
+
+
+class CursoreSQLite:
+    """Cursore SQLite con l'interfaccia di psycopg2 (righe tuple o dict come RealDictCursor)."""
+
+    def __init__(self, cur, come_dict):
+        self._cur = cur
+        self._come_dict = come_dict
+
+    def _riga(self, row):
+        if row is None or not self._come_dict:
+            return row
+        return {col[0]: val for col, val in zip(self._cur.description, row)}
+
+    def execute(self, query, params=None):
+        self._cur.execute(_traduci_sql_sqlite(query), tuple(params) if params is not None else ())
+
+    def executemany(self, query, seq_params):
+        self._cur.executemany(_traduci_sql_sqlite(query), [tuple(p) for p in seq_params])
+
+    def fetchone(self):
+        return self._riga(self._cur.fetchone())
+
+    def fetchmany(self, size=None):
+        righe = self._cur.fetchmany(size) if size else self._cur.fetchmany()
+        return [self._riga(r) for r in righe]
+
+    def fetchall(self):
+        return [self._riga(r) for r in self._cur.fetchall()]
+
+    def __iter__(self):
+        for row in self._cur:
+            yield self._riga(row)
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    def close(self):
+        self._cur.close()
+
+
+class ConnessioneSQLite:
+    """Connessione SQLite con l'interfaccia di psycopg2 usata dalle route."""
+
+    def __init__(self, percorso):
+        self._conn = sqlite3.connect(
+            percorso,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,   # le connessioni passano tra i thread del pool
+            timeout=30
+        )
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        # anche i DEFAULT delle colonne passano da NOW(): stesso formato e fuso dei valori scritti dalle route
+        self._conn.create_function("NOW", 0, lambda: _testo_timestamp(now_ita()))
+        self._conn.create_function("normalizza_codice", 1, lambda v: normalizza_codice(v), deterministic=True)
+        self._conn.create_function("normalizza_targa", 1, lambda v: normalizza_targa(v), deterministic=True)
+        self._conn.create_function("stagione_deposito", 1, lambda v: stagione_deposito(v), deterministic=True)
+        self.closed = 0
+
+    def cursor(self, name=None, cursor_factory=None):
+        return CursoreSQLite(self._conn.cursor(), come_dict=cursor_factory is RealDictCursor)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+        self.closed = 1
+
+
+def _nuova_connessione_sqlite():
+    return ConnessioneSQLite(DB_SQLITE_PATH)
+
+
+# =====================================
+# MIGRAZIONI SCHEMA (versionate)
+# =====================================
+# Ogni migrazione ha una versione crescente e l'SQL per entrambi i backend.
+# Le istruzioni NON sono tutte rieseguibili (su SQLite ALTER TABLE ... ADD COLUMN
+# fallisce se la colonna esiste già): ogni migrazione gira una sola volta perché
+# la sua versione viene registrata in schema_migrazioni nella stessa transazione,
+# e il lock (advisory su Postgres, BEGIN IMMEDIATE su SQLite) impedisce a due
+# processi di applicarla insieme. Gli IF NOT EXISTS servono solo ad adottare i
+# database creati prima del versionamento.
+# Per aggiungere una modifica allo schema si accoda una nuova migrazione,
+# senza mai modificare quelle già applicate.
+MIGRAZIONI = [
+    (1, "schema base", {
+        "postgres": """
+        CREATE TABLE IF NOT EXISTS utenti (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            ruolo TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS clienti (
+            id SERIAL PRIMARY KEY,
+            nome TEXT,
+            cognome TEXT,
+            via TEXT,
+            provincia TEXT,
+            comune TEXT,
+            codice_fiscale TEXT,
+            cellulare TEXT,
+            telefono_alt TEXT,
+            email TEXT,
+            utente_id INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS vetture (
+            id SERIAL PRIMARY KEY,
+            cliente_id INTEGER,
+            targa TEXT,
+            marca TEXT,
+            modello TEXT,
+            cilindrata TEXT,
+            kw TEXT,
+            carburante TEXT,
+            codice_motore TEXT,
+            telaio TEXT,
+            immatricolazione DATE,
+            km TEXT,
+            cambio TEXT,
+            utente_id INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS modelli (
+            id SERIAL PRIMARY KEY,
+            marca TEXT NOT NULL,
+            modello TEXT NOT NULL,
+            versione TEXT,
+            codice_versione TEXT,
+            cilindrata TEXT,
+            kw TEXT,
+            carburante TEXT,
+            codice_motore TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS ricambi (
+            id SERIAL PRIMARY KEY,
+            nome TEXT,
+            codice TEXT NOT NULL,
+            quantita INTEGER NOT NULL DEFAULT 0,
+            utente_id INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS ricambi_sostituti (
+            codice TEXT PRIMARY KEY,
+            codice_sostituto TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS modelli_ricambi (
+            id SERIAL PRIMARY KEY,
+            modello_id INTEGER NOT NULL,
+            ricambio_id INTEGER NOT NULL,
+            tipo_filtro TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS lavorazioni (
+            id SERIAL PRIMARY KEY,
+            id_officina INTEGER,
+            tecnico_id INTEGER,
+            cliente_id INTEGER,
+            vettura_id INTEGER,
+            veicolo TEXT,
+            tipo TEXT,
+            tagliando BOOLEAN DEFAULT FALSE,
+            dischi_pattini BOOLEAN DEFAULT FALSE,
+            marca TEXT,
+            modello TEXT,
+            cilindrata INTEGER,
+            kw INTEGER,
+            cavalli INTEGER,
+            anno INTEGER,
+            stato TEXT,
+            cliente_nome TEXT,
+            cliente_cognome TEXT,
+            targa TEXT,
+            ordine_riparazione TEXT,
+            descrizione TEXT,
+            note TEXT,
+            eliminata BOOLEAN NOT NULL DEFAULT FALSE,
+            data_creazione TIMESTAMPTZ DEFAULT NOW(),
+            data_aggiornamento TIMESTAMPTZ
+        );
+
+        CREATE TABLE IF NOT EXISTS gomme (
+            id SERIAL PRIMARY KEY,
+            marca TEXT NOT NULL,
+            larghezza INTEGER NOT NULL,
+            rapporto INTEGER NOT NULL,
+            diametro INTEGER NOT NULL,
+            prezzo_unitario NUMERIC(10, 2),
+            prezzo_treno NUMERIC(10, 2),
+            disponibilita INTEGER DEFAULT 0,
+            note TEXT,
+            UNIQUE (marca, larghezza, rapporto, diametro)
+        );
+
+        CREATE TABLE IF NOT EXISTS gomme_clienti (
+            id SERIAL PRIMARY KEY,
+            nome TEXT,
+            cognome TEXT,
+            targa TEXT,
+            data_inizio DATE,
+            marca TEXT,
+            larghezza INTEGER,
+            rapporto INTEGER,
+            diametro INTEGER,
+            note TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS ordini_magazzino (
+            id SERIAL PRIMARY KEY,
+            prodotto TEXT,
+            codice TEXT,
+            targa TEXT,
+            cliente TEXT,
+            fornitore TEXT,
+            stato TEXT,
+            data_creazione TIMESTAMPTZ DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS magazzino (
+            id SERIAL PRIMARY KEY,
+            descrizione TEXT,
+            codice TEXT,
+            marca_veicolo TEXT,
+            tipo_veicolo TEXT,
+            note TEXT,
+            foto TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS prima_nota (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            data DATE NOT NULL,
+            descrizione TEXT,
+            cassa NUMERIC(12, 2) DEFAULT 0,
+            banca NUMERIC(12, 2) DEFAULT 0,
+            saldo_cassa NUMERIC(12, 2) DEFAULT 0,
+            note TEXT,
+            username TEXT NOT NULL,
+            created_at TIMESTAMP,
+            chiusa BOOLEAN DEFAULT FALSE
+        );
+
+        CREATE TABLE IF NOT EXISTS prima_nota_storico (
+            id UUID PRIMARY KEY,
+            username TEXT NOT NULL,
+            data DATE NOT NULL,
+            saldo_iniziale NUMERIC(12, 2) DEFAULT 0,
+            saldo_finale NUMERIC(12, 2) DEFAULT 0,
+            totale NUMERIC(12, 2) DEFAULT 0,
+            chiusa BOOLEAN DEFAULT FALSE,
+            UNIQUE (username, data)
+        );
+
+        CREATE TABLE IF NOT EXISTS promemoria (
+            id SERIAL PRIMARY KEY,
+            utente_id INTEGER,
+            titolo TEXT,
+            info TEXT,
+            data_creazione TIMESTAMPTZ DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS storico_azioni (
+            id SERIAL PRIMARY KEY,
+            id_utente INTEGER,
+            utente TEXT,
+            azione TEXT,
+            dettagli TEXT,
+            tabella_nome TEXT,
+            record_id INTEGER,
+            data_ora TIMESTAMPTZ DEFAULT NOW()
+        );
+        """,
+        "sqlite": """
+        CREATE TABLE IF NOT EXISTS utenti (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            ruolo TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS clienti (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT,
+            cognome TEXT,
+            via TEXT,
+            provincia TEXT,
+            comune TEXT,
+            codice_fiscale TEXT,
+            cellulare TEXT,
+            telefono_alt TEXT,
+            email TEXT,
+            utente_id INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS vetture (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cliente_id INTEGER,
+            targa TEXT,
+            marca TEXT,
+            modello TEXT,
+            cilindrata TEXT,
+            kw TEXT,
+            carburante TEXT,
+            codice_motore TEXT,
+            telaio TEXT,
+            immatricolazione DATE,
+            km TEXT,
+            cambio TEXT,
+            utente_id INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS modelli (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            marca TEXT NOT NULL,
+            modello TEXT NOT NULL,
+            versione TEXT,
+            codice_versione TEXT,
+            cilindrata TEXT,
+            kw TEXT,
+            carburante TEXT,
+            codice_motore TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS ricambi (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT,
+            codice TEXT NOT NULL,
+            quantita INTEGER NOT NULL DEFAULT 0,
+            utente_id INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS ricambi_sostituti (
+            codice TEXT PRIMARY KEY,
+            codice_sostituto TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS modelli_ricambi (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            modello_id INTEGER NOT NULL,
+            ricambio_id INTEGER NOT NULL,
+            tipo_filtro TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS lavorazioni (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_officina INTEGER,
+            tecnico_id INTEGER,
+            cliente_id INTEGER,
+            vettura_id INTEGER,
+            veicolo TEXT,
+            tipo TEXT,
+            tagliando BOOLEAN DEFAULT FALSE,
+            dischi_pattini BOOLEAN DEFAULT FALSE,
+            marca TEXT,
+            modello TEXT,
+            cilindrata INTEGER,
+            kw INTEGER,
+            cavalli INTEGER,
+            anno INTEGER,
+            stato TEXT,
+            cliente_nome TEXT,
+            cliente_cognome TEXT,
+            targa TEXT,
+            ordine_riparazione TEXT,
+            descrizione TEXT,
+            note TEXT,
+            eliminata BOOLEAN NOT NULL DEFAULT FALSE,
+            data_creazione TIMESTAMPTZ DEFAULT (NOW()),
+            data_aggiornamento TIMESTAMPTZ
+        );
+
+        CREATE TABLE IF NOT EXISTS gomme (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            marca TEXT NOT NULL,
+            larghezza INTEGER NOT NULL,
+            rapporto INTEGER NOT NULL,
+            diametro INTEGER NOT NULL,
+            prezzo_unitario REAL,
+            prezzo_treno REAL,
+            disponibilita INTEGER DEFAULT 0,
+            note TEXT,
+            UNIQUE (marca, larghezza, rapporto, diametro)
+        );
+
+        CREATE TABLE IF NOT EXISTS gomme_clienti (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT,
+            cognome TEXT,
+            targa TEXT,
+            data_inizio DATE,
+            marca TEXT,
+            larghezza INTEGER,
+            rapporto INTEGER,
+            diametro INTEGER,
+            note TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS ordini_magazzino (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            prodotto TEXT,
+            codice TEXT,
+            targa TEXT,
+            cliente TEXT,
+            fornitore TEXT,
+            stato TEXT,
+            data_creazione TIMESTAMPTZ DEFAULT (NOW())
+        );
+
+        CREATE TABLE IF NOT EXISTS magazzino (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            descrizione TEXT,
+            codice TEXT,
+            marca_veicolo TEXT,
+            tipo_veicolo TEXT,
+            note TEXT,
+            foto TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS prima_nota (
+            id TEXT PRIMARY KEY DEFAULT (lower(hex(randomblob(16)))),
+            data DATE NOT NULL,
+            descrizione TEXT,
+            cassa REAL DEFAULT 0,
+            banca REAL DEFAULT 0,
+            saldo_cassa REAL DEFAULT 0,
+            note TEXT,
+            username TEXT NOT NULL,
+            created_at TIMESTAMP,
+            chiusa BOOLEAN DEFAULT FALSE
+        );
+
+        CREATE TABLE IF NOT EXISTS prima_nota_storico (
+            id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            data DATE NOT NULL,
+            saldo_iniziale REAL DEFAULT 0,
+            saldo_finale REAL DEFAULT 0,
+            totale REAL DEFAULT 0,
+            chiusa BOOLEAN DEFAULT FALSE,
+            UNIQUE (username, data)
+        );
+
+        CREATE TABLE IF NOT EXISTS promemoria (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            utente_id INTEGER,
+            titolo TEXT,
+            info TEXT,
+            data_creazione TIMESTAMPTZ DEFAULT (NOW())
+        );
+
+        CREATE TABLE IF NOT EXISTS storico_azioni (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_utente INTEGER,
+            utente TEXT,
+            azione TEXT,
+            dettagli TEXT,
+            tabella_nome TEXT,
+            record_id INTEGER,
+            data_ora TIMESTAMPTZ DEFAULT (NOW())
+        );
+        """,
+    }),
+    (2, "indici per le query più frequenti", {
+        "postgres": """
+        -- i vecchi record possono avere eliminata = NULL: l'indice parziale richiede un valore
+        UPDATE lavorazioni SET eliminata = FALSE WHERE eliminata IS NULL;
+        ALTER TABLE lavorazioni ALTER COLUMN eliminata SET DEFAULT FALSE;
+        ALTER TABLE lavorazioni ALTER COLUMN eliminata SET NOT NULL;
+
+        -- lavorazioni attive per officina (home_officina, ajax_lavorazioni)
+        CREATE INDEX IF NOT EXISTS idx_lavorazioni_officina_attive
+            ON lavorazioni (id_officina, data_creazione DESC) WHERE eliminata = FALSE;
+
+        -- lavorazioni attive di tutte le officine (accettazione)
+        CREATE INDEX IF NOT EXISTS idx_lavorazioni_attive_data
+            ON lavorazioni (data_creazione DESC) WHERE eliminata = FALSE;
+
+        -- movimenti prima nota del giorno per utente
+        CREATE INDEX IF NOT EXISTS idx_prima_nota_username_data
+            ON prima_nota (username, data, created_at);
+
+        -- storico azioni più recenti
+        CREATE INDEX IF NOT EXISTS idx_storico_azioni_data_ora
+            ON storico_azioni (data_ora DESC, id DESC);
+
+        -- login case-insensitive
+        CREATE INDEX IF NOT EXISTS idx_utenti_username_lower
+            ON utenti (LOWER(username));
+
+        CREATE INDEX IF NOT EXISTS idx_clienti_utente
+            ON clienti (utente_id, id);
+
+        CREATE INDEX IF NOT EXISTS idx_vetture_utente
+            ON vetture (utente_id, id);
+
+        CREATE INDEX IF NOT EXISTS idx_modelli_marca_modello
+            ON modelli (marca, modello, versione);
+
+        CREATE INDEX IF NOT EXISTS idx_ricambi_codice
+            ON ricambi (codice);
+
+        CREATE INDEX IF NOT EXISTS idx_ricambi_sostituti_sostituto
+            ON ricambi_sostituti (codice_sostituto);
+
+        CREATE INDEX IF NOT EXISTS idx_modelli_ricambi_modello
+            ON modelli_ricambi (modello_id, ricambio_id);
+
+        CREATE INDEX IF NOT EXISTS idx_modelli_ricambi_ricambio
+            ON modelli_ricambi (ricambio_id);
+
+        CREATE INDEX IF NOT EXISTS idx_promemoria_utente_data
+            ON promemoria (utente_id, data_creazione DESC);
+
+        CREATE INDEX IF NOT EXISTS idx_promemoria_data
+            ON promemoria (data_creazione DESC);
+
+        CREATE INDEX IF NOT EXISTS idx_gomme_clienti_data_inizio
+            ON gomme_clienti (data_inizio DESC);
+        """,
+        "sqlite": """
+        -- lavorazioni attive per officina (home_officina, ajax_lavorazioni)
+        CREATE INDEX IF NOT EXISTS idx_lavorazioni_officina_attive
+            ON lavorazioni (id_officina, data_creazione DESC) WHERE eliminata = FALSE;
+
+        -- lavorazioni attive di tutte le officine (accettazione)
+        CREATE INDEX IF NOT EXISTS idx_lavorazioni_attive_data
+            ON lavorazioni (data_creazione DESC) WHERE eliminata = FALSE;
+
+        -- movimenti prima nota del giorno per utente
+        CREATE INDEX IF NOT EXISTS idx_prima_nota_username_data
+            ON prima_nota (username, data, created_at);
+
+        -- storico azioni più recenti
+        CREATE INDEX IF NOT EXISTS idx_storico_azioni_data_ora
+            ON storico_azioni (data_ora DESC, id DESC);
+
+        -- login case-insensitive
+        CREATE INDEX IF NOT EXISTS idx_utenti_username_lower
+            ON utenti (LOWER(username));
+
+        CREATE INDEX IF NOT EXISTS idx_clienti_utente
+            ON clienti (utente_id, id);
+
+        CREATE INDEX IF NOT EXISTS idx_vetture_utente
+            ON vetture (utente_id, id);
+
+        CREATE INDEX IF NOT EXISTS idx_modelli_marca_modello
+            ON modelli (marca, modello, versione);
+
+        CREATE INDEX IF NOT EXISTS idx_ricambi_codice
+            ON ricambi (codice);
+
+        CREATE INDEX IF NOT EXISTS idx_ricambi_sostituti_sostituto
+            ON ricambi_sostituti (codice_sostituto);
+
+        CREATE INDEX IF NOT EXISTS idx_modelli_ricambi_modello
+            ON modelli_ricambi (modello_id, ricambio_id);
+
+        CREATE INDEX IF NOT EXISTS idx_modelli_ricambi_ricambio
+            ON modelli_ricambi (ricambio_id);
+
+        CREATE INDEX IF NOT EXISTS idx_promemoria_utente_data
+            ON promemoria (utente_id, data_creazione DESC);
+
+        CREATE INDEX IF NOT EXISTS idx_promemoria_data
+            ON promemoria (data_creazione DESC);
+
+        CREATE INDEX IF NOT EXISTS idx_gomme_clienti_data_inizio
+            ON gomme_clienti (data_inizio DESC);
+        """,
+    }),
+    (3, "tabella permessi", {
+        "postgres": """
+        CREATE TABLE IF NOT EXISTS permessi (
+            username TEXT NOT NULL,
+            permesso TEXT NOT NULL,
+            PRIMARY KEY (username, permesso)
+        );
+
+        -- permessi finora scritti nel codice
+        INSERT INTO permessi (username, permesso) VALUES
+            ('G.AS_Giuseppe.Palladino', 'modelli'),
+            ('G.AS_Gianluca.Scala', 'modelli'),
+            ('G.AS_Giuseppe.Palladino', 'ricambi_modelli'),
+            ('G.AS_Giuseppe.Palladino', 'giacenza_ricambi')
+        ON CONFLICT DO NOTHING
+        """,
+        "sqlite": """
+        CREATE TABLE IF NOT EXISTS permessi (
+            username TEXT NOT NULL,
+            permesso TEXT NOT NULL,
+            PRIMARY KEY (username, permesso)
+        );
+
+        INSERT OR IGNORE INTO permessi (username, permesso) VALUES
+            ('G.AS_Giuseppe.Palladino', 'modelli'),
+            ('G.AS_Gianluca.Scala', 'modelli'),
+            ('G.AS_Giuseppe.Palladino', 'ricambi_modelli'),
+            ('G.AS_Giuseppe.Palladino', 'giacenza_ricambi')
+        """,
+    }),
+    (4, "contatori di versione per tabella", {
+        "postgres": """
+        CREATE TABLE IF NOT EXISTS versioni_tabelle (
+            tabella TEXT PRIMARY KEY,
+            versione BIGINT NOT NULL DEFAULT 0
+        );
+
+        INSERT INTO versioni_tabelle (tabella) VALUES
+            ('lavorazioni'), ('storico_azioni'), ('promemoria')
+        ON CONFLICT DO NOTHING;
+
+        CREATE OR REPLACE FUNCTION incrementa_versione_tabella() RETURNS trigger AS $$
+        BEGIN
+            UPDATE versioni_tabelle SET versione = versione + 1 WHERE tabella = TG_TABLE_NAME;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS trg_versione_lavorazioni ON lavorazioni;
+        CREATE TRIGGER trg_versione_lavorazioni
+            AFTER INSERT OR UPDATE OR DELETE ON lavorazioni
+            FOR EACH STATEMENT EXECUTE FUNCTION incrementa_versione_tabella();
+
+        DROP TRIGGER IF EXISTS trg_versione_storico_azioni ON storico_azioni;
+        CREATE TRIGGER trg_versione_storico_azioni
+            AFTER INSERT OR UPDATE OR DELETE ON storico_azioni
+            FOR EACH STATEMENT EXECUTE FUNCTION incrementa_versione_tabella();
+
+        DROP TRIGGER IF EXISTS trg_versione_promemoria ON promemoria;
+        CREATE TRIGGER trg_versione_promemoria
+            AFTER INSERT OR UPDATE OR DELETE ON promemoria
+            FOR EACH STATEMENT EXECUTE FUNCTION incrementa_versione_tabella();
+        """,
+        "sqlite": """
+        CREATE TABLE IF NOT EXISTS versioni_tabelle (
+            tabella TEXT PRIMARY KEY,
+            versione INTEGER NOT NULL DEFAULT 0
+        );
+
+        INSERT OR IGNORE INTO versioni_tabelle (tabella) VALUES
+            ('lavorazioni'), ('storico_azioni'), ('promemoria');
+        """ + "".join(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_versione_{tabella}_{evento.lower()}
+            AFTER {evento} ON {tabella}
+        BEGIN
+            UPDATE versioni_tabelle SET versione = versione + 1 WHERE tabella = '{tabella}';
+        END;
+        """ for tabella in ("lavorazioni", "storico_azioni", "promemoria")
+            for evento in ("INSERT", "UPDATE", "DELETE")),
+    }),
+    (5, "data_aggiornamento sempre valorizzata sulle lavorazioni", {
+        "postgres": """
+        UPDATE lavorazioni SET data_aggiornamento = COALESCE(data_creazione, NOW())
+        WHERE data_aggiornamento IS NULL;
+
+        ALTER TABLE lavorazioni ALTER COLUMN data_aggiornamento SET DEFAULT NOW();
+
+        -- sincronizzazione incrementale (?since=) del widget lavorazioni
+        CREATE INDEX IF NOT EXISTS idx_lavorazioni_data_aggiornamento
+            ON lavorazioni (data_aggiornamento);
+        """,
+        "sqlite": """
+        UPDATE lavorazioni SET data_aggiornamento = COALESCE(data_creazione, NOW())
+        WHERE data_aggiornamento IS NULL;
+
+        -- SQLite non permette di cambiare il DEFAULT di una colonna esistente;
+        -- NOW() (registrata da ConnessioneSQLite) dà l'ora italiana come nelle UPDATE
+        CREATE TRIGGER IF NOT EXISTS trg_lavorazioni_data_aggiornamento
+            AFTER INSERT ON lavorazioni
+            WHEN NEW.data_aggiornamento IS NULL
+        BEGIN
+            UPDATE lavorazioni SET data_aggiornamento = NOW() WHERE id = NEW.id;
+        END;
+
+        CREATE INDEX IF NOT EXISTS idx_lavorazioni_data_aggiornamento
+            ON lavorazioni (data_aggiornamento);
+        """,
+    }),
+    (6, "indici per i filtri dello storico", {
+        "postgres": """
+        -- filtri di /storico, nello stesso ordine della paginazione per chiave
+        CREATE INDEX IF NOT EXISTS idx_storico_azioni_utente_data
+            ON storico_azioni (id_utente, data_ora DESC, id DESC);
+
+        CREATE INDEX IF NOT EXISTS idx_storico_azioni_nome_utente_data
+            ON storico_azioni (utente, data_ora DESC, id DESC)
+            WHERE utente IS NOT NULL;
+
+        CREATE INDEX IF NOT EXISTS idx_storico_azioni_record_data
+            ON storico_azioni (tabella_nome, record_id, data_ora DESC, id DESC);
+        """,
+        "sqlite": """
+        -- filtri di /storico, nello stesso ordine della paginazione per chiave
+        CREATE INDEX IF NOT EXISTS idx_storico_azioni_utente_data
+            ON storico_azioni (id_utente, data_ora DESC, id DESC);
+
+        CREATE INDEX IF NOT EXISTS idx_storico_azioni_nome_utente_data
+            ON storico_azioni (utente, data_ora DESC, id DESC)
+            WHERE utente IS NOT NULL;
+
+        CREATE INDEX IF NOT EXISTS idx_storico_azioni_record_data
+            ON storico_azioni (tabella_nome, record_id, data_ora DESC, id DESC);
+        """,
+    }),
+    (7, "ricerca testuale sul magazzino", {
+        "postgres": """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+        -- codice e descrizione pesano più di marca/tipo, le note meno di tutti
+        ALTER TABLE magazzino ADD COLUMN IF NOT EXISTS ricerca tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('simple', COALESCE(codice, '') || ' ' || COALESCE(descrizione, '')), 'A') ||
+                setweight(to_tsvector('simple', COALESCE(marca_veicolo, '') || ' ' || COALESCE(tipo_veicolo, '')), 'B') ||
+                setweight(to_tsvector('simple', COALESCE(note, '')), 'C')
+            ) STORED;
+
+        CREATE INDEX IF NOT EXISTS idx_magazzino_ricerca
+            ON magazzino USING GIN (ricerca);
+
+        -- sottostringhe (es. parte di un codice) che il full-text non trova
+        CREATE INDEX IF NOT EXISTS idx_magazzino_testo_trgm
+            ON magazzino USING GIN ((
+                COALESCE(descrizione, '') || ' ' || COALESCE(codice, '') || ' ' || COALESCE(note, '') || ' ' ||
+                COALESCE(marca_veicolo, '') || ' ' || COALESCE(tipo_veicolo, '')
+            ) gin_trgm_ops);
+
+        CREATE INDEX IF NOT EXISTS idx_magazzino_marca_descrizione
+            ON magazzino (marca_veicolo, descrizione);
+        """,
+        "sqlite": """
+        CREATE VIRTUAL TABLE IF NOT EXISTS magazzino_fts USING fts5(
+            codice, descrizione, marca_veicolo, tipo_veicolo, note,
+            content='magazzino', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        );
+
+        INSERT INTO magazzino_fts (magazzino_fts) VALUES ('rebuild');
+
+        CREATE TRIGGER IF NOT EXISTS trg_magazzino_fts_insert AFTER INSERT ON magazzino
+        BEGIN
+            INSERT INTO magazzino_fts (rowid, codice, descrizione, marca_veicolo, tipo_veicolo, note)
+            VALUES (NEW.id, NEW.codice, NEW.descrizione, NEW.marca_veicolo, NEW.tipo_veicolo, NEW.note);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_magazzino_fts_delete AFTER DELETE ON magazzino
+        BEGIN
+            INSERT INTO magazzino_fts (magazzino_fts, rowid, codice, descrizione, marca_veicolo, tipo_veicolo, note)
+            VALUES ('delete', OLD.id, OLD.codice, OLD.descrizione, OLD.marca_veicolo, OLD.tipo_veicolo, OLD.note);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_magazzino_fts_update AFTER UPDATE ON magazzino
+        BEGIN
+            INSERT INTO magazzino_fts (magazzino_fts, rowid, codice, descrizione, marca_veicolo, tipo_veicolo, note)
+            VALUES ('delete', OLD.id, OLD.codice, OLD.descrizione, OLD.marca_veicolo, OLD.tipo_veicolo, OLD.note);
+            INSERT INTO magazzino_fts (rowid, codice, descrizione, marca_veicolo, tipo_veicolo, note)
+            VALUES (NEW.id, NEW.codice, NEW.descrizione, NEW.marca_veicolo, NEW.tipo_veicolo, NEW.note);
+        END;
+
+        CREATE INDEX IF NOT EXISTS idx_magazzino_marca_descrizione
+            ON magazzino (marca_veicolo, descrizione);
+        """,
+    }),
+    (8, "codice ricambio normalizzato e indici di ricerca", {
+        "postgres": """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+        -- stessa regola di normalizza_codice(): maiuscolo, solo lettere e cifre
+        ALTER TABLE ricambi ADD COLUMN IF NOT EXISTS codice_norm TEXT
+            GENERATED ALWAYS AS (UPPER(regexp_replace(codice, '[^A-Za-z0-9]', '', 'g'))) STORED;
+
+        -- prefisso (LIKE 'MANN%') con B-tree, sottostringhe con trigram
+        CREATE INDEX IF NOT EXISTS idx_ricambi_codice_norm_prefisso
+            ON ricambi (codice_norm text_pattern_ops);
+
+        CREATE INDEX IF NOT EXISTS idx_ricambi_codice_norm_trgm
+            ON ricambi USING GIN (codice_norm gin_trgm_ops);
+
+        CREATE INDEX IF NOT EXISTS idx_ricambi_nome_trgm
+            ON ricambi USING GIN (nome gin_trgm_ops);
+        """,
+        "sqlite": """
+        ALTER TABLE ricambi ADD COLUMN codice_norm TEXT;
+
+        UPDATE ricambi SET codice_norm = normalizza_codice(codice);
+
+        CREATE TRIGGER IF NOT EXISTS trg_ricambi_codice_norm_insert AFTER INSERT ON ricambi
+        BEGIN
+            UPDATE ricambi SET codice_norm = normalizza_codice(NEW.codice) WHERE id = NEW.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_ricambi_codice_norm_update AFTER UPDATE OF codice ON ricambi
+        BEGIN
+            UPDATE ricambi SET codice_norm = normalizza_codice(NEW.codice) WHERE id = NEW.id;
+        END;
+
+        -- LIKE 'MANN%' usa l'indice solo con collazione NOCASE
+        CREATE INDEX IF NOT EXISTS idx_ricambi_codice_norm_prefisso
+            ON ricambi (codice_norm COLLATE NOCASE);
+        """,
+    }),
+    (9, "permesso importazione ricambi", {
+        "postgres": """
+        INSERT INTO permessi (username, permesso) VALUES
+            ('G.AS_Giuseppe.Palladino', 'importa_ricambi')
+        ON CONFLICT DO NOTHING
+        """,
+        "sqlite": """
+        INSERT OR IGNORE INTO permessi (username, permesso) VALUES
+            ('G.AS_Giuseppe.Palladino', 'importa_ricambi')
+        """,
+    }),
+    # stesso SQL per entrambi i backend: i gruppi iniziali sono le componenti
+    # connesse dei legami di ricambi_sostituti (tabella non più scritta)
+    (10, "gruppi di ricambi equivalenti", dict.fromkeys(("postgres", "sqlite"), """
+        CREATE TABLE IF NOT EXISTS ricambi_gruppi (
+            codice TEXT PRIMARY KEY,
+            gruppo INTEGER NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_ricambi_gruppi_gruppo
+            ON ricambi_gruppi (gruppo);
+
+        WITH RECURSIVE archi (a, b) AS (
+            SELECT codice, codice_sostituto FROM ricambi_sostituti
+            UNION
+            SELECT codice_sostituto, codice FROM ricambi_sostituti
+        ), raggiungibili (origine, codice) AS (
+            SELECT a, a FROM archi
+            UNION
+            SELECT r.origine, archi.b FROM raggiungibili r JOIN archi ON archi.a = r.codice
+        )
+        INSERT INTO ricambi_gruppi (codice, gruppo)
+        SELECT r.origine, MIN(x.id)
+        FROM raggiungibili r
+        JOIN ricambi x ON x.codice = r.codice
+        WHERE EXISTS (SELECT 1 FROM ricambi o WHERE o.codice = r.origine)
+        GROUP BY r.origine
+        HAVING COUNT(DISTINCT x.codice) > 1
+        ON CONFLICT DO NOTHING;
+        """)),
+    (11, "registro movimenti di magazzino ricambi e istantanee giornaliere", {
+        "postgres": """
+        CREATE TABLE IF NOT EXISTS movimenti_ricambi (
+            id BIGSERIAL PRIMARY KEY,
+            ricambio_id INTEGER NOT NULL,
+            tipo TEXT NOT NULL,
+            delta INTEGER NOT NULL,
+            quantita_dopo INTEGER NOT NULL,
+            utente_id INTEGER,
+            causale TEXT,
+            data_ora TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_movimenti_ricambi_ricambio_data
+            ON movimenti_ricambi (ricambio_id, data_ora DESC, id DESC);
+
+        CREATE INDEX IF NOT EXISTS idx_movimenti_ricambi_data
+            ON movimenti_ricambi (data_ora);
+
+        CREATE TABLE IF NOT EXISTS giacenze_istantanee (
+            data DATE NOT NULL,
+            ricambio_id INTEGER NOT NULL,
+            quantita INTEGER NOT NULL,
+            PRIMARY KEY (data, ricambio_id)
+        );
+
+        -- la giacenza attuale diventa il movimento di apertura del registro
+        INSERT INTO movimenti_ricambi (ricambio_id, tipo, delta, quantita_dopo, causale, data_ora)
+        SELECT r.id, 'apertura', r.quantita, r.quantita, 'Giacenza iniziale del registro', NOW()
+        FROM ricambi r
+        WHERE NOT EXISTS (SELECT 1 FROM movimenti_ricambi m WHERE m.ricambio_id = r.id);
+        """,
+        "sqlite": """
+        CREATE TABLE IF NOT EXISTS movimenti_ricambi (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ricambio_id INTEGER NOT NULL,
+            tipo TEXT NOT NULL,
+            delta INTEGER NOT NULL,
+            quantita_dopo INTEGER NOT NULL,
+            utente_id INTEGER,
+            causale TEXT,
+            data_ora TIMESTAMPTZ NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_movimenti_ricambi_ricambio_data
+            ON movimenti_ricambi (ricambio_id, data_ora DESC, id DESC);
+
+        CREATE INDEX IF NOT EXISTS idx_movimenti_ricambi_data
+            ON movimenti_ricambi (data_ora);
+
+        CREATE TABLE IF NOT EXISTS giacenze_istantanee (
+            data DATE NOT NULL,
+            ricambio_id INTEGER NOT NULL,
+            quantita INTEGER NOT NULL,
+            PRIMARY KEY (data, ricambio_id)
+        );
+
+        INSERT INTO movimenti_ricambi (ricambio_id, tipo, delta, quantita_dopo, causale, data_ora)
+        SELECT r.id, 'apertura', r.quantita, r.quantita, 'Giacenza iniziale del registro', NOW()
+        FROM ricambi r
+        WHERE NOT EXISTS (SELECT 1 FROM movimenti_ricambi m WHERE m.ricambio_id = r.id);
+        """,
+    }),
+    # misure equivalenti calcolate una volta sola sulla griglia delle misure
+    # commerciali: circonferenza di rotolamento entro il 3%, cerchio ±1" e
+    # larghezza ±20 mm; la ricerca gomme legge solo questa tabella
+    (12, "indice misure gomme e tabella misure equivalenti", dict.fromkeys(("postgres", "sqlite"), """
+        CREATE INDEX IF NOT EXISTS idx_gomme_misura
+            ON gomme (larghezza, rapporto, diametro);
+
+        CREATE TABLE IF NOT EXISTS gomme_misure_equivalenti (
+            larghezza INTEGER NOT NULL,
+            rapporto INTEGER NOT NULL,
+            diametro INTEGER NOT NULL,
+            alt_larghezza INTEGER NOT NULL,
+            alt_rapporto INTEGER NOT NULL,
+            alt_diametro INTEGER NOT NULL,
+            scarto REAL NOT NULL,
+            PRIMARY KEY (larghezza, rapporto, diametro, alt_larghezza, alt_rapporto, alt_diametro)
+        );
+
+        WITH RECURSIVE larghezze (l) AS (
+            SELECT 135 UNION ALL SELECT l + 10 FROM larghezze WHERE l < 335
+        ), rapporti (r) AS (
+            SELECT 25 UNION ALL SELECT r + 5 FROM rapporti WHERE r < 85
+        ), diametri (d) AS (
+            SELECT 12 UNION ALL SELECT d + 1 FROM diametri WHERE d < 24
+        ), misure (l, r, d, sviluppo) AS (
+            SELECT l, r, d, d * 25.4 + 2 * l * r / 100.0
+            FROM larghezze, rapporti, diametri
+        )
+        INSERT INTO gomme_misure_equivalenti
+            (larghezza, rapporto, diametro, alt_larghezza, alt_rapporto, alt_diametro, scarto)
+        SELECT a.l, a.r, a.d, b.l, b.r, b.d, ROUND((b.sviluppo - a.sviluppo) / a.sviluppo, 4)
+        FROM misure a
+        JOIN misure b
+          ON b.d BETWEEN a.d - 1 AND a.d + 1
+         AND b.l BETWEEN a.l - 20 AND a.l + 20
+         AND NOT (b.l = a.l AND b.r = a.r AND b.d = a.d)
+        WHERE ABS(b.sviluppo - a.sviluppo) <= 0.03 * a.sviluppo
+        ON CONFLICT DO NOTHING;
+        """)),
+    (13, "targa normalizzata e stagione di deposito in gomme_clienti", {
+        "postgres": """
+        -- stessa regola di normalizza_targa(): maiuscolo, solo lettere e cifre
+        ALTER TABLE gomme_clienti ADD COLUMN IF NOT EXISTS targa_norm TEXT
+            GENERATED ALWAYS AS (UPPER(regexp_replace(COALESCE(targa, ''), '[^A-Za-z0-9]', '', 'g'))) STORED;
+
+        -- stessa regola di stagione_deposito(): marzo-agosto → primavera
+        ALTER TABLE gomme_clienti ADD COLUMN IF NOT EXISTS stagione_deposito TEXT
+            GENERATED ALWAYS AS (
+                CASE
+                    WHEN data_inizio IS NULL THEN NULL
+                    WHEN EXTRACT(MONTH FROM data_inizio) BETWEEN 3 AND 8 THEN 'primavera'
+                    ELSE 'autunno'
+                END
+            ) STORED;
+
+        CREATE INDEX IF NOT EXISTS idx_gomme_clienti_targa_norm
+            ON gomme_clienti (targa_norm text_pattern_ops);
+
+        -- pianificazione cambio stagionale, nell'ordine di pagina (cognome, targa)
+        CREATE INDEX IF NOT EXISTS idx_gomme_clienti_pianificazione
+            ON gomme_clienti (stagione_deposito, LOWER(COALESCE(cognome, '')), targa_norm, id);
+        """,
+        "sqlite": """
+        ALTER TABLE gomme_clienti ADD COLUMN targa_norm TEXT;
+        ALTER TABLE gomme_clienti ADD COLUMN stagione_deposito TEXT;
+
+        UPDATE gomme_clienti
+        SET targa_norm = normalizza_targa(targa), stagione_deposito = stagione_deposito(data_inizio);
+
+        CREATE TRIGGER IF NOT EXISTS trg_gomme_clienti_norm_insert AFTER INSERT ON gomme_clienti
+        BEGIN
+            UPDATE gomme_clienti
+            SET targa_norm = normalizza_targa(NEW.targa), stagione_deposito = stagione_deposito(NEW.data_inizio)
+            WHERE id = NEW.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_gomme_clienti_norm_update AFTER UPDATE OF targa, data_inizio ON gomme_clienti
+        BEGIN
+            UPDATE gomme_clienti
+            SET targa_norm = normalizza_targa(NEW.targa), stagione_deposito = stagione_deposito(NEW.data_inizio)
+            WHERE id = NEW.id;
+        END;
+
+        CREATE INDEX IF NOT EXISTS idx_gomme_clienti_targa_norm
+            ON gomme_clienti (targa_norm COLLATE NOCASE);
+
+        CREATE INDEX IF NOT EXISTS idx_gomme_clienti_pianificazione
+            ON gomme_clienti (stagione_deposito, LOWER(COALESCE(cognome, '')), targa_norm, id);
+        """,
+    }),
+    (14, "targa normalizzata in vetture, lavorazioni e ordini_magazzino", {
+        "postgres": """
+        -- stessa regola di normalizza_targa(), come gomme_clienti.targa_norm
+        ALTER TABLE vetture ADD COLUMN IF NOT EXISTS targa_norm TEXT
+            GENERATED ALWAYS AS (UPPER(regexp_replace(COALESCE(targa, ''), '[^A-Za-z0-9]', '', 'g'))) STORED;
+
+        ALTER TABLE lavorazioni ADD COLUMN IF NOT EXISTS targa_norm TEXT
+            GENERATED ALWAYS AS (UPPER(regexp_replace(COALESCE(targa, ''), '[^A-Za-z0-9]', '', 'g'))) STORED;
+
+        ALTER TABLE ordini_magazzino ADD COLUMN IF NOT EXISTS targa_norm TEXT
+            GENERATED ALWAYS AS (UPPER(regexp_replace(COALESCE(targa, ''), '[^A-Za-z0-9]', '', 'g'))) STORED;
+
+        CREATE INDEX IF NOT EXISTS idx_vetture_targa_norm
+            ON vetture (targa_norm);
+
+        CREATE INDEX IF NOT EXISTS idx_lavorazioni_targa_norm
+            ON lavorazioni (targa_norm, data_creazione DESC);
+
+        -- lavorazioni collegate alla vettura ma senza targa propria
+        CREATE INDEX IF NOT EXISTS idx_lavorazioni_vettura
+            ON lavorazioni (vettura_id);
+
+        CREATE INDEX IF NOT EXISTS idx_ordini_magazzino_targa_norm
+            ON ordini_magazzino (targa_norm);
+        """,
+        "sqlite": """
+        ALTER TABLE vetture ADD COLUMN targa_norm TEXT;
+        UPDATE vetture SET targa_norm = normalizza_targa(targa);
+
+        CREATE TRIGGER IF NOT EXISTS trg_vetture_targa_norm_insert AFTER INSERT ON vetture
+        BEGIN
+            UPDATE vetture SET targa_norm = normalizza_targa(NEW.targa) WHERE id = NEW.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_vetture_targa_norm_update AFTER UPDATE OF targa ON vetture
+        BEGIN
+            UPDATE vetture SET targa_norm = normalizza_targa(NEW.targa) WHERE id = NEW.id;
+        END;
+
+        ALTER TABLE lavorazioni ADD COLUMN targa_norm TEXT;
+        UPDATE lavorazioni SET targa_norm = normalizza_targa(targa);
+
+        CREATE TRIGGER IF NOT EXISTS trg_lavorazioni_targa_norm_insert AFTER INSERT ON lavorazioni
+        BEGIN
+            UPDATE lavorazioni SET targa_norm = normalizza_targa(NEW.targa) WHERE id = NEW.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_lavorazioni_targa_norm_update AFTER UPDATE OF targa ON lavorazioni
+        BEGIN
+            UPDATE lavorazioni SET targa_norm = normalizza_targa(NEW.targa) WHERE id = NEW.id;
+        END;
+
+        ALTER TABLE ordini_magazzino ADD COLUMN targa_norm TEXT;
+        UPDATE ordini_magazzino SET targa_norm = normalizza_targa(targa);
+
+        CREATE TRIGGER IF NOT EXISTS trg_ordini_magazzino_targa_norm_insert AFTER INSERT ON ordini_magazzino
+        BEGIN
+            UPDATE ordini_magazzino SET targa_norm = normalizza_targa(NEW.targa) WHERE id = NEW.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_ordini_magazzino_targa_norm_update AFTER UPDATE OF targa ON ordini_magazzino
+        BEGIN
+            UPDATE ordini_magazzino SET targa_norm = normalizza_targa(NEW.targa) WHERE id = NEW.id;
+        END;
+
+        CREATE INDEX IF NOT EXISTS idx_vetture_targa_norm
+            ON vetture (targa_norm);
+
+        CREATE INDEX IF NOT EXISTS idx_lavorazioni_targa_norm
+            ON lavorazioni (targa_norm, data_creazione DESC);
+
+        -- lavorazioni collegate alla vettura ma senza targa propria
+        CREATE INDEX IF NOT EXISTS idx_lavorazioni_vettura
+            ON lavorazioni (vettura_id);
+
+        CREATE INDEX IF NOT EXISTS idx_ordini_magazzino_targa_norm
+            ON ordini_magazzino (targa_norm);
+        """,
+    }),
+    (15, "varianti WebP delle foto magazzino", {
+        "postgres": """
+        ALTER TABLE magazzino ADD COLUMN IF NOT EXISTS foto_media TEXT;
+        ALTER TABLE magazzino ADD COLUMN IF NOT EXISTS foto_miniatura TEXT;
+        """,
+        "sqlite": """
+        ALTER TABLE magazzino ADD COLUMN foto_media TEXT;
+        ALTER TABLE magazzino ADD COLUMN foto_miniatura TEXT;
+        """,
+    }),
+    # coda persistente delle operazioni sullo storage foto; il lavoro
+    # 'pulizia' non si chiude mai e viene ripianificato a ogni esecuzione
+    (16, "coda dei lavori sullo storage foto", {
+        "postgres": """
+        CREATE TABLE IF NOT EXISTS lavori_storage (
+            id BIGSERIAL PRIMARY KEY,
+            tipo TEXT NOT NULL,
+            magazzino_id INTEGER,
+            oggetti TEXT,
+            dati BYTEA,
+            tentativi INTEGER NOT NULL DEFAULT 0,
+            prossimo_tentativo TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            ultimo_errore TEXT,
+            creato TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_lavori_storage_prossimo
+            ON lavori_storage (prossimo_tentativo, id);
+
+        CREATE INDEX IF NOT EXISTS idx_lavori_storage_magazzino
+            ON lavori_storage (magazzino_id) WHERE magazzino_id IS NOT NULL;
+
+        INSERT INTO lavori_storage (tipo)
+        SELECT 'pulizia' WHERE NOT EXISTS (SELECT 1 FROM lavori_storage WHERE tipo = 'pulizia');
+        """,
+        "sqlite": """
+        CREATE TABLE IF NOT EXISTS lavori_storage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL,
+            magazzino_id INTEGER,
+            oggetti TEXT,
+            dati BLOB,
+            tentativi INTEGER NOT NULL DEFAULT 0,
+            prossimo_tentativo TIMESTAMPTZ NOT NULL,
+            ultimo_errore TEXT,
+            creato TIMESTAMPTZ NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_lavori_storage_prossimo
+            ON lavori_storage (prossimo_tentativo, id);
+
+        CREATE INDEX IF NOT EXISTS idx_lavori_storage_magazzino
+            ON lavori_storage (magazzino_id) WHERE magazzino_id IS NOT NULL;
+
+        INSERT INTO lavori_storage (tipo, prossimo_tentativo, creato)
+        SELECT 'pulizia', NOW(), NOW() WHERE NOT EXISTS (SELECT 1 FROM lavori_storage WHERE tipo = 'pulizia');
+        """,
+    }),
+    # contatore di versione dei permessi: ogni worker si accorge delle modifiche
+    # (anche quelle fatte dalla CLI) con una lettura per richiesta
+    (17, "contatore di versione della tabella permessi", {
+        "postgres": """
+        INSERT INTO versioni_tabelle (tabella) VALUES ('permessi')
+        ON CONFLICT DO NOTHING;
+
+        DROP TRIGGER IF EXISTS trg_versione_permessi ON permessi;
+        CREATE TRIGGER trg_versione_permessi
+            AFTER INSERT OR UPDATE OR DELETE ON permessi
+            FOR EACH STATEMENT EXECUTE FUNCTION incrementa_versione_tabella();
+        """,
+        "sqlite": """
+        INSERT OR IGNORE INTO versioni_tabelle (tabella) VALUES ('permessi');
+        """ + "".join(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_versione_permessi_{evento.lower()}
+            AFTER {evento} ON permessi
+        BEGIN
+            UPDATE versioni_tabelle SET versione = versione + 1 WHERE tabella = 'permessi';
+        END;
+        """ for evento in ("INSERT", "UPDATE", "DELETE")),
+    }),
+    (18, "permesso diagnostica", {
+        "postgres": """
+        INSERT INTO permessi (username, permesso) VALUES
+            ('G.AS_Giuseppe.Palladino', 'diagnostica')
+        ON CONFLICT DO NOTHING
+        """,
+        "sqlite": """
+        INSERT OR IGNORE INTO permessi (username, permesso) VALUES
+            ('G.AS_Giuseppe.Palladino', 'diagnostica')
+        """,
+    }),
+]
+
+# Chiave dell'advisory lock Postgres: un solo processo alla volta applica le migrazioni
+_LOCK_MIGRAZIONI = 827351
+# Chiave dell'advisory lock che serializza collegamento ed eliminazione delle foto
+_LOCK_STORAGE = 827352
+
+
+_RE_TRIGGER_SQLITE = re.compile(r"^\s*CREATE\s+TRIGGER\b.*\bBEGIN\b", re.IGNORECASE | re.DOTALL)
+_RE_FINE_BLOCCO = re.compile(r"\bEND\s*$", re.IGNORECASE)
+
+
+def _istruzioni_sql(sql):
+    """
+    Divide uno script in istruzioni singole, ignorando commenti e righe vuote.
+    I corpi $$ ... $$ (funzioni Postgres) e BEGIN ... END (trigger SQLite)
+    restano interi anche se contengono punti e virgola.
+    """
+    righe = [r for r in sql.splitlines() if r.strip() and not r.strip().startswith("--")]
+    istruzioni = []
+    corrente = ""
+    for pezzo in "\n".join(righe).split(";"):
+        corrente = f"{corrente};{pezzo}" if corrente else pezzo
+        aperta = corrente.count("$$") % 2 == 1 or (
+            _RE_TRIGGER_SQLITE.match(corrente) and not _RE_FINE_BLOCCO.search(corrente)
+        )
+        if not aperta:
+            if corrente.strip():
+                istruzioni.append(corrente.strip())
+            corrente = ""
+    if corrente.strip():
+        istruzioni.append(corrente.strip())
+    return istruzioni
+
+
+def applica_migrazioni(conn):
+    """
+    Porta lo schema all'ultima versione: applica in ordine le migrazioni
+    mancanti, ognuna nella propria transazione, e le registra in
+    schema_migrazioni. Restituisce le versioni applicate.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrazioni (
+            versione INTEGER PRIMARY KEY,
+            descrizione TEXT NOT NULL,
+            applicata_il TIMESTAMPTZ NOT NULL
+        )
+    """)
+    conn.commit()
+
+    applicate = []
+    try:
+        for versione, descrizione, sql in MIGRAZIONI:
+            if DB_BACKEND == "postgres":
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (_LOCK_MIGRAZIONI,))
+            else:
+                cur.execute("BEGIN IMMEDIATE")
+            cur.execute("SELECT 1 FROM schema_migrazioni WHERE versione = %s", (versione,))
+            if cur.fetchone():
+                conn.rollback()
+                continue
+            for istruzione in _istruzioni_sql(sql[DB_BACKEND]):
+                cur.execute(istruzione)
+            cur.execute(
+                "INSERT INTO schema_migrazioni (versione, descrizione, applicata_il) VALUES (%s, %s, %s)",
+                (versione, descrizione, now_ita())
+            )
+            conn.commit()
+            applicate.append(versione)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return applicate
+
+
+def versione_schema(conn):
+    """Versione di schema registrata nel database (0 se mai migrato)."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT MAX(versione) FROM schema_migrazioni")
+        row = cur.fetchone()
+    except Exception:
+        conn.rollback()
+        return 0
+    finally:
+        cur.close()
+    return (row[0] if row else None) or 0
+
+
+def _nuova_connessione():
+    """Connessione fuori dal pool sul backend selezionato."""
+    return _nuova_connessione_sqlite() if DB_BACKEND == "sqlite" else _nuova_connessione_postgres()
+
+
+# Con MIGRAZIONI_AUTOMATICHE=0 le migrazioni si applicano solo con `flask migra`
+# e un processo con lo schema indietro rifiuta di partire
+MIGRAZIONI_AUTOMATICHE = os.environ.get("MIGRAZIONI_AUTOMATICHE", "1") == "1"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _pool_db():
+    """Crea (una sola volta per processo) il pool e lo riscalda in background."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                crea = _nuova_connessione
+                # lo schema viene aggiornato all'avvio: le route danno per scontata l'ultima
+                # versione. L'advisory lock (Postgres) o BEGIN IMMEDIATE (SQLite) fanno
+                # applicare le migrazioni a un solo processo alla volta.
+                conn = crea()
+                try:
+                    if MIGRAZIONI_AUTOMATICHE:
+                        applica_migrazioni(conn)
+                    elif versione_schema(conn) < MIGRAZIONI[-1][0]:
+                        raise RuntimeError(
+                            f"❌ ERRORE: schema alla versione {versione_schema(conn)}, "
+                            f"serve la {MIGRAZIONI[-1][0]}: eseguire `flask --app app migra`"
+                        )
+                finally:
+                    conn.close()
+                _pool = PoolConnessioni(crea, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT)
+                threading.Thread(target=_pool.riscalda, name="riscalda-pool-db", daemon=True).start()
+    return _pool
+
+
+# =====================================
+# STRUMENTAZIONE SQL PER RICHIESTA
+# =====================================
+# Per ogni richiesta vengono contati query, tempo sul database, connessioni
+# prese dal pool e istruzioni identiche ripetute (tipico schema N+1).
+# I dati finiscono negli header X-DB-Stats / Server-Timing e in un
+# riepilogo per endpoint consultabile su /diagnostica/sql.
+SQL_STRUMENTAZIONE = os.environ.get("SQL_STRUMENTAZIONE", "1") == "1"
+# Oltre questa soglia di istruzioni identiche nella stessa richiesta si logga un avviso
+SQL_SOGLIA_RIPETUTE = int(os.environ.get("SQL_SOGLIA_RIPETUTE", 5))
+
+_RE_SPAZI = re.compile(r"\s+")
+_riepilogo_sql = {}
+_riepilogo_sql_lock = threading.Lock()
+
+
+def _stat_sql_richiesta():
+    if not SQL_STRUMENTAZIONE or not has_request_context():
+        return None
+    stat = g.get("_sql_stat")
+    if stat is None:
+        stat = g._sql_stat = {"query": 0, "tempo_ms": 0.0, "connessioni": 0, "istruzioni": {}}
+    return stat
+
+
+class CursoreStrumentato:
+    """Cursore che misura ogni execute() e lo registra nelle statistiche della richiesta."""
+
+    def __init__(self, cur, stat):
+        self._cur = cur
+        self._stat = stat
+
+    def _registra(self, query, inizio):
+        self._stat["query"] += 1
+        self._stat["tempo_ms"] += (time.perf_counter() - inizio) * 1000
+        chiave = _RE_SPAZI.sub(" ", query).strip()
+        self._stat["istruzioni"][chiave] = self._stat["istruzioni"].get(chiave, 0) + 1
+
+    def execute(self, query, params=None):
+        inizio = time.perf_counter()
+        try:
+            return self._cur.execute(query, params)
+        finally:
+            self._registra(query, inizio)
+
+    def executemany(self, query, seq_params):
+        inizio = time.perf_counter()
+        try:
+            return self._cur.executemany(query, seq_params)
+        finally:
+            self._registra(query, inizio)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def __getattr__(self, nome):
+        return getattr(self._cur, nome)
+
+
+def _ripetute(stat):
+    return {q: n for q, n in stat["istruzioni"].items() if n > 1}
+
+
+@app.after_request
+def aggiungi_statistiche_sql(response):
+    stat = g.get("_sql_stat")
+    if stat is None:
+        if not response.is_streamed or not SQL_STRUMENTAZIONE:
+            return response
+        # le query arriveranno durante lo streaming (stream_with_context mantiene g)
+        stat = _stat_sql_richiesta()
+    ripetute = _ripetute(stat)
+    # le risposte in streaming (CSV, stream_template, SSE) leggono il database dopo
+    # gli header: questi valori sono parziali, il riepilogo si registra a stream chiuso
+    response.headers["X-DB-Stats"] = (
+        f"query={stat['query']}; tempo_ms={stat['tempo_ms']:.1f}; "
+        f"connessioni={stat['connessioni']}; ripetute={sum(ripetute.values())}"
+        + ("; streaming=parziale" if response.is_streamed else "")
+    )
+    response.headers.add("Server-Timing", f'db;dur={stat["tempo_ms"]:.1f};desc="{stat["query"]} query"')
+
+    endpoint = request.endpoint or request.path
+    if response.is_streamed:
+        response.call_on_close(lambda: _registra_statistiche_sql(endpoint, stat))
+    else:
+        _registra_statistiche_sql(endpoint, stat)
+    return response
+
+
+def _registra_statistiche_sql(endpoint, stat):
+    """Somma le statistiche di una richiesta conclusa al riepilogo per endpoint."""
+    ripetute = _ripetute(stat)
+    if ripetute and max(ripetute.values()) >= SQL_SOGLIA_RIPETUTE:
+        app.logger.warning(
+            "Possibile N+1 su %s: %s",
+            endpoint, "; ".join(f"{n}x {q[:80]}" for q, n in ripetute.items())
+        )
+    with _riepilogo_sql_lock:
+        r = _riepilogo_sql.setdefault(endpoint, {
+            "richieste": 0, "query": 0, "tempo_ms": 0.0, "connessioni": 0,
+            "max_query": 0, "richieste_con_ripetute": 0, "ripetute": {}
+        })
+        r["richieste"] += 1
+        r["query"] += stat["query"]
+        r["tempo_ms"] += stat["tempo_ms"]
+        r["connessioni"] += stat["connessioni"]
+        r["max_query"] = max(r["max_query"], stat["query"])
+        if ripetute:
+            r["richieste_con_ripetute"] += 1
+            for q, n in ripetute.items():
+                r["ripetute"][q] = max(r["ripetute"].get(q, 0), n)
+
+
+def riepilogo_sql():
+    """Riepilogo per endpoint: medie di query, tempo DB e connessioni, istruzioni ripetute."""
+    with _riepilogo_sql_lock:
+        copia = {e: dict(r, ripetute=dict(r["ripetute"])) for e, r in _riepilogo_sql.items()}
+    for r in copia.values():
+        n = r["richieste"]
+        r["query_medie"] = round(r["query"] / n, 2)
+        r["tempo_medio_ms"] = round(r["tempo_ms"] / n, 3)
+        r["connessioni_medie"] = round(r["connessioni"] / n, 2)
+        r["tempo_ms"] = round(r["tempo_ms"], 3)
+    # lista ordinata per tempo DB totale: gli endpoint più costosi in cima
+    return sorted(
+        ({"endpoint": e, **r} for e, r in copia.items()),
+        key=lambda r: r["tempo_ms"], reverse=True
+    )
+
+
+class ConnessionePrestata:
+    """
+    Connessione presa in prestito dal pool.
+    Dentro una richiesta la stessa connessione è condivisa da tutti gli helper,
+    quindi close() non tocca la transazione: un helper che apre e chiude la
+    connessione non deve mai confermare né annullare il lavoro del chiamante.
+    Fa eccezione solo una transazione già fallita su Postgres, che verrebbe
+    comunque annullata e bloccherebbe ogni query successiva della richiesta.
+    Il lavoro non confermato si annulla al teardown, quando la connessione
+    torna al pool. Fuori da una richiesta close() la restituisce subito.
+    """
+
+    def __init__(self, pool, per_richiesta):
+        self._pool = pool
+        self._per_richiesta = per_richiesta
+        self._conn = pool.acquisisci()
+        self._stat = _stat_sql_richiesta()
+        if self._stat is not None:
+            self._stat["connessioni"] += 1
+
+    def cursor(self, *args, **kwargs):
+        cur = self._conn.cursor(*args, **kwargs)
+        return CursoreStrumentato(cur, self._stat) if self._stat is not None else cur
+
+    def __getattr__(self, nome):
+        if self.__dict__.get("_conn") is None:
+            raise psycopg2.InterfaceError("connessione già restituita al pool")
+        return getattr(self._conn, nome)
+
+    def close(self):
+        if self._conn is None:
+            return
+        if not self._per_richiesta:
+            self.restituisci()
+            return
+        if DB_BACKEND != "postgres":
+            return
+        try:
+            if self._conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                self._conn.rollback()
+        except Exception:
+            # connessione rotta: verrà scartata dal pool al teardown
+            pass
+
+    def restituisci(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.rilascia(conn)
+
+
+def get_db_connection():
+    """
+    Restituisce la connessione al database della richiesta corrente,
+    presa dal pool alla prima chiamata e restituita al teardown.
+    """
+    try:
+        if has_app_context():
+            conn = g.get("_db_conn")
+            if conn is None:
+                conn = g._db_conn = ConnessionePrestata(_pool_db(), per_richiesta=True)
+            return conn
+        return ConnessionePrestata(_pool_db(), per_richiesta=False)
     except Exception as e:
         raise RuntimeError(f"Impossibile connettersi al database: {e}")
 
 
+@app.teardown_appcontext
+def rilascia_connessione_db(exc):
+    # il rollback del lavoro non confermato avviene qui (Pool.rilascia), non in close()
+    conn = g.pop("_db_conn", None)
+    if conn is not None:
+        conn.restituisci()
+
+
+def statistiche_db():
+    """Metriche del pool (dimensione, checkout, tempi di attesa) e della cache DNS."""
+    stat = _pool_db().statistiche()
+    stat["backend"] = DB_BACKEND
+    stat["versione_schema"] = versione_schema(get_db_connection())
+    stat["coda_storico"] = coda_storico.statistiche()
+    stat["eventi"] = broker_eventi.statistiche()
+    if DB_BACKEND == "sqlite":
+        stat["percorso"] = DB_SQLITE_PATH
+    else:
+        stat["host"] = DB_HOST
+        stat["host_ip"] = _dns_cache["ip"]
+    return stat
+
+
 def lavorazioni_officina_query(user_id):
     """Restituisce tutte le lavorazioni relative all'officina indicata."""
     conn = get_db_connection()
@@ -162,10 +1930,529 @@ def lavorazioni_officina_query(user_id):
         conn.close()
     return rows
 
+# =====================================
+# IDENTITÀ E PERMESSI (cache in memoria)
+# =====================================
+# La tabella permessi (username → permesso) viene letta una volta e tenuta
+# in memoria per tutto il processo. A ogni richiesta che controlla un
+# permesso si legge solo il contatore versioni_tabelle['permessi'] (una
+# riga per chiave primaria, incrementata da trigger): se è cambiato, anche
+# per una modifica fatta da un altro worker o dalla CLI, la mappa viene
+# ricaricata. PERMESSI_TTL resta come rete di sicurezza.
+PERMESSI_TTL = float(os.environ.get("PERMESSI_TTL", 300))
+
+
+class CachePermessi:
+    """Permessi di tutti gli utenti, ricaricati quando cambia il contatore di versione, alla scadenza o dopo invalida()."""
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._permessi = None
+        self._versione = None
+        self._scadenza = 0.0
+        self._lock = threading.Lock()
+
+    def _versione_corrente(self):
+        # un controllo per richiesta, anche se la pagina verifica più permessi
+        if has_request_context() and "_versione_permessi" in g:
+            return g._versione_permessi
+        versioni = versioni_tabelle("permessi")
+        versione = versioni[0] if versioni else None
+        if has_request_context():
+            g._versione_permessi = versione
+        return versione
+
+    def _carica(self):
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT username, permesso FROM permessi")
+            rows = cur.fetchall()
+        finally:
+            conn.close()
+        mappa = {}
+        for username, permesso in rows:
+            mappa.setdefault(username.lower(), set()).add(permesso)
+        return mappa
+
+    def _scaduta(self, versione):
+        return self._permessi is None or versione != self._versione or time.monotonic() >= self._scadenza
+
+    def permessi(self, username):
+        versione = self._versione_corrente()
+        if self._scaduta(versione):
+            with self._lock:
+                if self._scaduta(versione):
+                    try:
+                        self._permessi = self._carica()
+                        self._versione = versione
+                    except Exception:
+                        if self._permessi is None:
+                            raise
+                        # database non raggiungibile: si continua con i permessi noti
+                        app.logger.exception("Ricarica permessi non riuscita.")
+                    self._scadenza = time.monotonic() + self._ttl
+        return self._permessi.get((username or "").lower(), frozenset())
+
+    def invalida(self):
+        with self._lock:
+            self._permessi = None
+
+
+cache_permessi = CachePermessi(PERMESSI_TTL)
+
+
+def nome_utente_corrente():
+    """Username dell'utente loggato, salvato in sessione al login."""
+    username = session.get('username')
+    if not username and session.get('user_id'):
+        # sessioni create prima che lo username fosse salvato
+        username = session['username'] = get_nome_reale(session['user_id'])
+    return username
+
+
+def ha_permesso(permesso: str) -> bool:
+    """True se l'utente loggato ha il permesso indicato."""
+    return permesso in cache_permessi.permessi(nome_utente_corrente())
+
+
+@app.context_processor
+def inietta_permessi():
+    return {"ha_permesso": ha_permesso}
+
+@app.context_processor
+def inietta_eventi():
+    # le dashboard scelgono tra stream SSE e polling
+    return {"eventi_sse": EVENTI_SSE, "eventi_polling": EVENTI_POLLING}
+
+# =====================================
+# CACHE DATI DI RIFERIMENTO
+# =====================================
+# Catalogo modelli, elenco marche e mappa dei sostituti cambiano di rado:
+# vengono letti una volta e serviti dalla memoria finché una route di
+# scrittura non li invalida. Il TTL limita quanto a lungo un altro worker
+# può servire dati vecchi. I valori restituiti sono condivisi: non modificarli.
+CACHE_RIFERIMENTO_MAX = int(os.environ.get("CACHE_RIFERIMENTO_MAX", 64))
+CACHE_RIFERIMENTO_TTL = float(os.environ.get("CACHE_RIFERIMENTO_TTL", 300))
+
+
+class CacheRiferimento:
+    """Cache read-through LRU con TTL, numero massimo di voci e contatori hit/miss."""
+
+    def __init__(self, max_voci, ttl):
+        self._max_voci = max_voci
+        self._ttl = ttl
+        self._voci = OrderedDict()     # chiave → (scadenza, valore)
+        self._lock = threading.Lock()
+        self._stat = {"hit": 0, "miss": 0, "espulse": 0, "invalidate": 0}
+
+    def ottieni(self, chiave, carica):
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is not None and voce[0] > time.monotonic():
+                self._voci.move_to_end(chiave)
+                self._stat["hit"] += 1
+                return voce[1]
+            self._stat["miss"] += 1
+        valore = carica()
+        with self._lock:
+            self._voci[chiave] = (time.monotonic() + self._ttl, valore)
+            self._voci.move_to_end(chiave)
+            while len(self._voci) > self._max_voci:
+                self._voci.popitem(last=False)
+                self._stat["espulse"] += 1
+        return valore
+
+    def invalida(self, *chiavi):
+        with self._lock:
+            for chiave in chiavi:
+                if self._voci.pop(chiave, None) is not None:
+                    self._stat["invalidate"] += 1
+
+    def statistiche(self):
+        with self._lock:
+            stat = dict(self._stat)
+            stat["voci"] = len(self._voci)
+            stat["chiavi"] = list(self._voci)
+        stat["max_voci"] = self._max_voci
+        richieste = stat["hit"] + stat["miss"]
+        stat["hit_ratio"] = round(stat["hit"] / richieste, 3) if richieste else 0.0
+        return stat
+
+
+cache_riferimento = CacheRiferimento(CACHE_RIFERIMENTO_MAX, CACHE_RIFERIMENTO_TTL)
+
+
+def _leggi_tutti(query):
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cur.execute(query)
+        return cur.fetchall()
+    finally:
+        conn.close()
+
+
+def catalogo_modelli():
+    """Tutti i modelli (globali), ordinati per marca, modello, versione."""
+    return cache_riferimento.ottieni(
+        "modelli", lambda: _leggi_tutti("SELECT * FROM modelli ORDER BY marca, modello, versione")
+    )
+
+
+def marche_modelli():
+    """Marche presenti nel catalogo modelli."""
+    return cache_riferimento.ottieni(
+        "marche_modelli", lambda: sorted({m['marca'] for m in catalogo_modelli()})
+    )
+
+
+def catalogo_modelli_json():
+    """Catalogo modelli già serializzato per le pagine che lo incorporano."""
+    return cache_riferimento.ottieni("modelli_json", lambda: json.dumps(catalogo_modelli()))
+
+
+def invalida_modelli():
+    cache_riferimento.invalida("modelli", "marche_modelli", "modelli_json")
+
+
+# =====================================
+# GRUPPI DI RICAMBI EQUIVALENTI
+# =====================================
+# L'equivalenza tra ricambi è transitiva: se A sostituisce B e B sostituisce
+# C, i tre codici sono intercambiabili. Ogni codice ha quindi un id di gruppo
+# (tabella ricambi_gruppi, un codice senza riga non ha equivalenti). Collegare
+# due codici unisce i loro gruppi (union-find, il gruppo più piccolo confluisce
+# nel più grande); scollegarne uno lo toglie dal gruppo senza toccare gli altri.
+# Un nuovo gruppo prende come id MAX(gruppo) + 1, letto sotto il lock dei
+# gruppi: un id ancora in uso non viene mai riassegnato (l'id del ricambio
+# da cui un gruppo è nato no, quel ricambio può averlo lasciato).
+# Le letture passano da una mappa in cache codice → tutti i codici del gruppo.
+_BLOCCO_IN = 500
+
+
+class UnioneTrova:
+    """Union-find con compressione dei cammini e unione per dimensione."""
+
+    def __init__(self):
+        self._padre = {}
+        self._dimensione = {}
+
+    def trova(self, x):
+        self._padre.setdefault(x, x)
+        self._dimensione.setdefault(x, 1)
+        radice = x
+        while self._padre[radice] != radice:
+            radice = self._padre[radice]
+        while self._padre[x] != radice:
+            self._padre[x], x = radice, self._padre[x]
+        return radice
+
+    def unisci(self, a, b):
+        ra, rb = self.trova(a), self.trova(b)
+        if ra == rb:
+            return
+        if self._dimensione[ra] < self._dimensione[rb]:
+            ra, rb = rb, ra
+        self._padre[rb] = ra
+        self._dimensione[ra] += self._dimensione[rb]
+
+    def componenti(self):
+        gruppi = {}
+        for x in self._padre:
+            gruppi.setdefault(self.trova(x), []).append(x)
+        return list(gruppi.values())
+
+
+def gruppi_equivalenti():
+    """Mappa codice → tupla ordinata di tutti i codici del suo gruppo (condivisa tra i membri)."""
+    def carica():
+        mappa, membri, gruppo_corrente = {}, [], None
+        for row in _leggi_tutti("SELECT codice, gruppo FROM ricambi_gruppi ORDER BY gruppo, codice"):
+            if row['gruppo'] != gruppo_corrente:
+                membri, gruppo_corrente = [], row['gruppo']
+            membri.append(row['codice'])
+            mappa[row['codice']] = membri
+        return {codice: tuple(m) for codice, m in mappa.items()}
+    return cache_riferimento.ottieni("equivalenti", carica)
+
+
+def equivalenti(codice):
+    """Codici intercambiabili con `codice` (escluso il codice stesso)."""
+    return tuple(c for c in gruppi_equivalenti().get(codice, ()) if c != codice)
+
+
+def invalida_equivalenti():
+    cache_riferimento.invalida("equivalenti")
+
+
+def _blocca_gruppi(cur):
+    # le modifiche ai gruppi leggono e poi scrivono: su Postgres si serializzano
+    # (le letture non vengono bloccate); SQLite ha già un solo scrittore alla volta
+    if DB_BACKEND == "postgres":
+        cur.execute("LOCK TABLE ricambi_gruppi IN SHARE ROW EXCLUSIVE MODE")
+
+
+def _in_blocchi(cur, query, valori):
+    """Esegue `query` (con {segnaposti}) per blocchi di valori e restituisce tutte le righe."""
+    valori, righe = list(valori), []
+    for i in range(0, len(valori), _BLOCCO_IN):
+        blocco = valori[i:i + _BLOCCO_IN]
+        cur.execute(query.format(segnaposti=", ".join(["%s"] * len(blocco))), blocco)
+        righe.extend(cur.fetchall())
+    return righe
+
+
+def collega_equivalenti(conn, coppie):
+    """
+    Rende equivalenti i codici di ogni coppia (a, b) unendo i loro gruppi.
+    L'union-find gira in memoria sui soli codici coinvolti; poi una UPDATE
+    per ogni gruppo assorbito e gli INSERT dei codici ancora senza gruppo.
+    Non fa commit. Solleva ValueError se un nuovo gruppo non ha ricambi in archivio.
+    """
+    coppie = [(a, b) for a, b in coppie if a and b and a != b]
+    if not coppie:
+        return 0
+    cur = conn.cursor()
+    _blocca_gruppi(cur)
+
+    codici = {c for coppia in coppie for c in coppia}
+    esistenti = dict(_in_blocchi(
+        cur, "SELECT codice, gruppo FROM ricambi_gruppi WHERE codice IN ({segnaposti})", codici
+    ))
+    dimensioni = dict(_in_blocchi(
+        cur, "SELECT gruppo, COUNT(*) FROM ricambi_gruppi WHERE gruppo IN ({segnaposti}) GROUP BY gruppo",
+        set(esistenti.values())
+    ))
+
+    # i gruppi già esistenti entrano nell'union-find come nodi ("gruppo", id)
+    uf = UnioneTrova()
+    prossimo_gruppo = None
+    for codice, gruppo in esistenti.items():
+        uf.unisci(codice, ("gruppo", gruppo))
+    for a, b in coppie:
+        uf.unisci(a, b)
+
+    for componente in uf.componenti():
+        membri = [m for m in componente if isinstance(m, str)]
+        gruppi = [m[1] for m in componente if isinstance(m, tuple)]
+        if gruppi:
+            destinazione = max(gruppi, key=lambda g: (dimensioni.get(g, 0), -g))
+        else:
+            cur.execute(
+                f"SELECT 1 FROM ricambi WHERE codice IN ({', '.join(['%s'] * len(membri))}) LIMIT 1", membri
+            )
+            if cur.fetchone() is None:
+                raise ValueError(f"Nessun ricambio in archivio tra {', '.join(sorted(membri))}")
+            if prossimo_gruppo is None:
+                cur.execute("SELECT COALESCE(MAX(gruppo), 0) + 1 FROM ricambi_gruppi")
+                prossimo_gruppo = cur.fetchone()[0]
+            destinazione = prossimo_gruppo
+            prossimo_gruppo += 1
+
+        assorbiti = [g for g in gruppi if g != destinazione]
+        if assorbiti:
+            cur.execute(
+                f"UPDATE ricambi_gruppi SET gruppo = %s WHERE gruppo IN ({', '.join(['%s'] * len(assorbiti))})",
+                [destinazione] + assorbiti
+            )
+        nuovi = [(c, destinazione) for c in membri if c not in esistenti]
+        if nuovi:
+            cur.executemany("INSERT INTO ricambi_gruppi (codice, gruppo) VALUES (%s, %s)", nuovi)
+    return len(coppie)
+
+
+def scollega_equivalente(conn, codice):
+    """Toglie `codice` dal suo gruppo; un gruppo rimasto con un solo codice viene sciolto. Non fa commit."""
+    cur = conn.cursor()
+    _blocca_gruppi(cur)
+    cur.execute("SELECT gruppo FROM ricambi_gruppi WHERE codice = %s", (codice,))
+    row = cur.fetchone()
+    if not row:
+        return
+    cur.execute("DELETE FROM ricambi_gruppi WHERE codice = %s", (codice,))
+    cur.execute("""
+        DELETE FROM ricambi_gruppi
+        WHERE gruppo = %s AND (SELECT COUNT(*) FROM ricambi_gruppi WHERE gruppo = %s) = 1
+    """, (row[0], row[0]))
+
+
+def rinomina_equivalente(conn, vecchio, nuovo):
+    """Il codice di un ricambio è cambiato: il nuovo codice resta nel gruppo del vecchio. Non fa commit."""
+    if not vecchio or vecchio == nuovo:
+        return
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM ricambi_gruppi WHERE codice = %s", (nuovo,))
+    if cur.fetchone():
+        # il nuovo codice ha già un suo gruppo: vale quello
+        scollega_equivalente(conn, vecchio)
+    else:
+        _blocca_gruppi(cur)
+        cur.execute("UPDATE ricambi_gruppi SET codice = %s WHERE codice = %s", (nuovo, vecchio))
+
+
+def equivalenti_disponibili(conn, codici):
+    """
+    Per ogni codice indicato, il primo equivalente con giacenza > 0
+    (quello con più pezzi). Restituisce codice → {codice, nome, quantita}.
+    """
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    righe = _in_blocchi(cur, """
+        SELECT g1.codice AS richiesto, r.codice, r.nome, r.quantita
+        FROM ricambi_gruppi g1
+        JOIN ricambi_gruppi g2 ON g2.gruppo = g1.gruppo AND g2.codice <> g1.codice
+        JOIN ricambi r ON r.codice = g2.codice
+        WHERE g1.codice IN ({segnaposti}) AND r.quantita > 0
+        ORDER BY g1.codice, r.quantita DESC, r.codice
+    """, codici)
+    disponibili = {}
+    for row in righe:
+        row = dict(row)
+        disponibili.setdefault(row.pop("richiesto"), row)
+    return disponibili
+
+# =====================================
+# RISPOSTE CONDIZIONALI (ETag / 304)
+# =====================================
+# I widget interrogano periodicamente alcune liste JSON. Ogni tabella ha un
+# contatore in versioni_tabelle, incrementato da un trigger a ogni modifica:
+# se il contatore non è cambiato il client riceve 304 senza rieseguire la
+# query né serializzare la lista.
+def versioni_tabelle(*tabelle):
+    """Contatori di modifica delle tabelle indicate (None se non disponibili)."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        segnaposti = ", ".join(["%s"] * len(tabelle))
+        cur.execute(
+            f"SELECT tabella, versione FROM versioni_tabelle WHERE tabella IN ({segnaposti})",
+            tabelle
+        )
+        versioni = dict(cur.fetchall())
+    except Exception:
+        conn.rollback()
+        app.logger.warning("Contatori versioni_tabelle non disponibili: eseguire 'flask --app app migra'.")
+        return None
+    return tuple(versioni.get(t, 0) for t in tabelle)
+
+
+def risposta_condizionale(tabelle, genera):
+    """
+    Restituisce 304 Not Modified se l'ETag inviato dal client (If-None-Match)
+    corrisponde alla versione corrente delle tabelle, altrimenti chiama
+    genera() e allega l'ETag alla risposta. L'ETag include utente e ruolo
+    perché il contenuto delle liste dipende da chi le chiede.
+    """
+    versioni = versioni_tabelle(*tabelle)
+    if versioni is None:
+        return genera()
+
+    chiave = f"{request.full_path}|{session.get('user_id')}|{session.get('ruolo')}|{versioni}"
+    etag = hashlib.sha1(chiave.encode()).hexdigest()
+    if etag in request.if_none_match:
+        risposta = app.response_class(status=304)
+    else:
+        risposta = make_response(genera())
+        if risposta.status_code != 200:
+            return risposta
+    risposta.set_etag(etag)
+    # il browser rivalida sempre, ma può riusare il corpo ricevuto con il 304
+    risposta.headers["Cache-Control"] = "private, no-cache"
+    return risposta
+
+# =====================================
+# LETTURA A BLOCCHI ED ESPORTAZIONE CSV
+# =====================================
+# Le tabelle grandi non vengono caricate per intero: su Postgres un cursore
+# con nome (lato server) restituisce le righe a blocchi con FETCH, su SQLite
+# il cursore è già incrementale. Le esportazioni CSV e le pagine con elenchi
+# lunghi (stream_template) sono generatori che inviano un blocco alla volta:
+# il primo byte parte subito e la memoria del worker non cresce con la tabella.
+LETTURA_BLOCCO = int(os.environ.get("LETTURA_BLOCCO", "500"))
+
+
+def righe_a_blocchi(query, parametri=None, blocco=LETTURA_BLOCCO):
+    """
+    Generatore di righe (dict) lette con un cursore lato server, `blocco` alla volta.
+    Usa una connessione propria presa dal pool: mentre il generatore è a metà,
+    la connessione della richiesta serve ancora agli helper (cache, permessi)
+    e un loro rollback distruggerebbe il cursore con nome su Postgres,
+    troncando in silenzio una risposta già partita.
+    """
+    conn = ConnessionePrestata(_pool_db(), per_richiesta=False)
+    cur = conn.cursor(name=f"blocchi_{uuid.uuid4().hex}", cursor_factory=RealDictCursor)
+    try:
+        cur.execute(query, parametri or None)
+        while True:
+            righe = cur.fetchmany(blocco)
+            if not righe:
+                break
+            yield from righe
+    finally:
+        cur.close()
+        conn.close()
+
+
+def valori_distinti(cur, tabella, colonna):
+    """Valori distinti e non vuoti di una colonna, ordinati (opzioni dei filtri delle pagine)."""
+    cur.execute(f"""
+        SELECT DISTINCT {colonna} AS valore FROM {tabella}
+        WHERE {colonna} IS NOT NULL
+        ORDER BY valore
+    """)
+    return [r['valore'] for r in cur.fetchall()]
+
+
+def _valore_csv(valore):
+    if valore is None:
+        return ""
+    if isinstance(valore, bool):
+        return "sì" if valore else "no"
+    if isinstance(valore, datetime):
+        return valore.strftime("%d/%m/%Y %H:%M")
+    if hasattr(valore, "strftime"):
+        return valore.strftime("%d/%m/%Y")
+    if isinstance(valore, (float, Decimal)):
+        # Excel in italiano usa la virgola come separatore decimale
+        return str(valore).replace(".", ",")
+    return valore
+
+
+def risposta_csv(nome_file, colonne, righe):
+    """
+    Risposta in streaming di un file CSV con separatore ";" (come lo apre
+    Excel in italiano). `colonne` è una lista di (intestazione, chiave);
+    `righe` un iterabile di dict, di solito righe_a_blocchi().
+    """
+    def genera():
+        buffer = io.StringIO()
+        scrittore = csv.writer(buffer, delimiter=";")
+        buffer.write("\ufeff")   # BOM: Excel riconosce l'UTF-8
+        scrittore.writerow([titolo for titolo, _ in colonne])
+        for n, riga in enumerate(righe, start=1):
+            scrittore.writerow([_valore_csv(riga.get(chiave)) for _, chiave in colonne])
+            if n % LETTURA_BLOCCO == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    nome = f"{nome_file}_{now_ita():%Y%m%d_%H%M}.csv"
+    return Response(
+        stream_with_context(genera()),
+        mimetype="text/csv",
+        headers={
+            "Content-Disposition": f'attachment; filename="{nome}"',
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no",
+        }
+    )
+
 # =====================================
 # UTILITY
 # =====================================
 import bcrypt  # aggiungi in cima al file, vicino agli altri import
+import click
 
 def hash_password(password: str) -> str:
     """Genera un hash sicuro con bcrypt"""
@@ -176,6 +2463,50 @@ def check_password(password: str, hashed: str) -> bool:
     """Verifica se la password inserita corrisponde all'hash salvato"""
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+def normalizza_codice(codice) -> str:
+    """Codice ricambio canonico: maiuscolo, senza spazi, trattini o barre ("MANN W 712/75" → "MANNW71275")."""
+    return re.sub(r"[^A-Z0-9]", "", (codice or "").upper())
+
+def escape_like(testo) -> str:
+    """Testo con %, _ e \\ presi alla lettera in un pattern LIKE/ILIKE (da usare con ESCAPE '\\')."""
+    return re.sub(r"([\\%_])", r"\\\1", testo)
+
+def pattern_contiene(testo) -> str:
+    """Pattern LIKE/ILIKE "contiene testo" (da usare con ESCAPE '\\')."""
+    return f"%{escape_like(testo)}%"
+
+def pattern_inizia(testo) -> str:
+    """Pattern LIKE/ILIKE "inizia con testo" (da usare con ESCAPE '\\')."""
+    return f"{escape_like(testo)}%"
+
+def normalizza_targa(targa) -> str:
+    """Targa canonica: maiuscolo, senza spazi né trattini ("ab 123-cd" → "AB123CD")."""
+    return re.sub(r"[^A-Z0-9]", "", (targa or "").upper())
+
+def stagione_deposito(giorno):
+    """
+    Stagione in cui un treno è stato lasciato in deposito: da marzo ad agosto
+    'primavera' (sono le invernali), altrimenti 'autunno' (le estive).
+    Accetta anche la data in testo, come arriva dalle funzioni SQLite.
+    """
+    if not giorno:
+        return None
+    if isinstance(giorno, str):
+        giorno = date.fromisoformat(giorno[:10])
+    return "primavera" if 3 <= giorno.month <= 8 else "autunno"
+
+def applica_prefisso(codice, prefisso) -> str:
+    """Antepone il prefisso fornitore al codice, se non è già presente ("MANN" + "W712" → "MANN W712")."""
+    codice = (codice or "").strip()
+    prefisso = (prefisso or "").strip().upper()
+    if prefisso and not codice.upper().startswith(prefisso):
+        codice = f"{prefisso} {codice}"
+    return codice
+
+def inizio_giorno(giorno) -> datetime:
+    """Mezzanotte (ora italiana) del giorno indicato, confrontabile con le colonne data_ora."""
+    return pytz.timezone("Europe/Rome").localize(datetime(giorno.year, giorno.month, giorno.day))
+
 def status_to_color(stato: str) -> str:
     if not stato:
         return '#f8f9fa'
@@ -271,48 +2602,329 @@ def lavorazioni_officina(user_id):
         out.append(lav)
     return out
 
+# =====================================
+# SCRITTURA ASINCRONA STORICO AZIONI
+# =====================================
+# Gli eventi di storico vengono accodati in memoria e scritti da un thread
+# in background con INSERT multi-riga: le route non aspettano il database.
+STORICO_BATCH = int(os.environ.get("STORICO_BATCH", 100))
+STORICO_INTERVALLO = float(os.environ.get("STORICO_INTERVALLO", 1.0))
+STORICO_CODA_MAX = int(os.environ.get("STORICO_CODA_MAX", 5000))
+# Attesa massima (secondi) quando la coda è piena, poi l'evento viene scartato
+STORICO_ATTESA_MAX = float(os.environ.get("STORICO_ATTESA_MAX", 0.05))
+STORICO_TENTATIVI = 3
+
+_COLONNE_STORICO = ("id_utente", "utente", "azione", "dettagli", "tabella_nome", "record_id", "data_ora")
+
+
+class CodaStorico:
+    """Coda limitata di eventi per storico_azioni, svuotata da un thread in background."""
+
+    def __init__(self, batch, intervallo, dimensione_max, attesa_max):
+        self._coda = queue.Queue(maxsize=dimensione_max)
+        self._batch = batch
+        self._intervallo = intervallo
+        self._attesa_max = attesa_max
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._stat = {"accodati": 0, "scritti": 0, "scartati": 0, "batch": 0, "errori": 0}
+
+    def _avvia(self):
+        # il thread parte al primo evento (dopo il fork dei worker gunicorn)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._ciclo, name="coda-storico", daemon=True)
+                self._thread.start()
+
+    def accoda(self, evento):
+        if self._thread is None or not self._thread.is_alive():
+            self._avvia()
+        try:
+            self._coda.put(evento, timeout=self._attesa_max)
+        except queue.Full:
+            with self._lock:
+                self._stat["scartati"] += 1
+            app.logger.warning("Coda storico piena: evento scartato (%s).", evento[2])
+            return False
+        with self._lock:
+            self._stat["accodati"] += 1
+        return True
+
+    def _preleva(self, attesa):
+        eventi = []
+        scadenza = time.monotonic() + attesa
+        while len(eventi) < self._batch:
+            restante = scadenza - time.monotonic()
+            try:
+                if restante > 0:
+                    eventi.append(self._coda.get(timeout=restante))
+                else:
+                    eventi.append(self._coda.get_nowait())
+            except queue.Empty:
+                break
+        return eventi
+
+    def _scrivi(self, eventi):
+        segnaposti = ", ".join(["(" + ", ".join(["%s"] * len(_COLONNE_STORICO)) + ")"] * len(eventi))
+        params = [valore for evento in eventi for valore in evento]
+        for tentativo in range(1, STORICO_TENTATIVI + 1):
+            conn = None
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                cur.execute(
+                    f"INSERT INTO storico_azioni ({', '.join(_COLONNE_STORICO)}) VALUES {segnaposti}",
+                    params
+                )
+                conn.commit()
+                with self._lock:
+                    self._stat["scritti"] += len(eventi)
+                    self._stat["batch"] += 1
+                return
+            except Exception:
+                with self._lock:
+                    self._stat["errori"] += 1
+                app.logger.exception("Impossibile registrare lo storico (tentativo %s).", tentativo)
+                if tentativo < STORICO_TENTATIVI and not self._stop.is_set():
+                    time.sleep(0.5 * 2 ** tentativo)
+            finally:
+                if conn is not None:
+                    conn.close()
+        with self._lock:
+            self._stat["scartati"] += len(eventi)
+
+    def _ciclo(self):
+        while not self._stop.is_set():
+            eventi = self._preleva(self._intervallo)
+            if eventi:
+                self._scrivi(eventi)
+        self.svuota()
+
+    def svuota(self):
+        """Scrive subito tutti gli eventi in coda (usato anche alla chiusura)."""
+        while True:
+            eventi = self._preleva(0)
+            if not eventi:
+                return
+            self._scrivi(eventi)
+
+    def chiudi(self, timeout=10):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+        else:
+            self.svuota()
+
+    def statistiche(self):
+        with self._lock:
+            stat = dict(self._stat)
+        stat["in_coda"] = self._coda.qsize()
+        stat["capacita"] = self._coda.maxsize
+        return stat
+
+
+coda_storico = CodaStorico(STORICO_BATCH, STORICO_INTERVALLO, STORICO_CODA_MAX, STORICO_ATTESA_MAX)
+# alla chiusura del processo gli eventi rimasti vengono scritti
+atexit.register(coda_storico.chiudi)
+
+
 def log_storico(user_id, azione: str, tabella: str | None = None, record_id: int | None = None):
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+    """Accoda un evento per storico_azioni (scritto in background da coda_storico)."""
+    coda_storico.accoda((user_id, None, azione, None, tabella, record_id, now_ita()))
 
-        cur.execute("""
-            INSERT INTO storico_azioni (id_utente, azione, tabella_nome, record_id, data_ora)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (
-            user_id,
-            azione,
-            tabella,      # <- ora il nome è corretto
-            record_id,
-            now_ita()      # <- ora italiana definitiva
-        ))
+def registra_azione_username(username, azione, dettagli):
+    coda_storico.accoda((None, username, azione, dettagli, None, None, now_ita()))
 
-        conn.commit()
+# =====================================
+# EVENTI LAVORAZIONI (Server-Sent Events)
+# =====================================
+# Le dashboard ricevono un evento quando una lavorazione viene creata,
+# cambia stato, viene modificata o eliminata, e solo allora rileggono il
+# delta da ajax_lavorazioni. Su Postgres gli eventi passano da NOTIFY, così
+# arrivano a tutti i worker; in locale (SQLite) basta il broker in memoria.
+EVENTI_CANALE = "lavorazioni"
+EVENTI_BACKEND = os.environ.get("EVENTI_BACKEND") or ("notify" if DB_BACKEND == "postgres" else "locale")
+# LISTEN richiede una connessione di sessione: la porta 6543 del pooler
+# Supabase è in transaction mode, la 5432 in session mode
+EVENTI_DB_PORT = os.environ.get("EVENTI_DB_PORT", "5432")
+# Ogni quanti secondi inviare un commento di keep-alive sullo stream
+EVENTI_HEARTBEAT = int(os.environ.get("EVENTI_HEARTBEAT", "25"))
+# Eventi in attesa per singolo client prima di scartare i più recenti
+EVENTI_CODA_CLIENT = int(os.environ.get("EVENTI_CODA_CLIENT", "100"))
+# Ogni stream aperto occupa un thread del server (gunicorn.conf.py usa gthread):
+# con EVENTI_SSE=0 le dashboard tornano a interrogare ajax_lavorazioni ogni
+# EVENTI_POLLING secondi, ad esempio con worker sync o pochi thread
+EVENTI_SSE = os.environ.get("EVENTI_SSE", "1") == "1"
+EVENTI_POLLING = int(os.environ.get("EVENTI_POLLING", "30"))
+
+if EVENTI_BACKEND not in ("notify", "locale"):
+    raise RuntimeError(f"EVENTI_BACKEND non valido: {EVENTI_BACKEND!r} (usa 'notify' o 'locale')")
+
+
+class BrokerEventi:
+    """
+    Distribuisce gli eventi agli stream SSE aperti in questo processo.
+    Ogni iscritto ha una propria coda limitata: un client lento perde
+    eventi (poi recupera con il delta) invece di bloccare gli altri.
+    """
 
-    except Exception:
-        app.logger.exception("Impossibile registrare lo storico.")
-    finally:
+    def __init__(self, dimensione_coda):
+        self._dimensione_coda = dimensione_coda
+        self._iscritti = set()
+        self._lock = threading.Lock()
+        self._pubblicati = 0
+        self._scartati = 0
+
+    def iscrivi(self):
+        coda = queue.Queue(maxsize=self._dimensione_coda)
+        with self._lock:
+            self._iscritti.add(coda)
+        return coda
+
+    def disiscrivi(self, coda):
+        with self._lock:
+            self._iscritti.discard(coda)
+
+    def pubblica(self, evento):
+        with self._lock:
+            iscritti = list(self._iscritti)
+            self._pubblicati += 1
+        for coda in iscritti:
+            try:
+                coda.put_nowait(evento)
+            except queue.Full:
+                with self._lock:
+                    self._scartati += 1
+
+    def statistiche(self):
+        with self._lock:
+            return {
+                "backend": EVENTI_BACKEND,
+                "iscritti": len(self._iscritti),
+                "pubblicati": self._pubblicati,
+                "scartati": self._scartati,
+            }
+
+
+broker_eventi = BrokerEventi(EVENTI_CODA_CLIENT)
+_ascoltatore_avviato = False
+_ascoltatore_lock = threading.Lock()
+
+
+def _ascolta_notify():
+    """Thread che riceve le NOTIFY di Postgres e le passa al broker locale."""
+    import select
+    while True:
+        conn = None
         try:
-            conn.close()
+            conn = _nuova_connessione_postgres(porta=EVENTI_DB_PORT)
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {EVENTI_CANALE}")
+            app.logger.info("In ascolto delle notifiche sul canale '%s'.", EVENTI_CANALE)
+            while True:
+                if select.select([conn], [], [], EVENTI_HEARTBEAT) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notifica = conn.notifies.pop(0)
+                    try:
+                        broker_eventi.pubblica(json.loads(notifica.payload))
+                    except ValueError:
+                        app.logger.warning("Notifica non valida: %r", notifica.payload)
         except Exception:
-            pass
+            app.logger.exception("Ascolto notifiche interrotto, nuovo tentativo tra 5 secondi.")
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
 
-def registra_azione_username(username, azione, dettagli):
+
+def _avvia_ascoltatore():
+    global _ascoltatore_avviato
+    if EVENTI_BACKEND != "notify" or _ascoltatore_avviato:
+        return
+    with _ascoltatore_lock:
+        if not _ascoltatore_avviato:
+            threading.Thread(target=_ascolta_notify, name="ascolto-notify", daemon=True).start()
+            _ascoltatore_avviato = True
+
+
+def notifica_lavorazione(evento, id_lavorazione):
+    """
+    Pubblica un evento ('creata', 'stato', 'modificata', 'eliminata') per la
+    lavorazione indicata. Da chiamare dopo il commit; un errore qui non deve
+    mai far fallire la richiesta che ha già salvato i dati.
+    """
     try:
         conn = get_db_connection()
         cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO storico_azioni (utente, azione, dettagli, data_ora)
-            VALUES (%s, %s, %s, %s)
-        """, (username, azione, dettagli, now_ita()))
-        conn.commit()
+        cur.execute("SELECT id_officina, stato FROM lavorazioni WHERE id = %s", (id_lavorazione,))
+        riga = cur.fetchone()
+        payload = {
+            "evento": evento,
+            "id": id_lavorazione,
+            "id_officina": riga[0] if riga else None,
+            "stato": (riga[1] if riga else None) or "",
+        }
+        if EVENTI_BACKEND == "notify":
+            cur.execute("SELECT pg_notify(%s, %s)", (EVENTI_CANALE, json.dumps(payload)))
+            conn.commit()
+        else:
+            conn.rollback()
+            broker_eventi.pubblica(payload)
+        conn.close()
     except Exception:
-        app.logger.exception("Impossibile registrare azione con username.")
-    finally:
+        app.logger.exception(f"Impossibile notificare l'evento '{evento}' per la lavorazione {id_lavorazione}.")
+
+
+def _evento_visibile(evento, ruolo, user_id):
+    # l'officina vede solo le proprie lavorazioni, l'accettazione tutte
+    if ruolo == 'officina':
+        return evento.get("id_officina") == user_id
+    return ruolo == 'accettazione'
+
+
+@app.route('/eventi/lavorazioni')
+@login_required
+def eventi_lavorazioni():
+    """
+    Stream SSE degli eventi sulle lavorazioni visibili all'utente.
+    Il client reagisce rileggendo ajax_lavorazioni?since=<cursore>.
+    """
+    if not EVENTI_SSE:
+        abort(404)
+    ruolo = session.get('ruolo')
+    user_id = session.get('user_id')
+    if ruolo not in ('officina', 'accettazione'):
+        return jsonify({"error": "Ruolo non autorizzato"}), 403
+
+    _avvia_ascoltatore()
+    coda = broker_eventi.iscrivi()
+
+    def genera():
         try:
-            conn.close()
-        except Exception:
-            pass
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    evento = coda.get(timeout=EVENTI_HEARTBEAT)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if _evento_visibile(evento, ruolo, user_id):
+                    yield f"event: lavorazione\ndata: {json.dumps(evento)}\n\n"
+        finally:
+            broker_eventi.disiscrivi(coda)
+
+    risposta = Response(stream_with_context(genera()), mimetype="text/event-stream")
+    risposta.headers["Cache-Control"] = "no-cache"
+    # evita che proxy come nginx accumulino lo stream
+    risposta.headers["X-Accel-Buffering"] = "no"
+    return risposta
 
 # =====================================
 # ROUTE: scelta login e login/logout
@@ -412,7 +3024,7 @@ def home():
     if session.get('ruolo') != 'accettazione':
         flash("Accesso negato: non sei Accettazione")
         return redirect(url_for('scelta_login'))
-    nome_reale = get_nome_reale(session['user_id'])
+    nome_reale = nome_utente_corrente()
     lavorazioni = fetch_lavorazioni(None)
     return render_template('home.html', nome_reale=nome_reale, ruolo='accettazione', lavorazioni=lavorazioni)
 
@@ -424,7 +3036,7 @@ def home_officina():
         flash("Accesso negato: non sei Officina", "danger")
         return redirect(url_for('scelta_login'))
 
-    nome_reale = get_nome_reale(session['user_id'])
+    nome_reale = nome_utente_corrente()
     
     # Recupera lavorazioni: se None, usa lista vuota
     lavorazioni = lavorazioni_officina_query(session['user_id']) or []
@@ -464,30 +3076,35 @@ def home_officina():
 # =====================================
 # CLIENTI
 # =====================================
+def _query_clienti():
+    """Query (sql, parametri) dei clienti visibili all'utente loggato."""
+    # Se l'utente loggato è accettazione, mostra tutti i clienti degli utenti accettazione
+    if session.get('ruolo') == 'accettazione':
+        return """
+            SELECT c.*
+            FROM clienti c
+            JOIN utenti u ON c.utente_id = u.id
+            WHERE u.ruolo = 'accettazione'
+            ORDER BY c.id
+        """, None
+    # Per altri ruoli, mostra solo i clienti propri
+    return "SELECT * FROM clienti WHERE utente_id=%s ORDER BY id", (session['user_id'],)
+
 @app.route('/clienti')
 @login_required
 def lista_clienti():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        # Se l'utente loggato è accettazione, mostra tutti i clienti degli utenti accettazione
-        if session.get('ruolo') == 'accettazione':
-            cur.execute("""
-                SELECT c.*
-                FROM clienti c
-                JOIN utenti u ON c.utente_id = u.id
-                WHERE u.ruolo = 'accettazione'
-                ORDER BY c.id
-            """)
-        else:
-            # Per altri ruoli, mostra solo i clienti propri
-            cur.execute("SELECT * FROM clienti WHERE utente_id=%s ORDER BY id", (session['user_id'],))
-        
-        clienti = cur.fetchall()
-    finally:
-        conn.close()
-    
-    return render_template('clienti.html', clienti=clienti)
+    return stream_template('clienti.html', clienti=righe_a_blocchi(*_query_clienti()))
+
+COLONNE_CSV_CLIENTI = [
+    ("ID", "id"), ("Nome", "nome"), ("Cognome", "cognome"), ("Via", "via"),
+    ("Comune", "comune"), ("Provincia", "provincia"), ("Codice fiscale", "codice_fiscale"),
+    ("Cellulare", "cellulare"), ("Telefono alternativo", "telefono_alt"), ("Email", "email"),
+]
+
+@app.route('/clienti/esporta')
+@login_required
+def esporta_clienti():
+    return risposta_csv("clienti", COLONNE_CSV_CLIENTI, righe_a_blocchi(*_query_clienti()))
 
 @app.route('/inserisci_cliente', methods=['GET'])
 @login_required
@@ -639,6 +3256,25 @@ def lista_vetture():
         conn.close()
     return render_template('vetture.html', vetture=vetture)
 
+COLONNE_CSV_VETTURE = [
+    ("ID", "id"), ("Targa", "targa"), ("Marca", "marca"), ("Modello", "modello"),
+    ("Cilindrata", "cilindrata"), ("kW", "kw"), ("Carburante", "carburante"),
+    ("Codice motore", "codice_motore"), ("Telaio", "telaio"), ("Immatricolazione", "immatricolazione"),
+    ("Km", "km"), ("Cambio", "cambio"), ("Cliente", "cliente"),
+]
+
+@app.route('/vetture/esporta')
+@login_required
+def esporta_vetture():
+    query = """
+        SELECT v.*, TRIM(COALESCE(c.nome, '') || ' ' || COALESCE(c.cognome, '')) AS cliente
+        FROM vetture v
+        LEFT JOIN clienti c ON c.id = v.cliente_id
+        WHERE v.utente_id = %s
+        ORDER BY v.id
+    """
+    return risposta_csv("vetture", COLONNE_CSV_VETTURE, righe_a_blocchi(query, (session['user_id'],)))
+
 @app.route('/inserisci_vettura', methods=['GET'])
 @login_required
 def inserisci_vettura():
@@ -664,16 +3300,11 @@ def inserisci_vettura():
             (session['user_id'],)
         )
         clienti = cur.fetchall()
-
-        # Modelli: GLOBALI
-        cur.execute(
-            "SELECT * FROM modelli ORDER BY marca, modello, versione"
-        )
-        modelli_raw = cur.fetchall()
     finally:
         conn.close()
 
-    modelli_json = json.dumps(modelli_raw)
+    # Modelli: GLOBALI (dalla cache, già serializzati)
+    modelli_json = catalogo_modelli_json()
 
     return render_template(
         'inserisci_vettura.html',
@@ -709,24 +3340,124 @@ def salva_vettura():
     except Exception:
         pass
     return redirect('/vetture')
+
+# =====================================
+# SCHEDA TARGA
+# =====================================
+# Una targa compare in vetture, lavorazioni, gomme_clienti e ordini_magazzino,
+# scritta a mano in formati diversi: ogni tabella ha la colonna targa_norm
+# (normalizza_targa) indicizzata, e le ricerche passano sempre da quella.
+
+# Lavorazioni completate restituite dalla scheda (le più recenti)
+SCHEDA_TARGA_CHIUSE = 20
+
+def vettura_per_targa(cur, targa, utente_id):
+    """
+    Vettura più recente con quella targa tra quelle dell'utente, con i dati
+    del cliente (cliente_nome, cliente_cognome, cellulare, email); None se
+    sconosciuta. Vuole un cursore RealDictCursor.
+    """
+    targa = normalizza_targa(targa)
+    if not targa:
+        return None
+    cur.execute("""
+        SELECT v.id, v.cliente_id, v.targa, v.marca, v.modello, v.cilindrata, v.kw, v.carburante,
+               v.immatricolazione, v.km,
+               c.nome AS cliente_nome, c.cognome AS cliente_cognome, c.cellulare, c.email
+        FROM vetture v
+        LEFT JOIN clienti c ON c.id = v.cliente_id
+        WHERE v.targa_norm = %s AND v.utente_id = %s
+        ORDER BY v.id DESC
+        LIMIT 1
+    """, (targa, utente_id))
+    return cur.fetchone()
+
+def _json_righe(righe):
+    # date e timestamp in ISO, il resto così com'è
+    return [
+        {k: (v.isoformat() if isinstance(v, (date, datetime)) else v) for k, v in r.items()}
+        for r in righe
+    ]
+
+@app.route('/targa')
+@login_required
+def scheda_targa():
+    """
+    Tutto ciò che sappiamo di una targa (?targa=, in qualsiasi formato):
+    vettura e cliente, lavorazioni aperte e ultime completate, gomme in
+    deposito e ordini ricambi in corso, con una sola richiesta.
+    """
+    targa = normalizza_targa(request.args.get('targa'))
+    if not targa:
+        return jsonify({"error": "Targa mancante"}), 400
+    user_id = session['user_id']
+
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        vettura = vettura_per_targa(cur, targa, user_id)
+
+        # lavorazioni con la targa scritta sopra o collegate a una vettura dell'utente;
+        # l'officina vede solo le proprie, come nel widget lavorazioni
+        filtro_officina, parametri = "", [targa, targa, user_id]
+        if session.get('ruolo') == 'officina':
+            filtro_officina = "AND l.id_officina = %s"
+            parametri.append(user_id)
+        cur.execute(f"""
+            SELECT l.id, l.tipo, l.stato, l.marca, l.modello, l.cliente_nome, l.ordine_riparazione,
+                   l.descrizione, l.data_creazione, l.data_aggiornamento
+            FROM lavorazioni l
+            WHERE l.eliminata = FALSE
+              AND (l.targa_norm = %s
+                   OR l.vettura_id IN (SELECT id FROM vetture WHERE targa_norm = %s AND utente_id = %s))
+              {filtro_officina}
+            ORDER BY l.data_creazione DESC, l.id DESC
+        """, parametri)
+        aperte, chiuse = [], []
+        for l in cur.fetchall():
+            if (l['stato'] or '').lower() != 'completata':
+                aperte.append(l)
+            elif len(chiuse) < SCHEDA_TARGA_CHIUSE:
+                chiuse.append(l)
+
+        cur.execute("""
+            SELECT id, nome, cognome, data_inizio, marca, larghezza, rapporto, diametro, note
+            FROM gomme_clienti
+            WHERE targa_norm = %s
+            ORDER BY data_inizio DESC, id DESC
+        """, (targa,))
+        gomme = cur.fetchall()
+
+        # gli ordini restano in tabella finché non vengono eliminati a consegna avvenuta
+        cur.execute("""
+            SELECT id, prodotto, codice, cliente, fornitore, stato, data_creazione
+            FROM ordini_magazzino
+            WHERE targa_norm = %s
+            ORDER BY data_creazione DESC, id DESC
+        """, (targa,))
+        ordini = cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
+
+    return jsonify({
+        "targa": targa,
+        "vettura": _json_righe([vettura])[0] if vettura else None,
+        "lavorazioni_aperte": _json_righe(aperte),
+        "lavorazioni_chiuse": _json_righe(chiuse),
+        "gomme_deposito": _json_righe(gomme),
+        "ordini": _json_righe(ordini),
+    })
+
 # =====================================
 # MODELLI
 # =====================================
 @app.route('/modelli')
 @login_required
 def lista_modelli():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        # Marche GLOBALI (visibili a tutti)
-        cur.execute("SELECT DISTINCT marca FROM modelli ORDER BY marca")
-        marche = [row['marca'] for row in cur.fetchall()]
-
-        # Tutti i modelli GLOBALI
-        cur.execute("SELECT * FROM modelli ORDER BY marca, modello, versione")
-        modelli_raw = cur.fetchall()
-    finally:
-        conn.close()
+    # Marche e modelli GLOBALI (visibili a tutti), dalla cache
+    marche = marche_modelli()
+    modelli_raw = catalogo_modelli()
 
     # Rimuove eventuali duplicati logici
     seen = set()
@@ -746,11 +3477,7 @@ def inserisci_modello():
     if permesso:
         return permesso
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT DISTINCT marca FROM modelli ORDER BY marca")
-    marche_db = [row[0] for row in cur.fetchall()]
-    conn.close()
+    marche_db = marche_modelli()
 
     marche_totali = [
         "ALFA ROMEO","AUDI","BMW","CHEVROLET","CHRYSLER","CITROEN","CUPRA","DACIA",
@@ -794,6 +3521,7 @@ def salva_modello():
     new_id = cur.fetchone()[0]
     conn.commit()
     conn.close()
+    invalida_modelli()
 
     log_storico(session['user_id'], f"Inserito modello {new_id}", "modelli", new_id)
     return redirect('/modelli')
@@ -846,6 +3574,7 @@ def aggiorna_modello(id):
     """, data)
     conn.commit()
     conn.close()
+    invalida_modelli()
 
     log_storico(session['user_id'], f"Aggiornato modello {id}", "modelli", id)
     return redirect('/modelli')
@@ -862,10 +3591,223 @@ def elimina_modello(id):
     cur.execute("DELETE FROM modelli WHERE id=%s", (id,))
     conn.commit()
     conn.close()
+    invalida_modelli()
 
     log_storico(session['user_id'], f"Eliminato modello {id}", "modelli", id)
     return redirect('/modelli')
 
+# =====================================
+# MOVIMENTI DI MAGAZZINO RICAMBI
+# =====================================
+# Ogni variazione di giacenza è una riga di movimenti_ricambi (mai modificata
+# né cancellata) con tipo, variazione, giacenza risultante, utente e causale.
+# Le giacenze cambiano con UPDATE relative sull'insieme dei ricambi coinvolti
+# (quantita = quantita + delta), quindi due richieste concorrenti non si
+# sovrascrivono. La giacenza a una data passata parte dall'istantanea
+# giornaliera più recente (comando istantanea-giacenze) e somma i movimenti
+# successivi.
+TIPI_MOVIMENTO = {
+    "apertura": "Apertura registro",
+    "carico": "Carico",
+    "scarico": "Scarico",
+    "rettifica": "Rettifica inventario",
+    "uso_veicolo": "Uso su veicolo",
+    "importazione": "Importazione CSV",
+}
+MOVIMENTI_PAGINA = 50
+MOVIMENTI_PAGINA_MAX = 200
+
+
+def _filtro_id(ids):
+    """Condizione `IN` sugli id (ANY con un solo parametro array su Postgres)."""
+    if DB_BACKEND == "postgres":
+        return "= ANY(%s)", [list(ids)]
+    return f"IN ({', '.join(['%s'] * len(ids))})", list(ids)
+
+
+def _registra_movimenti(cur, movimenti, tipo, utente_id, causale):
+    """movimenti: coppie (ricambio_id, delta, quantita_dopo)."""
+    cur.executemany("""
+        INSERT INTO movimenti_ricambi (ricambio_id, tipo, delta, quantita_dopo, utente_id, causale, data_ora)
+        VALUES (%s, %s, %s, %s, %s, %s, NOW())
+    """, [(rid, tipo, delta, dopo, utente_id, causale) for rid, delta, dopo in movimenti])
+
+
+def muovi_giacenze(conn, ricambi_ids, tipo, delta, utente_id=None, causale=None):
+    """
+    Aggiunge `delta` (anche negativo) alla giacenza dei ricambi indicati con
+    un'unica UPDATE ... RETURNING. I ricambi che andrebbero sotto zero restano
+    invariati e non generano movimenti. Non fa commit.
+    Restituisce {ricambio_id: nuova quantità} dei soli ricambi modificati.
+    """
+    ricambi_ids = list(dict.fromkeys(ricambi_ids))
+    if not ricambi_ids or not delta:
+        return {}
+    filtro, parametri = _filtro_id(ricambi_ids)
+    cur = conn.cursor()
+    cur.execute(f"""
+        UPDATE ricambi SET quantita = quantita + %s
+        WHERE id {filtro} AND quantita + %s >= 0
+        RETURNING id, quantita
+    """, [delta] + parametri + [delta])
+    nuove = dict(cur.fetchall())
+    _registra_movimenti(cur, [(rid, delta, q) for rid, q in nuove.items()], tipo, utente_id, causale)
+    return nuove
+
+
+def rettifica_giacenza(conn, ricambio_id, quantita, tipo="rettifica", utente_id=None, causale=None):
+    """
+    Porta la giacenza di un ricambio al valore contato. La riga resta bloccata
+    tra lettura e scrittura, così il movimento registra la differenza reale.
+    Non fa commit. Restituisce la nuova quantità (None se il ricambio non esiste).
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT quantita FROM ricambi WHERE id = %s FOR UPDATE", (ricambio_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    if row[0] != quantita:
+        cur.execute("UPDATE ricambi SET quantita = %s WHERE id = %s", (quantita, ricambio_id))
+        _registra_movimenti(cur, [(ricambio_id, quantita - row[0], quantita)], tipo, utente_id, causale)
+    return quantita
+
+
+def query_giacenze_alla_data(conn, giorno, ricambio_id=None, ricalcola=False):
+    """
+    Query (sql, parametri) della giacenza di ogni ricambio a fine giornata
+    `giorno`: istantanea più recente non successiva + movimenti dopo di essa
+    (con ricalcola=True si ignora l'istantanea del giorno stesso).
+    Sono esclusi i ricambi che a quella data non avevano ancora movimenti.
+    """
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT data FROM giacenze_istantanee
+        WHERE data {'<' if ricalcola else '<='} %s
+        ORDER BY data DESC LIMIT 1
+    """, (giorno,))
+    row = cur.fetchone()
+    cur.close()
+    base = row[0] if row else None
+    dal = inizio_giorno(base + timedelta(days=1)) if base else inizio_giorno(date(2000, 1, 1))
+    al = inizio_giorno(giorno + timedelta(days=1))
+
+    condizioni = ["(i.ricambio_id IS NOT NULL OR m.movimenti > 0)"]
+    parametri = [dal, al, base]
+    if ricambio_id is not None:
+        condizioni.append("r.id = %s")
+        parametri.append(ricambio_id)
+    return f"""
+        SELECT r.id, r.codice, r.nome,
+               COALESCE(i.quantita, 0) + COALESCE(m.delta, 0) AS quantita
+        FROM ricambi r
+        LEFT JOIN (
+            SELECT ricambio_id, SUM(delta) AS delta, COUNT(*) AS movimenti
+            FROM movimenti_ricambi
+            WHERE data_ora >= %s AND data_ora < %s
+            GROUP BY ricambio_id
+        ) m ON m.ricambio_id = r.id
+        LEFT JOIN giacenze_istantanee i ON i.ricambio_id = r.id AND i.data = %s
+        WHERE {' AND '.join(condizioni)}
+        ORDER BY r.codice, r.id
+    """, parametri
+
+
+def salva_istantanea_giacenze(conn, giorno):
+    """Scrive (o riscrive) l'istantanea di fine giornata `giorno`. Non fa commit. Restituisce le righe scritte."""
+    cur = conn.cursor()
+    query, parametri = query_giacenze_alla_data(conn, giorno, ricalcola=True)
+    cur.execute(f"""
+        INSERT INTO giacenze_istantanee (data, ricambio_id, quantita)
+        SELECT %s, g.id, g.quantita FROM ({query}) AS g
+        WHERE true
+        ON CONFLICT (data, ricambio_id) DO UPDATE SET quantita = EXCLUDED.quantita
+    """, [giorno] + parametri)
+    return cur.rowcount
+
+
+@app.route('/ricambi/<int:id>/movimenti')
+@login_required
+def movimenti_ricambio(id):
+    """
+    Movimenti di un ricambio, dal più recente, paginati per chiave (data_ora, id)
+    come lo storico (?cursore=<data_ora ISO>_<id>).
+    Con ?data=AAAA-MM-GG restituisce anche la giacenza a fine di quel giorno.
+    """
+    limite = min(max(request.args.get('limite', MOVIMENTI_PAGINA, type=int), 1), MOVIMENTI_PAGINA_MAX)
+    cursore = _cursore_storico(request.args['cursore']) if request.args.get('cursore') else None
+    giorno = request.args.get('data')
+    if giorno:
+        try:
+            giorno = date.fromisoformat(giorno)
+        except ValueError:
+            return jsonify({"error": "Data non valida"}), 400
+
+    condizioni, parametri = ["m.ricambio_id = %s"], [id]
+    if cursore:
+        # stessa chiave dell'ORDER BY, come nello storico: l'id da solo salterebbe o ripeterebbe righe
+        condizioni.append("(m.data_ora, m.id) < (%s, %s)")
+        parametri.extend(cursore)
+
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cur.execute(f"""
+            SELECT m.id, m.tipo, m.delta, m.quantita_dopo, m.causale, m.data_ora, u.username
+            FROM movimenti_ricambi m
+            LEFT JOIN utenti u ON u.id = m.utente_id
+            WHERE {' AND '.join(condizioni)}
+            ORDER BY m.data_ora DESC, m.id DESC
+            LIMIT %s
+        """, parametri + [limite + 1])
+        righe = cur.fetchall()
+
+        alla_data = None
+        if giorno:
+            cur.execute(*query_giacenze_alla_data(conn, giorno, id))
+            row = cur.fetchone()
+            alla_data = {"data": giorno.isoformat(), "quantita": row['quantita'] if row else 0}
+    finally:
+        conn.close()
+
+    altri = len(righe) > limite
+    righe = righe[:limite]
+    return jsonify({
+        "movimenti": [
+            {
+                "id": r['id'],
+                "tipo": r['tipo'],
+                "descrizione": TIPI_MOVIMENTO.get(r['tipo'], r['tipo']),
+                "delta": r['delta'],
+                "quantita_dopo": r['quantita_dopo'],
+                "causale": r['causale'],
+                "utente": r['username'],
+                "data_ora": r['data_ora'].isoformat() if r['data_ora'] else None,
+            }
+            for r in righe
+        ],
+        "cursore_successivo": f"{righe[-1]['data_ora'].isoformat()}_{righe[-1]['id']}" if altri else None,
+        "giacenza_alla_data": alla_data,
+    })
+
+
+COLONNE_CSV_GIACENZE = [("ID", "id"), ("Codice", "codice"), ("Nome", "nome"), ("Quantità", "quantita")]
+
+@app.route('/ricambi/giacenze_alla_data')
+@login_required
+def giacenze_alla_data():
+    """Esporta in CSV la giacenza di tutti i ricambi a fine della giornata ?data=AAAA-MM-GG."""
+    try:
+        giorno = date.fromisoformat(request.args.get('data', ''))
+    except ValueError:
+        abort(400, description="Parametro data mancante o non valido (AAAA-MM-GG).")
+
+    conn = get_db_connection()
+    try:
+        query, parametri = query_giacenze_alla_data(conn, giorno)
+    finally:
+        conn.close()
+    return risposta_csv(f"giacenze_{giorno.isoformat()}", COLONNE_CSV_GIACENZE, righe_a_blocchi(query, parametri))
+
 # =====================================
 # RICAMBI
 # =====================================
@@ -879,39 +3821,22 @@ def lista_ricambi():
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
     # ----------------------------
-    # COSTRUISCO QUERY PRINCIPALE
+    # QUERY PRINCIPALE (indicizzata, ordinata per rilevanza se c'è testo)
     # ----------------------------
-    query = "SELECT * FROM ricambi WHERE 1=1"
-    params = []
-
-    if prefisso:
-        query += " AND codice ILIKE %s"
-        params.append(prefisso + "%")
-
-    if ricerca:
-        query += " AND codice ILIKE %s"
-        params.append("%" + ricerca + "%")
-
-    query += " ORDER BY id"
-
-    cur.execute(query, params)
-    ricambi = cur.fetchall()
+    ricambi = cerca_ricambi(cur, ricerca, prefisso)
 
     # -------------------------------------------
-    # 🔁 CARICO RICAMBI SOSTITUENTI
+    # 🔁 RICAMBI EQUIVALENTI (gruppi dalla cache)
     # -------------------------------------------
-    cur.execute("""
-        SELECT codice, codice_sostituto
-        FROM ricambi_sostituti
-    """)
-    sostituti_raw = cur.fetchall()
-
-    # Mappa codice → codice_sostituto
-    sost_map = {row['codice']: row['codice_sostituto'] for row in sostituti_raw}
+    for r in ricambi:
+        r['equivalenti'] = equivalenti(r['codice'])
 
-    # Aggiungo info sostituto a ogni ricambio
+    # per gli esauriti, l'equivalente disponibile (una sola query per la pagina)
+    disponibili = equivalenti_disponibili(
+        conn, [r['codice'] for r in ricambi if r['quantita'] <= 0 and r['equivalenti']]
+    )
     for r in ricambi:
-        r['sost_codice'] = sost_map.get(r['codice'])
+        r['disponibile'] = disponibili.get(r['codice'])
 
     conn.close()
 
@@ -922,6 +3847,446 @@ def lista_ricambi():
         filtro_prefisso=prefisso
     )
 
+# Risultati massimi dell'autocompletamento ricambi
+RICAMBI_AUTOCOMPLETE_MAX = 20
+
+def cerca_ricambi(cur, testo, prefisso="", **opzioni):
+    """Esegue query_ricambi() e restituisce tutte le righe trovate."""
+    cur.execute(*query_ricambi(testo, prefisso, **opzioni))
+    return cur.fetchall()
+
+def query_ricambi(testo, prefisso="", limite=None, offset=0,
+                  nome_contiene=None, escludi_modello=None, escludi_id=None, ordine_vuoto="id"):
+    """
+    Query (sql, parametri) della ricerca ricambi per codice (normalizzato) e nome. L'ordine è per rilevanza:
+    codice identico, codice che inizia col testo, codice che finisce col testo
+    (il codice senza prefisso fornitore), codice che lo contiene, nome.
+    Senza testo restituisce i ricambi in ordine `ordine_vuoto`.
+    Filtri opzionali: parola nel nome (tipo di filtro), esclusione dei
+    ricambi già associati a un modello o di un ricambio specifico.
+    """
+    norm = normalizza_codice(testo)
+    condizioni, parametri = [], []
+
+    # il testo dell'utente entra nei pattern sempre con %, _ e \\ protetti
+    # (i codici normalizzati hanno solo lettere e cifre, ma valgono le stesse regole)
+    if prefisso:
+        condizioni.append("codice_norm LIKE %s ESCAPE '\\'")
+        parametri.append(pattern_inizia(normalizza_codice(prefisso)))
+    if nome_contiene:
+        condizioni.append("nome ILIKE %s ESCAPE '\\'")
+        parametri.append(pattern_contiene(nome_contiene))
+    if escludi_modello is not None:
+        condizioni.append("""NOT EXISTS (
+            SELECT 1 FROM modelli_ricambi mr WHERE mr.ricambio_id = ricambi.id AND mr.modello_id = %s
+        )""")
+        parametri.append(escludi_modello)
+    if escludi_id is not None:
+        condizioni.append("id <> %s")
+        parametri.append(escludi_id)
+
+    ordine, parametri_ordine = ordine_vuoto, []
+    if testo:
+        if norm:
+            condizioni.append("(codice_norm LIKE %s ESCAPE '\\' OR nome ILIKE %s ESCAPE '\\')")
+            parametri.extend([pattern_contiene(norm), pattern_contiene(testo)])
+            ordine = """
+                CASE
+                    WHEN codice_norm = %s THEN 0
+                    WHEN codice_norm LIKE %s ESCAPE '\\' THEN 1
+                    WHEN codice_norm LIKE %s ESCAPE '\\' THEN 2
+                    WHEN codice_norm LIKE %s ESCAPE '\\' THEN 3
+                    WHEN nome ILIKE %s ESCAPE '\\' THEN 4
+                    ELSE 5
+                END, LENGTH(codice_norm), codice
+            """
+            parametri_ordine = [
+                norm, pattern_inizia(norm), f"%{escape_like(norm)}", pattern_contiene(norm), pattern_inizia(testo)
+            ]
+        else:
+            condizioni.append("nome ILIKE %s ESCAPE '\\'")
+            parametri.append(pattern_contiene(testo))
+            ordine = "nome, id"
+
+    where = f"WHERE {' AND '.join(condizioni)}" if condizioni else ""
+    limit = "LIMIT %s OFFSET %s" if limite else ""
+    return (
+        f"SELECT * FROM ricambi {where} ORDER BY {ordine} {limit}",
+        parametri + parametri_ordine + ([limite, offset] if limite else [])
+    )
+
+COLONNE_CSV_RICAMBI = [
+    ("ID", "id"), ("Nome", "nome"), ("Codice", "codice"), ("Quantità", "quantita"), ("Equivalenti", "equivalenti"),
+]
+
+@app.route('/ricambi/esporta')
+@login_required
+def esporta_ricambi():
+    """Esporta in CSV i ricambi con gli stessi filtri dell'elenco (prefisso, q)."""
+    prefisso = request.args.get('prefisso', '').strip().upper()
+    ricerca = request.args.get('q', '').strip()
+    def righe():
+        for r in righe_a_blocchi(*query_ricambi(ricerca, prefisso)):
+            r['equivalenti'] = ", ".join(equivalenti(r['codice']))
+            yield r
+
+    return risposta_csv("ricambi", COLONNE_CSV_RICAMBI, righe())
+
+# Tipo di filtro (associazione ai modelli) → parola cercata nel nome del ricambio
+TIPI_FILTRO = {"olio": "olio", "aria": "aria", "abitacolo": "abitacolo"}
+RICAMBI_LOOKUP_PAGINA = 20
+
+@app.route('/ricambi/lookup')
+@login_required
+def lookup_ricambi():
+    """
+    Pagine di ricambi per i selettori con ricerca (sostituto, associazione
+    ai modelli). Parametri: q, tipo_filtro (Olio/Aria/Abitacolo, anche nella
+    forma "Filtro Olio"), escludi_modello, escludi_id, offset, limite.
+    """
+    limite = min(max(request.args.get('limite', RICAMBI_LOOKUP_PAGINA, type=int), 1), RICAMBI_AUTOCOMPLETE_MAX)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    tipo = request.args.get('tipo_filtro', '').strip().lower().removeprefix('filtro').strip()
+    if tipo and tipo not in TIPI_FILTRO:
+        return jsonify({"error": "Tipo filtro non valido"}), 400
+
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        # una riga in più per sapere se esiste una pagina successiva
+        righe = cerca_ricambi(
+            cur, request.args.get('q', '').strip(),
+            limite=limite + 1, offset=offset,
+            nome_contiene=TIPI_FILTRO.get(tipo),
+            escludi_modello=request.args.get('escludi_modello', type=int),
+            escludi_id=request.args.get('escludi_id', type=int),
+            ordine_vuoto="codice"
+        )
+    finally:
+        conn.close()
+
+    return jsonify({
+        "risultati": [
+            {"id": r['id'], "codice": r['codice'], "nome": r['nome'] or ""}
+            for r in righe[:limite]
+        ],
+        "altri": len(righe) > limite
+    })
+
+@app.route('/ricambi/autocomplete')
+@login_required
+def autocomplete_ricambi():
+    """Primi N ricambi per codice o nome, con i codici equivalenti."""
+    testo = request.args.get('q', '').strip()
+    limite = min(max(request.args.get('limite', 10, type=int), 1), RICAMBI_AUTOCOMPLETE_MAX)
+    if not testo:
+        return jsonify([])
+
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        righe = cerca_ricambi(cur, testo, request.args.get('prefisso', '').strip().upper(), limite=limite)
+    finally:
+        conn.close()
+
+    return jsonify([
+        {
+            "id": r['id'],
+            "codice": r['codice'],
+            "nome": r['nome'] or "",
+            "quantita": r['quantita'],
+            "equivalenti": list(equivalenti(r['codice']))
+        }
+        for r in righe
+    ])
+
+@app.route('/ricambi/<int:id>/equivalenti')
+@login_required
+def equivalenti_ricambio(id):
+    """Gruppo di equivalenza di un ricambio e primo equivalente disponibile a magazzino."""
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cur.execute("SELECT codice, quantita FROM ricambi WHERE id = %s", (id,))
+        ricambio = cur.fetchone()
+        if not ricambio:
+            return jsonify({"error": "Ricambio non trovato"}), 404
+        disponibile = equivalenti_disponibili(conn, [ricambio['codice']]).get(ricambio['codice'])
+    finally:
+        conn.close()
+
+    return jsonify({
+        "codice": ricambio['codice'],
+        "quantita": ricambio['quantita'],
+        "equivalenti": list(equivalenti(ricambio['codice'])),
+        "disponibile": disponibile
+    })
+
+# =====================================
+# IMPORTAZIONE MASSIVA RICAMBI (CSV)
+# =====================================
+# Il file viene letto riga per riga, validato e caricato in una tabella di
+# appoggio temporanea (COPY su Postgres, inserimenti a blocchi su SQLite);
+# poi un'unica transazione fonde i dati in ricambi e nei gruppi di equivalenza.
+# Colonne: codice (obbligatoria), nome, prefisso, quantita, sostituto.
+# Il sostituto è il codice completo di un ricambio esistente o presente nel file:
+# il codice entra nel suo gruppo (l'import aggiunge equivalenze, non ne toglie).
+IMPORT_DIR = os.environ.get("IMPORT_DIR") or os.path.join(tempfile.gettempdir(), "gestionale_import")
+IMPORT_BLOCCO_SQLITE = 1000
+_COLONNE_IMPORT = ("riga", "nome", "codice", "quantita", "sostituto", "codice_norm", "sostituto_norm")
+
+
+class _FlussoCopy:
+    """File in sola lettura che produce il CSV per COPY FROM STDIN da un generatore di righe."""
+
+    def __init__(self, righe):
+        self._righe = righe
+        self._buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._righe)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        dati, self._buffer = self._buffer[:size], self._buffer[size:]
+        return dati
+
+    readline = read
+
+
+class _DialettoImport(csv.excel):
+    delimiter = ";"
+
+
+def _riga_csv(valori):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(valori)
+    return buffer.getvalue()
+
+
+def _leggi_csv_ricambi(testo, errori):
+    """
+    Genera le tuple valide (riga, nome, codice, quantita, sostituto, codice_norm,
+    sostituto_norm) dal CSV, con il prefisso già applicato. I confronti con
+    l'archivio usano le forme normalizzate ("MANN W712/75" = "MANN W 712/75").
+    Le righe scartate finiscono in `errori`.
+    """
+    # il separatore si deduce dall'intestazione (Excel italiano usa ";")
+    intestazione = testo.readline()
+    try:
+        dialetto = csv.Sniffer().sniff(intestazione, delimiters=";,\t")
+    except csv.Error:
+        dialetto = _DialettoImport
+    lettore = csv.DictReader(itertools.chain([intestazione], testo), dialect=dialetto)
+    if not lettore.fieldnames or "codice" not in [c.strip().lower() for c in lettore.fieldnames]:
+        raise ValueError("Il file deve avere un'intestazione con almeno la colonna 'codice'.")
+
+    visti = set()
+    for numero, grezza in enumerate(lettore, start=2):
+        riga = {(k or "").strip().lower(): (v or "").strip() for k, v in grezza.items()}
+        codice = applica_prefisso(riga.get("codice"), riga.get("prefisso"))
+        if not codice:
+            errori.append((numero, "Codice mancante", grezza))
+            continue
+        codice_norm = normalizza_codice(codice)
+        if codice_norm in visti:
+            errori.append((numero, f"Codice {codice} ripetuto nel file", grezza))
+            continue
+        quantita = riga.get("quantita") or None
+        if quantita is not None:
+            try:
+                quantita = int(quantita)
+            except ValueError:
+                errori.append((numero, f"Quantità non valida: {quantita}", grezza))
+                continue
+        sostituto = riga.get("sostituto") or None
+        sostituto_norm = normalizza_codice(sostituto) if sostituto else None
+        if sostituto_norm == codice_norm:
+            errori.append((numero, "Un ricambio non può essere sostituto di se stesso", grezza))
+            continue
+        visti.add(codice_norm)
+        yield (numero, riga.get("nome") or None, codice, quantita, sostituto, codice_norm, sostituto_norm)
+
+
+def _carica_appoggio(cur, righe):
+    """Riempie la tabella temporanea ricambi_import con le righe validate."""
+    if DB_BACKEND == "postgres":
+        cur.execute("""
+            CREATE TEMP TABLE ricambi_import (
+                riga INTEGER, nome TEXT, codice TEXT, quantita INTEGER, sostituto TEXT,
+                codice_norm TEXT, sostituto_norm TEXT
+            ) ON COMMIT DROP
+        """)
+        cur.copy_expert(
+            f"COPY ricambi_import ({', '.join(_COLONNE_IMPORT)}) FROM STDIN WITH (FORMAT csv)",
+            _FlussoCopy(_riga_csv(r) for r in righe)
+        )
+    else:
+        cur.execute("DROP TABLE IF EXISTS temp.ricambi_import")
+        cur.execute("""
+            CREATE TEMP TABLE ricambi_import (
+                riga INTEGER, nome TEXT, codice TEXT, quantita INTEGER, sostituto TEXT,
+                codice_norm TEXT, sostituto_norm TEXT
+            )
+        """)
+        blocco = []
+        for r in righe:
+            blocco.append(r)
+            if len(blocco) >= IMPORT_BLOCCO_SQLITE:
+                cur.executemany("INSERT INTO ricambi_import VALUES (%s, %s, %s, %s, %s, %s, %s)", blocco)
+                blocco = []
+        if blocco:
+            cur.executemany("INSERT INTO ricambi_import VALUES (%s, %s, %s, %s, %s, %s, %s)", blocco)
+
+
+def importa_ricambi(testo, utente_id, percorso_errori):
+    """
+    Importa un catalogo ricambi da un file CSV aperto in modalità testo.
+    Aggiorna nome/quantità dei codici già presenti, inserisce i nuovi e
+    unisce i gruppi di equivalenza indicati dalla colonna sostituto, in
+    un'unica transazione. Le righe scartate sono scritte in `percorso_errori` (CSV).
+    Restituisce un dizionario con i conteggi.
+    """
+    errori = []
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        _carica_appoggio(cur, _leggi_csv_ricambi(testo, errori))
+
+        # sostituti che non esistono né in archivio né nel file → riga scartata;
+        # i codici si confrontano sempre normalizzati, come nella ricerca
+        cur.execute("""
+            SELECT i.riga, i.codice, i.sostituto FROM ricambi_import i
+            WHERE i.sostituto IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM ricambi r WHERE r.codice_norm = i.sostituto_norm)
+              AND NOT EXISTS (SELECT 1 FROM ricambi_import j WHERE j.codice_norm = i.sostituto_norm)
+        """)
+        for riga, codice, sostituto in cur.fetchall():
+            errori.append((riga, f"Sostituto {sostituto} inesistente", {"codice": codice, "sostituto": sostituto}))
+            cur.execute("DELETE FROM ricambi_import WHERE riga = %s", (riga,))
+
+        cur.execute("SELECT COUNT(*) FROM ricambi_import")
+        validi = cur.fetchone()[0]
+
+        # le quantità cambiate finiscono nel registro movimenti prima dell'UPDATE
+        cur.execute("""
+            INSERT INTO movimenti_ricambi (ricambio_id, tipo, delta, quantita_dopo, utente_id, data_ora)
+            SELECT r.id, 'importazione', i.quantita - r.quantita, i.quantita, %s, NOW()
+            FROM ricambi r
+            JOIN ricambi_import i ON i.codice_norm = r.codice_norm
+            WHERE i.quantita IS NOT NULL AND i.quantita <> r.quantita
+            FOR UPDATE OF r
+        """, (utente_id,))
+
+        cur.execute("""
+            UPDATE ricambi AS r
+            SET nome = COALESCE(i.nome, r.nome),
+                quantita = COALESCE(i.quantita, r.quantita)
+            FROM ricambi_import AS i
+            WHERE r.codice_norm = i.codice_norm
+        """)
+        aggiornati = cur.rowcount
+
+        cur.execute("""
+            INSERT INTO ricambi (nome, codice, quantita, utente_id)
+            SELECT i.nome, i.codice, COALESCE(i.quantita, 0), %s
+            FROM ricambi_import i
+            WHERE NOT EXISTS (SELECT 1 FROM ricambi r WHERE r.codice_norm = i.codice_norm)
+        """, (utente_id,))
+        inseriti = cur.rowcount
+        cur.execute("""
+            INSERT INTO movimenti_ricambi (ricambio_id, tipo, delta, quantita_dopo, utente_id, data_ora)
+            SELECT r.id, 'importazione', r.quantita, r.quantita, %s, NOW()
+            FROM ricambi r
+            JOIN ricambi_import i ON i.codice_norm = r.codice_norm
+            WHERE NOT EXISTS (SELECT 1 FROM movimenti_ricambi m WHERE m.ricambio_id = r.id)
+        """, (utente_id,))
+
+        # i gruppi di equivalenza usano i codici come sono scritti in archivio
+        cur.execute("""
+            SELECT DISTINCT r.codice, s.codice
+            FROM ricambi_import i
+            JOIN ricambi r ON r.codice_norm = i.codice_norm
+            JOIN ricambi s ON s.codice_norm = i.sostituto_norm
+            WHERE i.sostituto IS NOT NULL
+        """)
+        sostituti = collega_equivalenti(conn, cur.fetchall())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    invalida_equivalenti()
+
+    if errori:
+        os.makedirs(os.path.dirname(percorso_errori) or ".", exist_ok=True)
+        with open(percorso_errori, "w", newline="", encoding="utf-8") as f:
+            scrittore = csv.writer(f, delimiter=";")
+            scrittore.writerow(["riga", "errore", "dati"])
+            for riga, messaggio, dati in sorted(errori, key=lambda e: e[0]):
+                scrittore.writerow([riga, messaggio, json.dumps(dati, ensure_ascii=False)])
+
+    return {
+        "validi": validi,
+        "inseriti": inseriti,
+        "aggiornati": aggiornati,
+        "sostituti": sostituti,
+        "errori": len(errori),
+        "file_errori": percorso_errori if errori else None,
+    }
+
+
+@app.route('/ricambi/importa', methods=['POST'])
+@login_required
+def importa_ricambi_csv():
+    if not ha_permesso("importa_ricambi"):
+        flash("Non hai i permessi per importare ricambi.")
+        return redirect(url_for('lista_ricambi'))
+
+    file = request.files.get('file')
+    if not file or not file.filename:
+        flash("Seleziona un file CSV da importare.")
+        return redirect(url_for('lista_ricambi'))
+
+    nome_errori = f"errori_ricambi_{uuid.uuid4().hex}.csv"
+    testo = io.TextIOWrapper(file.stream, encoding="utf-8-sig", newline="")
+    try:
+        esito = importa_ricambi(testo, session['user_id'], os.path.join(IMPORT_DIR, nome_errori))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        flash(f"File non valido: {e}")
+        return redirect(url_for('lista_ricambi'))
+    except Exception:
+        app.logger.exception("Errore durante l'importazione ricambi.")
+        flash("Errore durante l'importazione: nessuna modifica salvata.")
+        return redirect(url_for('lista_ricambi'))
+
+    log_storico(session['user_id'], f"Importati ricambi da {file.filename}: "
+                f"{esito['inseriti']} nuovi, {esito['aggiornati']} aggiornati, {esito['errori']} scartati", "ricambi")
+
+    flash(f"Import completato: {esito['inseriti']} nuovi, {esito['aggiornati']} aggiornati, "
+          f"{esito['sostituti']} sostituti, {esito['errori']} righe scartate.")
+    if esito['file_errori']:
+        session['import_ricambi_errori'] = nome_errori
+    else:
+        session.pop('import_ricambi_errori', None)
+    return redirect(url_for('lista_ricambi'))
+
+
+@app.route('/ricambi/importa/errori')
+@login_required
+def errori_import_ricambi():
+    """Scarica il file con le righe scartate dall'ultima importazione dell'utente."""
+    nome = session.get('import_ricambi_errori')
+    percorso = os.path.join(IMPORT_DIR, nome) if nome else None
+    if not percorso or not os.path.exists(percorso):
+        abort(404)
+    return send_file(percorso, mimetype="text/csv", as_attachment=True, download_name="errori_import_ricambi.csv")
+
 @app.route('/aggiungi_ricambio', methods=['POST', 'GET'])
 @login_required
 def aggiungi_ricambio():
@@ -933,8 +4298,7 @@ def aggiungi_ricambio():
     prefisso = request.form.get('prefisso', '').upper()
 
     # Applica prefisso al codice principale
-    if prefisso and not codice.upper().startswith(prefisso):
-        codice = f"{prefisso} {codice.strip()}"
+    codice = applica_prefisso(codice, prefisso)
 
     # -----------------------------------------------------
     # 🔁 NUOVA LOGICA — SOLO MENÙ SOSTITUENTE
@@ -953,31 +4317,19 @@ def aggiungi_ricambio():
         """, (nome, codice, 0, session['user_id']))
 
         new_id = cur.fetchone()[0]
+        _registra_movimenti(cur, [(new_id, 0, 0)], "apertura", session['user_id'], None)
 
         # -----------------------------------------------------
-        # 🔁 INSERIMENTO SOSTITUTO BIDIREZIONALE (SE PRESENTE)
+        # 🔁 IL NUOVO CODICE ENTRA NEL GRUPPO DEL SOSTITUTO (SE PRESENTE)
         # -----------------------------------------------------
-        if sostitutivo and sostitutivo != "":
-            # A → B
-            cur.execute("""
-                INSERT INTO ricambi_sostituti (codice, codice_sostituto)
-                VALUES (%s, %s)
-                ON CONFLICT (codice) DO UPDATE SET
-                    codice_sostituto = EXCLUDED.codice_sostituto
-            """, (codice, sostitutivo))
-
-            # B → A (collegamento reciproco)
-            cur.execute("""
-                INSERT INTO ricambi_sostituti (codice, codice_sostituto)
-                VALUES (%s, %s)
-                ON CONFLICT (codice) DO UPDATE SET
-                    codice_sostituto = EXCLUDED.codice_sostituto
-            """, (sostitutivo, codice))
+        if sostitutivo:
+            collega_equivalenti(conn, [(codice, sostitutivo)])
 
         conn.commit()
 
     finally:
         conn.close()
+    invalida_equivalenti()
 
     # Storico
     try:
@@ -991,16 +4343,8 @@ def aggiungi_ricambio():
 @app.route('/inserisci_ricambio')
 @login_required
 def inserisci_ricambio():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-
-    # Recupera tutti i ricambi esistenti (usati per il menu sostituti)
-    cur.execute("SELECT codice, nome FROM ricambi ORDER BY codice")
-    ricambi = cur.fetchall()
-
-    conn.close()
-
-    return render_template('inserisci_ricambio.html', ricambi=ricambi)
+    # il sostituto si sceglie con il selettore che interroga lookup_ricambi
+    return render_template('inserisci_ricambio.html')
 
 @app.route('/elimina_ricambio/<int:id>', methods=['POST'])
 @login_required
@@ -1024,22 +4368,23 @@ def elimina_ricambio(id):
 
         codice = row[0]
 
-        # 2️⃣ Cancello solo i legami sostituzione collegati
-        cur.execute("""
-            DELETE FROM ricambi_sostituti 
-            WHERE codice = %s OR codice_sostituto = %s
-        """, (codice, codice))
-
-        # 3️⃣ Cancello il ricambio
+        # 2️⃣ Cancello il ricambio
         cur.execute("""
             DELETE FROM ricambi 
             WHERE id = %s AND utente_id = %s
         """, (id, session['user_id']))
 
+        # 3️⃣ Se nessun altro ricambio ha lo stesso codice, lo tolgo dal suo
+        #    gruppo: gli altri codici restano equivalenti tra loro
+        cur.execute("SELECT 1 FROM ricambi WHERE codice = %s", (codice,))
+        if not cur.fetchone():
+            scollega_equivalente(conn, codice)
+
         conn.commit()
 
     finally:
         conn.close()
+    invalida_equivalenti()
 
     # 4️⃣ Log storico
     try:
@@ -1076,12 +4421,16 @@ def modifica_ricambio(id):
         # Nuovi valori inviati dal form
         nome = request.form.get('nome')
         codice = request.form.get('codice')
-        quantita = request.form.get('quantita')
+        try:
+            quantita = max(0, int(request.form.get('quantita')))
+        except (TypeError, ValueError):
+            cur.close()
+            flash("Quantità non valida.", "danger")
+            return redirect(url_for('modifica_ricambio', id=id))
 
         # ✅ PREFISSO (STESSA LOGICA DI INSERIMENTO)
         prefisso = request.form.get('prefisso', '').upper()
-        if prefisso and not codice.upper().startswith(prefisso):
-            codice = f"{prefisso} {codice.strip()}"
+        codice = applica_prefisso(codice, prefisso)
 
         # Sostituente scelto dal menu (UNICA MODALITÀ)
         sostitutivo = request.form.get('sost_codice_select')
@@ -1089,42 +4438,43 @@ def modifica_ricambio(id):
             sostitutivo = None
 
         try:
-            # 1️⃣ Aggiorna ricambio principale
+            # 1️⃣ Aggiorna ricambio principale; la quantità passa dal
+            #    registro movimenti come rettifica
             cur.execute("""
                 UPDATE ricambi
-                SET nome=%s, codice=%s, quantita=%s
+                SET nome=%s, codice=%s
                 WHERE id=%s AND utente_id=%s
-            """, (nome, codice, quantita, id, session['user_id']))
-
-            # 2️⃣ Elimina tutti i vecchi legami (A→B e B→A)
-            cur.execute("""
-                DELETE FROM ricambi_sostituti
-                WHERE codice=%s OR codice_sostituto=%s
-            """, (old_codice, old_codice))
-
-            # 3️⃣ Se è impostato un nuovo sostituto, ricrea legami A↔B
-            if sostitutivo:
+            """, (nome, codice, id, session['user_id']))
+            if not cur.rowcount:
+                # ricambio di un altro utente: nemmeno i gruppi di equivalenza si toccano
+                conn.rollback()
+                flash("Ricambio non trovato.", "danger")
+                return redirect(url_for('lista_ricambi'))
+            rettifica_giacenza(conn, id, quantita, utente_id=session['user_id'], causale="Modifica ricambio")
 
-                # A → B
-                cur.execute("""
-                    INSERT INTO ricambi_sostituti (codice, codice_sostituto)
-                    VALUES (%s, %s)
-                    ON CONFLICT (codice) DO UPDATE SET
-                        codice_sostituto = EXCLUDED.codice_sostituto
-                """, (codice, sostitutivo))
+            # 2️⃣ Il codice cambiato resta nel suo gruppo di equivalenza
+            rinomina_equivalente(conn, old_codice, codice)
 
-                # B → A
-                cur.execute("""
-                    INSERT INTO ricambi_sostituti (codice, codice_sostituto)
-                    VALUES (%s, %s)
-                    ON CONFLICT (codice) DO UPDATE SET
-                        codice_sostituto = EXCLUDED.codice_sostituto
-                """, (sostitutivo, codice))
+            # 3️⃣ Sostituto scelto: il ricambio passa nel suo gruppo (se non
+            #    c'è già); nessun sostituto: esce dal gruppo
+            if not sostitutivo:
+                scollega_equivalente(conn, codice)
+            else:
+                cur.execute(
+                    "SELECT COUNT(DISTINCT gruppo) AS gruppi, COUNT(*) AS codici "
+                    "FROM ricambi_gruppi WHERE codice IN (%s, %s)",
+                    (codice, sostitutivo)
+                )
+                stato = cur.fetchone()
+                if not (stato['codici'] == 2 and stato['gruppi'] == 1):
+                    scollega_equivalente(conn, codice)
+                    collega_equivalenti(conn, [(codice, sostitutivo)])
 
             conn.commit()
 
         finally:
             conn.close()
+        invalida_equivalenti()
 
         # Storico
         try:
@@ -1148,32 +4498,18 @@ def modifica_ricambio(id):
         flash("Ricambio non trovato.", "danger")
         return redirect(url_for('lista_ricambi'))
 
-    # Recupero eventuale sostituente esistente
-    cur.execute("""
-        SELECT codice_sostituto
-        FROM ricambi_sostituti
-        WHERE codice=%s
-    """, (ricambio['codice'],))
-    row = cur.fetchone()
-
-    sostitutivo_corrente = row['codice_sostituto'] if row else None
-
-    # Tutti i ricambi disponibili per il menu (escluso se stesso)
-    cur.execute("""
-        SELECT codice, nome 
-        FROM ricambi
-        WHERE id != %s
-        ORDER BY nome ASC
-    """, (id,))
-    ricambi = cur.fetchall()
+    # Gruppo di equivalenza corrente: il menu propone il primo codice
+    gruppo = equivalenti(ricambio['codice'])
+    sostitutivo_corrente = gruppo[0] if gruppo else None
 
     cur.close()
 
+    # il menu dei sostituti è caricato a pagine da lookup_ricambi
     return render_template(
         'modifica_ricambio.html',
         ricambio=ricambio,
-        ricambi=ricambi,
-        sostitutivo_corrente=sostitutivo_corrente
+        sostitutivo_corrente=sostitutivo_corrente,
+        equivalenti=gruppo
     )
 
 @app.route('/modello_ricambi/<int:modello_id>')
@@ -1195,22 +4531,16 @@ def modello_ricambi(modello_id):
             ORDER BY r.codice ASC
         """, (modello_id,))
         associati = cur.fetchall()
-
-        cur.execute("""
-            SELECT r.* FROM ricambi r
-            WHERE r.id NOT IN (SELECT ricambio_id FROM modelli_ricambi WHERE modello_id = %s)
-            ORDER BY r.codice ASC
-        """, (modello_id,))
-        non_associati = cur.fetchall()
     finally:
         conn.close()
-    return render_template('modello_ricambi.html', modello=modello, associati=associati, non_associati=non_associati)
+    # i ricambi non associati si cercano da lookup_ricambi (escludi_modello)
+    return render_template('modello_ricambi.html', modello=modello, associati=associati)
 
 @app.route('/aggiungi_ricambio_a_modello/<int:modello_id>', methods=['POST'])
 @login_required
 def aggiungi_ricambio_a_modello(modello_id):
     # Controllo permessi
-    if session.get('username') != 'G.AS_Giuseppe.Palladino':
+    if not ha_permesso("ricambi_modelli"):
         flash("Non hai i permessi per associare ricambi ai modelli.")
         return redirect(url_for('modello_ricambi', modello_id=modello_id))
 
@@ -1285,7 +4615,7 @@ def aggiungi_ricambio_a_modello(modello_id):
 @app.route('/rimuovi_ricambio_da_modello/<int:modello_id>/<int:ricambio_id>', methods=['POST'])
 @login_required
 def rimuovi_ricambio_da_modello(modello_id, ricambio_id):
-    if session.get('username') != 'G.AS_Giuseppe.Palladino':
+    if not ha_permesso("ricambi_modelli"):
         flash("Non hai i permessi per rimuovere ricambi dai modelli.")
         return redirect(url_for('modello_ricambi', modello_id=modello_id))
 
@@ -1311,27 +4641,20 @@ def rimuovi_ricambio_da_modello(modello_id, ricambio_id):
     return redirect(url_for('modello_ricambi', modello_id=modello_id))
 
 @app.route('/modello/<int:modello_id>/usa_veicolo', methods=['POST'])
+@login_required
 def usa_veicolo(modello_id):
     # Connessione al database Supabase
     conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur = conn.cursor()
 
     try:
         # Recupera tutti i ricambi associati a questo modello
-        cur.execute("""
-            SELECT r.id, r.quantita
-            FROM ricambi r
-            JOIN modelli_ricambi mr ON r.id = mr.ricambio_id
-            WHERE mr.modello_id = %s
-        """, (modello_id,))
-        associati = cur.fetchall()
+        cur.execute("SELECT ricambio_id FROM modelli_ricambi WHERE modello_id = %s", (modello_id,))
+        associati = [r[0] for r in cur.fetchall()]
+
+        # Decrementa di 1 (solo dove la giacenza è maggiore di 0) con un'unica UPDATE
+        muovi_giacenze(conn, associati, "uso_veicolo", -1, session['user_id'], f"Modello {modello_id}")
 
-        # Decrementa la quantità di 1 se maggiore di 0
-        for r in associati:
-            nuova_quantita = max(r['quantita'] - 1, 0)
-            cur.execute("UPDATE ricambi SET quantita = %s WHERE id = %s",
-                        (nuova_quantita, r['id']))
-        
         conn.commit()
         flash("Giacenze aggiornate per tutti i ricambi di questo modello.", "success")
     finally:
@@ -1343,37 +4666,36 @@ def usa_veicolo(modello_id):
 @app.route('/ricambi/aggiorna_giacenza/<int:ricambio_id>', methods=['POST'])
 @login_required
 def aggiorna_giacenza(ricambio_id):
-    if session.get('username') != 'G.AS_Giuseppe.Palladino':
+    if not ha_permesso("giacenza_ricambi"):
         flash("Accesso negato.", "danger")
         return redirect(url_for('lista_ricambi'))
 
     azione = request.form.get('azione')
     nuova_quantita = request.form.get('nuova_quantita')
+    causale = (request.form.get('causale') or '').strip() or None
+    utente_id = session['user_id']
 
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        # prendi la quantità attuale
-        cur.execute("SELECT quantita FROM ricambi WHERE id=%s", (ricambio_id,))
-        result = cur.fetchone()
-        if not result:
+        cur.execute("SELECT 1 FROM ricambi WHERE id=%s", (ricambio_id,))
+        if not cur.fetchone():
             flash("Ricambio non trovato.", "danger")
             return redirect(url_for('lista_ricambi'))
 
-        quantita = result[0]
-
+        # variazioni relative in un'unica UPDATE: niente lettura-modifica-scrittura
         if azione == 'incrementa':
-            quantita += 1
+            muovi_giacenze(conn, [ricambio_id], "carico", 1, utente_id, causale)
         elif azione == 'decrementa':
-            quantita = max(0, quantita - 1)
+            muovi_giacenze(conn, [ricambio_id], "scarico", -1, utente_id, causale)
         elif nuova_quantita is not None:
             try:
                 quantita = max(0, int(nuova_quantita))
             except ValueError:
                 flash("Valore non valido.", "danger")
                 return redirect(url_for('lista_ricambi'))
+            rettifica_giacenza(conn, ricambio_id, quantita, utente_id=utente_id, causale=causale)
 
-        cur.execute("UPDATE ricambi SET quantita=%s WHERE id=%s", (quantita, ricambio_id))
         conn.commit()
     finally:
         conn.close()
@@ -1382,35 +4704,30 @@ def aggiorna_giacenza(ricambio_id):
     return redirect(url_for('lista_ricambi'))
 
 # =====================================
-# LAVORAZIONI (OFFICINA)
-# =====================================
-@app.route('/lavorazioni')
-@login_required
-def lavorazioni_generale():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        cur.execute("""
-            SELECT l.*, u.username
-            FROM lavorazioni l
-            LEFT JOIN utenti u ON l.tecnico_id = u.id
-            WHERE l.eliminata = FALSE
-            ORDER BY l.id DESC
-        """)
-        lavori_raw = cur.fetchall()
-    finally:
-        conn.close()
+# LAVORAZIONI (OFFICINA)
+# =====================================
+@app.route('/lavorazioni')
+@login_required
+def lavorazioni_generale():
+    lavori_raw = righe_a_blocchi("""
+        SELECT l.*, u.username
+        FROM lavorazioni l
+        LEFT JOIN utenti u ON l.tecnico_id = u.id
+        WHERE l.eliminata = FALSE
+        ORDER BY l.id DESC
+    """)
 
-    # Rimuove duplicati in Python usando (cliente_nome, targa, data_creazione)
-    seen = set()
-    lavori = []
-    for l in lavori_raw:
-        key = (l.get('cliente_nome'), l.get('targa'), l.get('data_creazione'))
-        if key not in seen:
-            seen.add(key)
-            lavori.append(l)
+    # Rimuove duplicati in Python usando (cliente_nome, targa, data_creazione):
+    # in memoria restano solo le chiavi, le righe passano una alla volta
+    def lavori():
+        seen = set()
+        for l in lavori_raw:
+            key = (l.get('cliente_nome'), l.get('targa'), l.get('data_creazione'))
+            if key not in seen:
+                seen.add(key)
+                yield l
 
-    return render_template('lavorazioni.html', lavorazioni=lavori)
+    return stream_template('lavorazioni.html', lavorazioni=lavori())
 
 @app.route('/nuova_lavorazione', methods=['GET', 'POST'])
 @login_required
@@ -1457,8 +4774,72 @@ def nuova_lavorazione():
 @app.route('/ajax_lavorazioni')
 @login_required
 def ajax_lavorazioni():
+    # 304 se il widget ha già la versione corrente delle lavorazioni
+    return risposta_condizionale(("lavorazioni",), _lavorazioni_json)
+
+# Colonne del widget lavorazioni (stesso ordine per lista completa e delta)
+_COLONNE_WIDGET_LAVORAZIONI = """
+    id, data_creazione, tipo, 
+    COALESCE(tagliando, FALSE) AS tagliando,
+    COALESCE(dischi_pattini, FALSE) AS dischi_pattini,
+    COALESCE(marca,'') AS marca,
+    COALESCE(modello,'') AS modello,
+    COALESCE(stato,'') AS stato,
+    COALESCE(cliente_nome,'') AS cliente_nome,
+    COALESCE(targa,'') AS targa,
+    COALESCE(cilindrata,'') AS cilindrata,
+    COALESCE(kw,NULL) AS kw,
+    COALESCE(anno,NULL) AS anno,
+    COALESCE(ordine_riparazione,'') AS ordine_riparazione,
+    COALESCE(descrizione,'') AS descrizione,
+    COALESCE(note,'') AS note
+"""
+
+# Stati visibili all'accettazione
+STATI_WIDGET_ACCETTAZIONE = ('ordine inviato', 'in lavorazione', 'completata', 'attesa del levabolle')
+
+# Il cursore restituito è arretrato di qualche secondo: una modifica confermata
+# dopo la lettura ma con data_aggiornamento precedente viene ripresa al giro dopo
+LAVORAZIONI_SYNC_MARGINE = int(os.environ.get("LAVORAZIONI_SYNC_MARGINE", "30"))
+
+
+def _formatta_lavorazione(r):
+    # Determina il tipo leggibile
+    if r[3]:  # tagliando
+        tipo_display = "Tagliando"
+    elif r[4]:  # dischi_pattini
+        tipo_display = "Dischi e Pattini freno"
+    else:
+        tipo_display = r[2] or ""  # tipo originale
+
+    return {
+        "id": r[0],
+        "data_creazione": r[1].strftime("%d/%m/%Y %H:%M") if r[1] else "",
+        "tipo": tipo_display,
+        "marca": r[5] or "",
+        "modello": r[6] or "",
+        "stato": r[7] or "",
+        "cliente_nome": r[8] or "",
+        "targa": r[9] or "",
+        "cilindrata": r[10] or "",
+        "kw": r[11] or "",
+        "anno": r[12] or "",
+        "ordine_riparazione": r[13] or "",
+        "descrizione": r[14] or "",
+        "note": r[15] or ""
+    }
+
+
+def _lavorazioni_json():
     ruolo = session.get('ruolo')
     user_id = session.get('user_id')
+    if ruolo not in ('officina', 'accettazione'):
+        return jsonify({"error": "Ruolo non autorizzato"}), 403
+
+    # --- Modalità incrementale: ?since=<cursore> ---
+    if 'since' in request.args:
+        return _lavorazioni_delta(ruolo, user_id, request.args.get('since'))
+
     conn = None
     cur = None
     try:
@@ -1466,83 +4847,93 @@ def ajax_lavorazioni():
         cur = conn.cursor()
 
         if ruolo == 'officina':
-            cur.execute("""
-                SELECT id, data_creazione, tipo, 
-                       COALESCE(tagliando, FALSE) AS tagliando,
-                       COALESCE(dischi_pattini, FALSE) AS dischi_pattini,
-                       COALESCE(marca,'') AS marca,
-                       COALESCE(modello,'') AS modello,
-                       COALESCE(stato,'') AS stato,
-                       COALESCE(cliente_nome,'') AS cliente_nome,
-                       COALESCE(targa,'') AS targa,
-                       COALESCE(cilindrata,'') AS cilindrata,
-                       COALESCE(kw,NULL) AS kw,
-                       COALESCE(anno,NULL) AS anno,
-                       COALESCE(ordine_riparazione,'') AS ordine_riparazione,
-                       COALESCE(descrizione,'') AS descrizione,
-                       COALESCE(note,'') AS note
+            cur.execute(f"""
+                SELECT {_COLONNE_WIDGET_LAVORAZIONI}
                 FROM lavorazioni
-                WHERE id_officina = %s AND COALESCE(eliminata, false) = false
+                WHERE id_officina = %s AND eliminata = FALSE
                 ORDER BY data_creazione DESC
             """, (user_id,))
-        
-        elif ruolo == 'accettazione':
-            cur.execute("""
-                SELECT id, data_creazione, tipo, 
-                       COALESCE(tagliando, FALSE) AS tagliando,
-                       COALESCE(dischi_pattini, FALSE) AS dischi_pattini,
-                       COALESCE(marca,'') AS marca,
-                       COALESCE(modello,'') AS modello,
-                       COALESCE(stato,'') AS stato,
-                       COALESCE(cliente_nome,'') AS cliente_nome,
-                       COALESCE(targa,'') AS targa,
-                       COALESCE(cilindrata,'') AS cilindrata,
-                       COALESCE(kw,NULL) AS kw,
-                       COALESCE(anno,NULL) AS anno,
-                       COALESCE(ordine_riparazione,'') AS ordine_riparazione,
-                       COALESCE(descrizione,'') AS descrizione,
-                       COALESCE(note,'') AS note
+        else:
+            cur.execute(f"""
+                SELECT {_COLONNE_WIDGET_LAVORAZIONI}
                 FROM lavorazioni
-                WHERE COALESCE(eliminata, false) = false
-                  AND TRIM(stato) IN ('ordine inviato', 'in lavorazione', 'completata', 'attesa del levabolle')
+                WHERE eliminata = FALSE
+                  AND TRIM(stato) IN ({", ".join(["%s"] * len(STATI_WIDGET_ACCETTAZIONE))})
                 ORDER BY data_creazione DESC
-            """)
-        else:
-            return jsonify({"error": "Ruolo non autorizzato"}), 403
+            """, STATI_WIDGET_ACCETTAZIONE)
 
-        rows = cur.fetchall()
+        return jsonify([_formatta_lavorazione(r) for r in cur.fetchall()])
 
-        lavori_list = []
-        for r in rows:
-            # Determina il tipo leggibile
-            if r[3]:  # tagliando
-                tipo_display = "Tagliando"
-            elif r[4]:  # dischi_pattini
-                tipo_display = "Dischi e Pattini freno"
-            else:
-                tipo_display = r[2] or ""  # tipo originale
-
-            lavori_list.append({
-                "id": r[0],
-                "data_creazione": r[1].strftime("%d/%m/%Y %H:%M") if r[1] else "",
-                "tipo": tipo_display,
-                "marca": r[5] or "",
-                "modello": r[6] or "",
-                "stato": r[7] or "",
-                "cliente_nome": r[8] or "",
-                "targa": r[9] or "",
-                "cilindrata": r[10] or "",
-                "kw": r[11] or "",
-                "anno": r[12] or "",
-                "ordine_riparazione": r[13] or "",
-                "descrizione": r[14] or "",
-                "note": r[15] or ""
-            })
+    except Exception:
+        app.logger.exception("Errore nel recupero delle lavorazioni AJAX.")
+        return jsonify({"error": "Impossibile recuperare le lavorazioni"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
 
-        return jsonify(lavori_list)
+
+def _lavorazioni_delta(ruolo, user_id, since):
+    """
+    Restituisce solo le lavorazioni create o modificate dopo il cursore
+    (data_aggiornamento), gli id da togliere dalla lista (eliminate o uscite
+    dagli stati visibili al ruolo) e il nuovo cursore da usare al giro dopo.
+    Con cursore vuoto restituisce la lista completa.
+    """
+    dal = None
+    if since:
+        try:
+            dal = datetime.fromisoformat(since)
+        except ValueError:
+            return jsonify({"error": "Cursore 'since' non valido"}), 400
+        if dal.tzinfo is None:
+            dal = pytz.timezone("Europe/Rome").localize(dal)
+        dal = dal.astimezone(pytz.timezone("Europe/Rome"))
+
+    cursore = now_ita() - timedelta(seconds=LAVORAZIONI_SYNC_MARGINE)
+
+    condizioni, parametri = [], []
+    if ruolo == 'officina':
+        condizioni.append("id_officina = %s")
+        parametri.append(user_id)
+    if dal is None:
+        # prima sincronizzazione: niente tombstone, solo le righe visibili
+        condizioni.append("eliminata = FALSE")
+    else:
+        condizioni.append("data_aggiornamento > %s")
+        parametri.append(dal)
+
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT {_COLONNE_WIDGET_LAVORAZIONI}, eliminata
+            FROM lavorazioni
+            WHERE {" AND ".join(condizioni)}
+            ORDER BY data_creazione DESC
+        """, parametri)
+
+        lavorazioni, rimosse = [], []
+        for r in cur.fetchall():
+            visibile = not r[16] and (
+                ruolo == 'officina' or (r[7] or '').strip() in STATI_WIDGET_ACCETTAZIONE
+            )
+            if visibile:
+                lavorazioni.append(_formatta_lavorazione(r))
+            elif dal is not None:
+                rimosse.append(r[0])
+
+        return jsonify({
+            "lavorazioni": lavorazioni,
+            "eliminate": rimosse,
+            "cursore": cursore.isoformat()
+        })
 
     except Exception:
-        app.logger.exception("Errore nel recupero delle lavorazioni AJAX.")
+        app.logger.exception("Errore nella sincronizzazione incrementale delle lavorazioni.")
         return jsonify({"error": "Impossibile recuperare le lavorazioni"}), 500
     finally:
         if cur:
@@ -1586,6 +4977,19 @@ def inserisci_lavorazione():
                 flash("Devi inserire almeno il nome del cliente, la targa del veicolo o il numero ordine di riparazione.")
                 return redirect(url_for('inserisci_lavorazione'))
 
+            # Targa già nota: collega vettura e cliente e completa i campi lasciati vuoti
+            vettura = vettura_per_targa(cur, targa, session['user_id'])
+            if vettura:
+                cliente_nome = cliente_nome or " ".join(
+                    p for p in (vettura['cliente_nome'], vettura['cliente_cognome']) if p
+                )
+                marca = marca or vettura['marca'] or ''
+                modello = modello or vettura['modello'] or ''
+                cilindrata = cilindrata or vettura['cilindrata']
+                kw = kw or vettura['kw']
+                if not anno and vettura['immatricolazione']:
+                    anno = str(vettura['immatricolazione'].year)
+
             # Funzione di conversione valori numerici
             def to_int(val):
                 try:
@@ -1600,13 +5004,15 @@ def inserisci_lavorazione():
             # Inserimento nel database
             cur.execute("""
                 INSERT INTO lavorazioni 
-                (id_officina, tipo, marca, modello, cilindrata, kw, anno, stato, cliente_nome, targa, ordine_riparazione)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                (id_officina, tipo, marca, modello, cilindrata, kw, anno, stato, cliente_nome, targa, ordine_riparazione,
+                 vettura_id, cliente_id)
+                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
                 RETURNING id;
             """, (
                 session['user_id'],
                 tipo_lavorazione if tipo_lavorazione else ('Tagliando' if tagliando else 'Dischi e Pattini freno' if dischi_pattini else None),
-                marca, modello, cilindrata_val, kw_val, anno_val, stato, cliente_nome, targa, ordine_riparazione
+                marca, modello, cilindrata_val, kw_val, anno_val, stato, cliente_nome, targa, ordine_riparazione,
+                vettura['id'] if vettura else None, vettura['cliente_id'] if vettura else None
             ))
 
             new_record = cur.fetchone()
@@ -1618,18 +5024,18 @@ def inserisci_lavorazione():
                 log_storico(session['user_id'], f"Inserita lavorazione {new_id}: {marca} {modello}", "lavorazioni", new_id)
             except Exception:
                 pass
+            notifica_lavorazione("creata", new_id)
 
             flash("Lavorazione inserita correttamente.")
             return redirect(url_for('home_officina'))
 
-        # GET: recupero marche e modelli
-        cur.execute("SELECT DISTINCT marca FROM modelli ORDER BY marca")
-        marche = [row['marca'] for row in cur.fetchall()]
-        cur.execute("SELECT marca, modello FROM modelli ORDER BY marca, modello")
-        modelli = cur.fetchall()
     finally:
         conn.close()
 
+    # GET: marche e modelli dalla cache
+    marche = marche_modelli()
+    modelli = catalogo_modelli()
+
     return render_template('inserisci_lavorazione.html', marche=marche, modelli=modelli)
 
 @app.route('/accettazione/aggiorna_stato/<int:id>', methods=['POST'])
@@ -1666,6 +5072,7 @@ def accettazione_aggiorna_stato(id):
             log_storico(session['user_id'], f"Aggiornato stato lavorazione {id} → {nuovo_stato}", "lavorazioni", id)
         except Exception as log_err:
             app.logger.warning(f"Errore durante log storico lavorazione {id}: {log_err}")
+        notifica_lavorazione("stato", id)
 
     except Exception as e:
         conn.rollback()
@@ -1780,21 +5187,14 @@ def modifica_lavorazione(id):
 
     values.append(id)  # id per WHERE
 
+    set_clause.append("data_aggiornamento = NOW()")
     query = f"UPDATE lavorazioni SET {', '.join(set_clause)} WHERE id = %s"
 
     conn = None
     try:
-        # Connessione al DB usando variabili .env
-        conn = psycopg2.connect(
-            dbname=os.environ.get('DB_NAME'),
-            user=os.environ.get('DB_USER'),
-            password=os.environ.get('DB_PASSWORD'),
-            host=os.environ.get('DB_HOST'),
-            port=os.environ.get('DB_PORT'),
-            cursor_factory=RealDictCursor
-        )
+        conn = get_db_connection()
 
-        cur = conn.cursor()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
         cur.execute(query, values)
 
         if cur.rowcount == 0:
@@ -1803,6 +5203,7 @@ def modifica_lavorazione(id):
 
         conn.commit()
         conn.close()
+        notifica_lavorazione("modificata", id)
         return jsonify({'success': True})
 
     except Exception as e:
@@ -1834,21 +5235,14 @@ def elimina_lavorazione(id):
         # Soft delete della lavorazione
         cur.execute("""
             UPDATE lavorazioni 
-            SET eliminata = TRUE
+            SET eliminata = TRUE, data_aggiornamento = NOW()
             WHERE id = %s
         """, (id,))
         conn.commit()
 
         # Log nello storico
-        try:
-            cur.execute("""
-                INSERT INTO storico_azioni (id_utente, azione, tabella, record_id, data_ora)
-                VALUES (%s, %s, %s, %s, NOW())
-            """, (session.get('user_id'), 'Eliminazione', 'lavorazioni', id))
-            conn.commit()
-        except Exception as log_err:
-            app.logger.error(f"Impossibile registrare storico: {log_err}")
-            conn.rollback()
+        log_storico(session.get('user_id'), f"Eliminata lavorazione {id}", "lavorazioni", id)
+        notifica_lavorazione("eliminata", id)
 
         return jsonify({"success": True})
     except Exception as e:
@@ -1896,6 +5290,7 @@ def officina_aggiorna_stato(id):
             log_storico(session['user_id'], f"Aggiornato stato lavorazione {id} → {nuovo_stato_db}", "lavorazioni", id)
         except Exception as log_err:
             app.logger.warning(f"Errore durante log storico lavorazione {id}: {log_err}")
+        notifica_lavorazione("stato", id)
 
     except Exception as e:
         conn.rollback()
@@ -2040,23 +5435,134 @@ def inserisci_gomme():
 @app.route("/giacenza_gomme")
 @login_required
 def giacenza_gomme():
+    # le opzioni dei filtri arrivano da query a parte: l'elenco viene letto una volta sola, in streaming
     try:
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
+        marche = valori_distinti(cur, "gomme", "marca")
         cur.execute("""
-            SELECT id, marca, larghezza, rapporto, diametro, prezzo_unitario, prezzo_treno, disponibilita, note
-            FROM gomme
-            ORDER BY marca, larghezza, rapporto, diametro
+            SELECT DISTINCT larghezza, rapporto, diametro FROM gomme
+            ORDER BY larghezza, rapporto, diametro
         """)
-        gomme = cur.fetchall()
+        misure = [f"{r['larghezza']}/{r['rapporto']} R{r['diametro']}" for r in cur.fetchall()]
         cur.close()
         conn.close()
     except Exception as e:
         app.logger.error(f"Errore nel caricamento giacenza gomme: {e}")
-        gomme = []
         flash("❌ Errore nel recupero della giacenza gomme.")
+        return render_template("giacenza_gomme.html", gomme=[], marche=[], misure=[])
+
+    gomme = righe_a_blocchi("""
+        SELECT id, marca, larghezza, rapporto, diametro, prezzo_unitario, prezzo_treno, disponibilita, note
+        FROM gomme
+        ORDER BY marca, larghezza, rapporto, diametro
+    """)
+    return stream_template("giacenza_gomme.html", gomme=gomme, marche=marche, misure=misure)
+
+COLONNE_CSV_GOMME = [
+    ("Marca", "marca"), ("Larghezza", "larghezza"), ("Rapporto", "rapporto"), ("Diametro", "diametro"),
+    ("Prezzo unitario", "prezzo_unitario"), ("Prezzo treno", "prezzo_treno"),
+    ("Disponibilità", "disponibilita"), ("Note", "note"),
+]
+# 205/55 R16, 205/55ZR16, 205 55 16, 2055516, con eventuale indice di carico/velocità (91V)
+_RE_MISURA = re.compile(
+    r"^\s*(\d{3})\s*[/\s-]?\s*(\d{2})\s*(?:Z?R\s*|-\s*|\s+)?(\d{2})(?:\s*\d{2,3}\s*[A-Z]{1,2})?\s*$",
+    re.IGNORECASE
+)
+
+def leggi_misura(testo):
+    """(larghezza, rapporto, diametro) da una misura scritta a mano, None se non riconosciuta."""
+    m = _RE_MISURA.match(testo or "")
+    return tuple(int(v) for v in m.groups()) if m else None
+
+@app.route("/giacenza_gomme/esporta")
+@login_required
+def esporta_gomme():
+    """Esporta la giacenza gomme, filtrabile per marca e misura (es. 205/55 R16) come la pagina."""
+    condizioni, parametri = [], []
+    marca = request.args.get("marca", "").strip()
+    if marca:
+        condizioni.append("marca = %s")
+        parametri.append(marca)
+    misura = request.args.get("misura", "").strip()
+    if misura:
+        valori = leggi_misura(misura)
+        if not valori:
+            abort(400, description="Misura non valida (formato 205/55 R16).")
+        condizioni.append("larghezza = %s AND rapporto = %s AND diametro = %s")
+        parametri.extend(valori)
+
+    where = f"WHERE {' AND '.join(condizioni)}" if condizioni else ""
+    query = f"""
+        SELECT marca, larghezza, rapporto, diametro, prezzo_unitario, prezzo_treno, disponibilita, note
+        FROM gomme {where}
+        ORDER BY marca, larghezza, rapporto, diametro
+    """
+    return risposta_csv("giacenza_gomme", COLONNE_CSV_GOMME, righe_a_blocchi(query, parametri))
+
+
+def _gomma_json(r):
+    return {
+        "id": r['id'],
+        "marca": r['marca'],
+        "prezzo_unitario": float(r['prezzo_unitario']) if r['prezzo_unitario'] is not None else None,
+        "prezzo_treno": float(r['prezzo_treno']) if r['prezzo_treno'] is not None else None,
+        "disponibilita": r['disponibilita'],
+        "note": r['note'],
+    }
+
+@app.route("/gomme/cerca")
+@login_required
+def cerca_gomme():
+    """
+    Gomme disponibili di una misura (?misura=205/55 R16) in tutte le marche,
+    più le misure alternative a magazzino lette da gomme_misure_equivalenti,
+    dalla più vicina per circonferenza di rotolamento.
+    """
+    misura = leggi_misura(request.args.get("misura"))
+    if not misura:
+        return jsonify({"error": "Misura non valida (es. 205/55 R16)."}), 400
+
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cur.execute("""
+            SELECT id, marca, prezzo_unitario, prezzo_treno, disponibilita, note
+            FROM gomme
+            WHERE larghezza = %s AND rapporto = %s AND diametro = %s AND disponibilita > 0
+            ORDER BY prezzo_unitario, marca
+        """, misura)
+        disponibili = cur.fetchall()
+
+        cur.execute("""
+            SELECT e.scarto, g.larghezza, g.rapporto, g.diametro,
+                   g.id, g.marca, g.prezzo_unitario, g.prezzo_treno, g.disponibilita, g.note
+            FROM gomme_misure_equivalenti e
+            JOIN gomme g ON g.larghezza = e.alt_larghezza
+                        AND g.rapporto = e.alt_rapporto
+                        AND g.diametro = e.alt_diametro
+            WHERE e.larghezza = %s AND e.rapporto = %s AND e.diametro = %s
+              AND g.disponibilita > 0
+            ORDER BY ABS(e.scarto), g.larghezza, g.rapporto, g.diametro, g.prezzo_unitario, g.marca
+        """, misura)
+        alternative = {}
+        for r in cur.fetchall():
+            chiave = f"{r['larghezza']}/{r['rapporto']} R{r['diametro']}"
+            voce = alternative.setdefault(chiave, {
+                "misura": chiave,
+                "scarto_percentuale": round(r['scarto'] * 100, 2),
+                "gomme": [],
+            })
+            voce["gomme"].append(_gomma_json(r))
+    finally:
+        cur.close()
+        conn.close()
 
-    return render_template("giacenza_gomme.html", gomme=gomme)
+    return jsonify({
+        "misura": "{}/{} R{}".format(*misura),
+        "disponibili": [_gomma_json(r) for r in disponibili],
+        "alternative": list(alternative.values()),
+    })
 
 
 @app.route("/modifica_gomma/<int:id>", methods=["POST"])
@@ -2127,7 +5633,7 @@ def inserisci_gommeclienti():
     if request.method == 'POST':
         nome = request.form.get('nome')
         cognome = request.form.get('cognome')
-        targa = request.form.get('targa').strip().upper()
+        targa = normalizza_targa(request.form.get('targa'))
         data_inizio = request.form.get('data_inizio')
         marca = request.form.get('marca')
         larghezza = request.form.get('larghezza')
@@ -2158,12 +5664,138 @@ def inserisci_gommeclienti():
 @app.route('/giacenza_gommeclienti')
 @login_required
 def giacenza_gommeclienti():
+    # ?targa= (anche parziale, in qualsiasi formato) filtra sull'indice di targa_norm
+    targa = normalizza_targa(request.args.get('targa'))
+    where, parametri = ("WHERE targa_norm LIKE %s", [targa + "%"]) if targa else ("", [])
+    gomme_clienti = righe_a_blocchi(
+        f"SELECT * FROM gomme_clienti {where} ORDER BY data_inizio DESC, id DESC", parametri
+    )
+    return stream_template('giacenza_gommeclienti.html', gomme_clienti=gomme_clienti, targa=targa)
+
+# =====================================
+# PIANIFICAZIONE CAMBIO STAGIONALE (gomme in deposito)
+# =====================================
+# Treni per pagina e età minima del deposito (mesi) proposta di default
+PIANIFICAZIONE_PAGINA = 50
+PIANIFICAZIONE_MESI = 4
+# cambio → stagione in cui sono state lasciate le gomme da rimontare
+CAMBI_STAGIONALI = {"primavera": "autunno", "autunno": "primavera"}
+# ordine di pagina (e della lista chiamate), coperto da idx_gomme_clienti_pianificazione
+_ORDINE_PIANIFICAZIONE = "LOWER(COALESCE(cognome, '')), targa_norm, id"
+
+COLONNE_CSV_PIANIFICAZIONE = [
+    ("Cognome", "cognome"), ("Nome", "nome"), ("Targa", "targa"), ("Cellulare", "cellulare"),
+    ("In deposito dal", "data_inizio"),
+    ("Marca", "marca"), ("Larghezza", "larghezza"), ("Rapporto", "rapporto"), ("Diametro", "diametro"),
+    ("Note", "note"),
+]
+
+def _filtri_pianificazione(args):
+    """
+    Condizioni SQL del piano di cambio: ?cambio=primavera|autunno (default il
+    prossimo), ?mesi (età minima del deposito), ?targa (anche parziale).
+    Restituisce (condizioni, parametri, filtri normalizzati per i link).
+    """
+    oggi = now_ita().date()
+    cambio = args.get('cambio') or ("primavera" if oggi.month <= 6 else "autunno")
+    if cambio not in CAMBI_STAGIONALI:
+        abort(400, description="Cambio non valido (primavera o autunno).")
+    mesi = max(args.get('mesi', PIANIFICAZIONE_MESI, type=int), 0)
+    anno, mese = divmod(oggi.year * 12 + oggi.month - 1 - mesi, 12)
+    depositato_entro = date(anno, mese + 1, min(oggi.day, 28))
+
+    condizioni = ["stagione_deposito = %s", "data_inizio <= %s"]
+    parametri = [CAMBI_STAGIONALI[cambio], depositato_entro]
+    filtri = {"cambio": cambio, "mesi": mesi}
+    targa = normalizza_targa(args.get('targa'))
+    if targa:
+        condizioni.append("targa_norm LIKE %s")
+        parametri.append(targa + "%")
+        filtri["targa"] = targa
+    return condizioni, parametri, filtri
+
+def _cursore_pianificazione(valore):
+    """Il cursore è la chiave d'ordine [cognome, targa, id] dell'ultima riga vista, in JSON."""
+    try:
+        chiave = json.loads(valore)
+        # un cursore manomesso deve dare 400, non un errore di tipo nella query
+        if not (isinstance(chiave, list) and len(chiave) == 3
+                and isinstance(chiave[0], str) and isinstance(chiave[1], str)
+                and isinstance(chiave[2], int) and not isinstance(chiave[2], bool)):
+            raise ValueError
+        return chiave
+    except ValueError:
+        abort(400, description="Cursore non valido")
+
+@app.route('/gomme_clienti/pianificazione')
+@login_required
+def pianificazione_gomme():
+    """
+    Treni in deposito da rimontare al cambio stagionale, a pagine per
+    cognome e targa (paginazione per chiave, parametro 'cursore').
+    """
+    condizioni, parametri, filtri = _filtri_pianificazione(request.args)
+    cursore = _cursore_pianificazione(request.args['cursore']) if request.args.get('cursore') else None
+
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT * FROM gomme_clienti ORDER BY data_inizio DESC")
-    gomme_clienti = cur.fetchall()
-    conn.close()
-    return render_template('giacenza_gommeclienti.html', gomme_clienti=gomme_clienti)
+    try:
+        cur.execute(f"SELECT COUNT(*) AS totale FROM gomme_clienti WHERE {' AND '.join(condizioni)}", parametri)
+        totale = cur.fetchone()['totale']
+
+        if cursore:
+            condizioni = condizioni + [f"({_ORDINE_PIANIFICAZIONE}) > (%s, %s, %s)"]
+            parametri = parametri + cursore
+        # una riga in più per sapere se esiste una pagina successiva
+        cur.execute(f"""
+            SELECT id, nome, cognome, targa, targa_norm, data_inizio, marca, larghezza, rapporto, diametro, note,
+                   LOWER(COALESCE(cognome, '')) AS chiave_cognome
+            FROM gomme_clienti
+            WHERE {' AND '.join(condizioni)}
+            ORDER BY {_ORDINE_PIANIFICAZIONE}
+            LIMIT %s
+        """, parametri + [PIANIFICAZIONE_PAGINA + 1])
+        righe = cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
+
+    successivo = None
+    if len(righe) > PIANIFICAZIONE_PAGINA:
+        righe = righe[:PIANIFICAZIONE_PAGINA]
+        ultima = righe[-1]
+        successivo = json.dumps([ultima['chiave_cognome'], ultima['targa_norm'], ultima['id']])
+
+    return render_template(
+        'pianificazione_gomme.html',
+        gomme=righe,
+        totale=totale,
+        filtri=filtri,
+        cursore_successivo=successivo,
+        prima_pagina=cursore is None
+    )
+
+@app.route('/gomme_clienti/pianificazione/esporta')
+@login_required
+def esporta_pianificazione_gomme():
+    """
+    Lista chiamate del cambio stagionale: stessi filtri della pagina, un'unica
+    query letta a blocchi. Il cellulare è quello del cliente della vettura con
+    la stessa targa, se registrata dall'utente.
+    """
+    condizioni, parametri, filtri = _filtri_pianificazione(request.args)
+    query = f"""
+        SELECT cognome, nome, targa,
+               (SELECT c.cellulare FROM vetture v JOIN clienti c ON c.id = v.cliente_id
+                WHERE v.targa_norm = gomme_clienti.targa_norm AND v.utente_id = %s
+                ORDER BY v.id DESC LIMIT 1) AS cellulare,
+               data_inizio, marca, larghezza, rapporto, diametro, note
+        FROM gomme_clienti
+        WHERE {' AND '.join(condizioni)}
+        ORDER BY {_ORDINE_PIANIFICAZIONE}
+    """
+    return risposta_csv(f"cambio_{filtri['cambio']}", COLONNE_CSV_PIANIFICAZIONE,
+                        righe_a_blocchi(query, [session['user_id']] + parametri))
 
 @app.route('/modifica_gommeclienti/<int:id>', methods=['GET', 'POST'])
 @login_required
@@ -2187,7 +5819,7 @@ def modifica_gommeclienti(id):
     if request.method == 'POST':
         nome = request.form.get('nome')
         cognome = request.form.get('cognome')
-        targa = request.form.get('targa').strip().upper()
+        targa = normalizza_targa(request.form.get('targa'))
         data_inizio = request.form.get('data_inizio')
         marca = request.form.get('marca')
         larghezza = request.form.get('larghezza')
@@ -2235,7 +5867,11 @@ def lista_promemoria():
     """
     Restituisce in formato JSON la lista dei promemoria
     visibili all'utente corrente (o a tutti se è accettazione).
+    Risponde 304 se il client ha già la versione corrente.
     """
+    return risposta_condizionale(("promemoria",), _promemoria_json)
+
+def _promemoria_json():
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
@@ -2349,28 +5985,124 @@ def elimina_promemoria(id):
 # =====================================
 # STORICO (route già definita con log_storico)
 # =====================================
+# Righe per pagina dello storico (per_pagina non può superare STORICO_PAGINA_MAX)
+STORICO_PAGINA = 50
+STORICO_PAGINA_MAX = 200
+# Filtri accettati dalla querystring di /storico
+FILTRI_STORICO = ('utente', 'tabella', 'record_id', 'dal', 'al', 'testo', 'per_pagina')
+
 @app.route('/storico')
 @login_required
 def storico():
+    """
+    Storico azioni paginato per chiave (data_ora, id): il parametro 'cursore'
+    indica l'ultima riga già vista, quindi ogni pagina costa come la prima
+    anche molto indietro nel tempo. Filtri: utente, tabella, record_id,
+    dal/al (YYYY-MM-DD), testo (contenuto in azione).
+    """
+    # --- Se richiesta AJAX, restituisci JSON (304 se invariato) ---
+    if request.args.get('ajax') in ['1', 'true']:
+        def genera():
+            righe, successivo = _leggi_storico(request.args)
+            return jsonify({"voci": _formatta_storico(righe), "cursore_successivo": successivo})
+        return risposta_condizionale(("storico_azioni",), genera)
+
+    # --- Rendering pagina dedicata ---
+    righe, successivo = _leggi_storico(request.args)
+    filtri = {k: v for k, v in request.args.items() if k in FILTRI_STORICO and v}
+    return render_template(
+        'storico.html',
+        storico=righe,
+        filtri=filtri,
+        cursore_successivo=successivo,
+        prima_pagina=not request.args.get('cursore')
+    )
+
+def _data_filtro(valore, giorni=0):
+    # inizio del giorno (ora italiana) come timestamp confrontabile con data_ora
+    try:
+        giorno = date.fromisoformat(valore) + timedelta(days=giorni)
+    except ValueError:
+        abort(400, description=f"Data non valida: {valore}")
+    return inizio_giorno(giorno)
+
+def _filtri_storico(cur, args, dal=None, al=None):
+    """Traduce i filtri della querystring in condizioni SQL su storico_azioni."""
+    condizioni, parametri = [], []
+
+    utente = (args.get('utente') or '').strip()
+    if utente:
+        # le azioni possono riferirsi all'utente per id o solo per nome
+        cur.execute("SELECT id FROM utenti WHERE LOWER(username) = LOWER(%s)", (utente,))
+        trovato = cur.fetchone()
+        condizioni.append("(s.id_utente = %s OR s.utente = %s)")
+        parametri.extend([trovato['id'] if trovato else None, utente])
+
+    tabella = (args.get('tabella') or '').strip()
+    if tabella:
+        condizioni.append("s.tabella_nome = %s")
+        parametri.append(tabella)
+
+    record_id = args.get('record_id', type=int)
+    if record_id is not None:
+        condizioni.append("s.record_id = %s")
+        parametri.append(record_id)
+
+    if dal:
+        condizioni.append("s.data_ora >= %s")
+        parametri.append(dal)
+    if al:
+        condizioni.append("s.data_ora < %s")
+        parametri.append(al)
+
+    testo = (args.get('testo') or '').strip()
+    if testo:
+        condizioni.append("s.azione ILIKE %s ESCAPE '\\'")
+        parametri.append(pattern_contiene(testo))
+
+    return condizioni, parametri
+
+def _cursore_storico(valore):
+    """Il cursore è '<data_ora ISO>_<id>' dell'ultima riga della pagina precedente."""
+    try:
+        data_ora, _, id_riga = valore.rpartition("_")
+        return datetime.fromisoformat(data_ora), int(id_riga)
+    except ValueError:
+        abort(400, description="Cursore non valido")
+
+def _leggi_storico(args):
+    """Restituisce (righe della pagina, cursore della pagina successiva o None)."""
+    per_pagina = min(max(args.get('per_pagina', STORICO_PAGINA, type=int), 1), STORICO_PAGINA_MAX)
+    # cursore e date non validi → 400 prima di toccare il database
+    cursore = _cursore_storico(args['cursore']) if args.get('cursore') else None
+    intervallo = [_data_filtro(args[k], giorni=g) if args.get(k) else None for k, g in (('dal', 0), ('al', 1))]
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
-        cur.execute("""
+        condizioni, parametri = _filtri_storico(cur, args, *intervallo)
+        if cursore:
+            condizioni.append("(s.data_ora, s.id) < (%s, %s)")
+            parametri.extend(cursore)
+        where = f"WHERE {' AND '.join(condizioni)}" if condizioni else ""
+
+        # una riga in più per sapere se esiste una pagina successiva
+        cur.execute(f"""
             SELECT 
                 s.id,
                 s.id_utente,
-                COALESCE(u.username, 'Sistema') AS username,
+                COALESCE(u.username, s.utente, 'Sistema') AS username,
                 s.tabella_nome,
                 s.record_id,
                 s.azione,
                 s.data_ora
             FROM storico_azioni s
             LEFT JOIN utenti u ON s.id_utente = u.id
-            ORDER BY s.data_ora DESC
-            LIMIT 200
-        """)
+            {where}
+            ORDER BY s.data_ora DESC, s.id DESC
+            LIMIT %s
+        """, parametri + [per_pagina + 1])
         storico_rows = cur.fetchall() or []
 
     except Exception as e:
@@ -2380,39 +6112,73 @@ def storico():
         if conn:
             conn.close()
 
-    # --- Se richiesta AJAX, restituisci JSON ---
-    if request.args.get('ajax') in ['1', 'true']:
-        formatted = []
-        for row in storico_rows:
-            formatted.append({
-                'id': row.get('id'),
-                'username': row.get('username') or 'Sistema',
-                'tabella_nome': row.get('tabella_nome') or '',
-                'record_id': row.get('record_id') or '',
-                'azione': row.get('azione') or '',
-                'data_ora': row.get('data_ora').strftime('%Y-%m-%d %H:%M:%S') if row.get('data_ora') else ''
-            })
-        return jsonify(formatted)
-
-    # --- Rendering pagina dedicata ---
-    return render_template('storico.html', storico=storico_rows)
+    successivo = None
+    if len(storico_rows) > per_pagina:
+        storico_rows = storico_rows[:per_pagina]
+        ultima = storico_rows[-1]
+        if ultima['data_ora']:
+            successivo = f"{ultima['data_ora'].isoformat()}_{ultima['id']}"
+    return storico_rows, successivo
+
+def _formatta_storico(storico_rows):
+    formatted = []
+    for row in storico_rows:
+        formatted.append({
+            'id': row.get('id'),
+            'username': row.get('username') or 'Sistema',
+            'tabella_nome': row.get('tabella_nome') or '',
+            'record_id': row.get('record_id') or '',
+            'azione': row.get('azione') or '',
+            'data_ora': row.get('data_ora').strftime('%Y-%m-%d %H:%M:%S') if row.get('data_ora') else ''
+        })
+    return formatted
 
 # =====================================
 # ORDINI RICAMBI - ROUTE ESSENZIALI
 # =====================================
 
 # ========== 1) GIACENZA ORDINI ==========
+# colonne filtrabili (pagina ed esportazione CSV)
+FILTRI_ORDINI = ("prodotto", "codice", "targa", "cliente", "fornitore")
+
 @app.route("/ordini/giacenza")
 @login_required
 def giacenza_ordini():
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
-    cur.execute("SELECT * FROM ordini_magazzino ORDER BY id DESC")
-    ordini = cur.fetchall()
+    cur.execute("SELECT 1 FROM ordini_magazzino LIMIT 1")
+    presenti = cur.fetchone() is not None
+    # opzioni delle tendine dei filtri
+    filtri = {campo: valori_distinti(cur, "ordini_magazzino", campo) for campo in FILTRI_ORDINI}
 
     conn.close()
-    return render_template("giacenza_ordini.html", ordini=ordini)
+    ordini = righe_a_blocchi("SELECT * FROM ordini_magazzino ORDER BY id DESC")
+    return stream_template("giacenza_ordini.html", ordini=ordini, presenti=presenti, filtri=filtri)
+
+COLONNE_CSV_ORDINI = [
+    ("ID", "id"), ("Prodotto", "prodotto"), ("Codice", "codice"), ("Targa", "targa"),
+    ("Cliente", "cliente"), ("Fornitore", "fornitore"), ("Stato", "stato"), ("Inserito il", "data_creazione"),
+]
+
+@app.route("/ordini/esporta")
+@login_required
+def esporta_ordini():
+    """Esporta gli ordini; i filtri (testo contenuto, come nella pagina) arrivano in query string."""
+    condizioni, parametri = [], []
+    for campo in FILTRI_ORDINI:
+        valore = request.args.get(campo, "").strip()
+        if valore:
+            condizioni.append(f"{campo} ILIKE %s ESCAPE '\\'")
+            parametri.append(pattern_contiene(valore))
+    stato = request.args.get("stato", "").strip()
+    if stato:
+        condizioni.append("stato = %s")
+        parametri.append(stato)
+
+    where = f"WHERE {' AND '.join(condizioni)}" if condizioni else ""
+    query = f"SELECT * FROM ordini_magazzino {where} ORDER BY id DESC"
+    return risposta_csv("ordini", COLONNE_CSV_ORDINI, righe_a_blocchi(query, parametri))
 
 
 
@@ -2437,7 +6203,13 @@ def salva_ordine_ricambi():
     stato = request.form.get("stato")
 
     conn = get_db_connection()
-    cur = conn.cursor()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+
+    # cliente non indicato: quello della vettura con la stessa targa
+    if not (cliente or "").strip():
+        vettura = vettura_per_targa(cur, targa, session['user_id'])
+        if vettura:
+            cliente = " ".join(p for p in (vettura['cliente_nome'], vettura['cliente_cognome']) if p)
 
     # ⭐ Inserisce anche il campo fornitore e la data italiana
     cur.execute("""
@@ -2446,7 +6218,7 @@ def salva_ordine_ricambi():
         RETURNING id
     """, (prodotto, codice, targa, cliente, fornitore, stato, now_ita()))
 
-    nuovo_id = cur.fetchone()[0]
+    nuovo_id = cur.fetchone()['id']
 
     conn.commit()
     conn.close()
@@ -2462,71 +6234,607 @@ def salva_ordine_ricambi():
     flash("Ordine inserito correttamente!", "success")
     return redirect(url_for("giacenza_ordini"))
 
-# ========== 4) CAMBIO STATO DIRETTO (DA GIACENZA) ==========
-@app.route("/ordini/cambia_stato/<int:id>/<string:nuovo_stato>")
-@login_required
-def cambia_stato_ordine(id, nuovo_stato):
+# ========== 4) CAMBIO STATO DIRETTO (DA GIACENZA) ==========
+@app.route("/ordini/cambia_stato/<int:id>/<string:nuovo_stato>")
+@login_required
+def cambia_stato_ordine(id, nuovo_stato):
+
+    # REGOLE STATO
+    stati_permesi = [
+        "Ordine Inviato",
+        "Ordine Arrivato",
+        "Appuntamento Fissato",
+        "In Stock"
+    ]
+
+    if nuovo_stato not in stati_permesi:
+        flash("Stato non valido.", "error")
+        return redirect(url_for("giacenza_ordino"))
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+
+    cur.execute("""
+        UPDATE ordini_magazzino
+        SET stato = %s
+        WHERE id = %s
+    """, (nuovo_stato, id))
+
+    conn.commit()
+    conn.close()
+
+    # 🔥 STORICO — CAMBIO STATO
+    log_storico(
+        user_id=session.get("user_id"),
+        azione=f"Cambio stato ordine → {nuovo_stato}",
+        tabella="ordini_magazzino",
+        record_id=id
+    )
+
+    flash("Stato aggiornato!", "success")
+    return redirect(url_for("giacenza_ordini"))
+
+
+
+# ========== 5) ELIMINA ORDINE ==========
+@app.route("/ordini/elimina/<int:id>")
+@login_required
+def elimina_ordine(id):
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+
+    cur.execute("DELETE FROM ordini_magazzino WHERE id = %s", (id,))
+
+    conn.commit()
+    conn.close()
+
+    # 🔥 STORICO — ELIMINAZIONE
+    log_storico(
+        user_id=session.get("user_id"),
+        azione="Eliminazione ordine magazzino",
+        tabella="ordini_magazzino",
+        record_id=id
+    )
+
+    flash("Ordine eliminato!", "success")
+    return redirect(url_for("giacenza_ordini"))
+# =====================================
+# STORAGE OGGETTI (Supabase o disco locale)
+# =====================================
+# Le foto passano tutte da storage_foto: stessa interfaccia (carica, esiste,
+# elimina, elenca, url) per il bucket Supabase e per una cartella locale,
+# usata offline e nei test (STORAGE_BACKEND=locale).
+import requests.adapters
+
+# Un database locale usa lo storage locale: il bucket di produzione va confrontato
+# solo con il database di produzione (la pulizia eliminerebbe le sue foto)
+STORAGE_BACKEND = (os.environ.get("STORAGE_BACKEND") or ("locale" if DB_BACKEND == "sqlite" else "supabase")).strip().lower()
+if STORAGE_BACKEND not in ("supabase", "locale"):
+    raise RuntimeError(f"❌ ERRORE: STORAGE_BACKEND non valido: '{STORAGE_BACKEND}' (usa 'supabase' o 'locale')")
+if STORAGE_BACKEND == "supabase" and DB_BACKEND == "sqlite" and os.environ.get("STORAGE_SUPABASE_CON_SQLITE") != "1":
+    raise RuntimeError(
+        "❌ ERRORE: STORAGE_BACKEND=supabase con DB_BACKEND=sqlite collega un database locale al bucket reale; "
+        "se è voluto imposta anche STORAGE_SUPABASE_CON_SQLITE=1"
+    )
+STORAGE_LOCALE_PATH = os.environ.get("STORAGE_LOCALE_PATH") or os.path.join(os.path.dirname(__file__), "storage_locale")
+
+
+class StorageSupabase:
+    """Bucket Supabase via API REST, su una sessione HTTP condivisa (connessioni keep-alive)."""
+
+    def __init__(self, url, chiave, bucket, connessioni):
+        self._oggetti = f"{url}/storage/v1/object"
+        self._pubblico = f"{url}/storage/v1/object/public/{bucket}"
+        self._bucket = bucket
+        self._sessione = requests.Session()
+        self._sessione.headers["Authorization"] = f"Bearer {chiave}"
+        adattatore = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connessioni)
+        self._sessione.mount("https://", adattatore)
+        self._sessione.mount("http://", adattatore)
+
+    def url(self, nome):
+        return f"{self._pubblico}/{nome}"
+
+    def carica(self, nome, dati, content_type):
+        res = self._sessione.post(
+            f"{self._oggetti}/{self._bucket}/{nome}",
+            headers={"Content-Type": content_type, "x-upsert": "true"},
+            data=dati,
+            timeout=30
+        )
+        if res.status_code not in (200, 201):
+            raise RuntimeError(f"upload di {nome} fallito: HTTP {res.status_code} {res.text[:200]}")
+
+    def esiste(self, nome):
+        res = self._sessione.head(f"{self._oggetti}/{self._bucket}/{nome}", timeout=30)
+        if res.status_code == 200:
+            return True
+        # lo storage risponde 400 o 404 per gli oggetti assenti
+        if res.status_code in (400, 404):
+            return False
+        raise RuntimeError(f"controllo di {nome} fallito: HTTP {res.status_code}")
+
+    def elimina(self, nomi):
+        """Elimina i file indicati; quelli già assenti non sono un errore."""
+        res = self._sessione.delete(
+            f"{self._oggetti}/{self._bucket}",
+            json={"prefixes": list(nomi)},
+            timeout=30
+        )
+        if res.status_code not in (200, 204, 404):
+            raise RuntimeError(f"eliminazione fallita: HTTP {res.status_code} {res.text[:200]}")
+
+    def elenca(self, blocco=1000):
+        """Genera (nome, data di creazione) per ogni file del bucket, leggendo l'elenco a pagine."""
+        offset = 0
+        while True:
+            res = self._sessione.post(
+                f"{self._oggetti}/list/{self._bucket}",
+                json={"prefix": "", "limit": blocco, "offset": offset,
+                      "sortBy": {"column": "name", "order": "asc"}},
+                timeout=30
+            )
+            if res.status_code != 200:
+                raise RuntimeError(f"elenco del bucket fallito: HTTP {res.status_code} {res.text[:200]}")
+            oggetti = res.json()
+            for oggetto in oggetti:
+                if oggetto.get("id") is None:
+                    continue   # cartella, non un file
+                yield oggetto["name"], datetime.fromisoformat(oggetto["created_at"])
+            if len(oggetti) < blocco:
+                return
+            offset += blocco
+
+
+class StorageLocale:
+    """Cartella su disco con la stessa interfaccia di StorageSupabase; i file sono serviti da /foto_locali."""
+
+    def __init__(self, percorso):
+        self._percorso = percorso
+        os.makedirs(percorso, exist_ok=True)
+
+    def url(self, nome):
+        return f"/foto_locali/{nome}"
+
+    def _file(self, nome):
+        return os.path.join(self._percorso, os.path.basename(nome))
+
+    def carica(self, nome, dati, content_type):
+        # scrittura atomica: chi legge vede il file vecchio o quello completo
+        fd, temporaneo = tempfile.mkstemp(dir=self._percorso, prefix=".carica-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(dati)
+        os.replace(temporaneo, self._file(nome))
+
+    def esiste(self, nome):
+        return os.path.isfile(self._file(nome))
+
+    def elimina(self, nomi):
+        for nome in nomi:
+            try:
+                os.remove(self._file(nome))
+            except FileNotFoundError:
+                pass
+
+    def elenca(self):
+        with os.scandir(self._percorso) as voci:
+            for voce in voci:
+                if voce.is_file() and not voce.name.startswith("."):
+                    yield voce.name, datetime.fromtimestamp(voce.stat().st_mtime, pytz.utc)
+
+
+def _crea_storage():
+    if STORAGE_BACKEND == "locale":
+        return StorageLocale(STORAGE_LOCALE_PATH)
+    # una connessione per thread di coda_storage più qualcuna di scorta
+    return StorageSupabase(SUPABASE_URL, SUPABASE_KEY, FOTO_BUCKET, connessioni=STORAGE_WORKER + 2)
+
+
+@app.route("/foto_locali/<nome>")
+def foto_locale(nome):
+    """File dello storage locale (solo con STORAGE_BACKEND=locale)."""
+    if STORAGE_BACKEND != "locale":
+        abort(404)
+    # nomi ricavati dal contenuto: un file non cambia mai, il browser può tenerlo
+    return send_from_directory(STORAGE_LOCALE_PATH, nome, max_age=365 * 24 * 3600)
+
+# =====================================
+# FOTO MAGAZZINO E LAVORI STORAGE (in background)
+# =====================================
+# Le foto arrivano dal telefono: anche 5-10 MB, spesso ruotate via EXIF.
+# Vengono decodificate una volta sola, raddrizzate e salvate come originale
+# ridimensionato (JPEG) più una variante media e una miniatura WebP.
+# I nomi dei file derivano dall'hash della foto caricata: la stessa foto
+# caricata due volte non viene né rielaborata né ricaricata.
+# Nessuna chiamata allo storage parte dalla richiesta: le route scrivono un
+# lavoro in lavori_storage nella stessa transazione della riga magazzino e
+# i thread di coda_storage lo eseguono, con nuovi tentativi e backoff.
+# Un lavoro 'pulizia' periodico elimina i file del bucket non più collegati.
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+FOTO_BUCKET = "foto_magazzino"
+# Lato massimo (px) dell'originale conservato e delle varianti WebP
+FOTO_LATO_MAX = int(os.environ.get("FOTO_LATO_MAX", 2000))
+FOTO_VARIANTI = (("media", 800), ("miniatura", 240))
+FOTO_QUALITA_JPEG = 85
+FOTO_QUALITA_WEBP = 80
+# Entra nell'hash dei nomi: cambiando i parametri le foto vengono rigenerate
+_FOTO_PARAMETRI = f"{FOTO_LATO_MAX}|{FOTO_VARIANTI}|{FOTO_QUALITA_JPEG}|{FOTO_QUALITA_WEBP}".encode()
+
+# Thread che eseguono i lavori (Pillow rilascia il GIL durante decodifica e codifica)
+STORAGE_WORKER = int(os.environ.get("STORAGE_WORKER", 2))
+# Ogni quanti secondi i thread controllano la tabella se nessuno li sveglia
+STORAGE_INTERVALLO = float(os.environ.get("STORAGE_INTERVALLO", 30))
+# Un lavoro preso in carico e mai concluso (processo terminato) torna disponibile dopo questo tempo
+STORAGE_LEASE = timedelta(minutes=5)
+STORAGE_TENTATIVI_MAX = 8
+# Attesa prima del tentativo n: base * 2^(n-1), fino al massimo
+STORAGE_ATTESA_BASE = 30
+STORAGE_ATTESA_MAX = 3600
+# Pulizia dei file orfani: ogni quante ore, e quanto deve essere vecchio un file per essere toccato
+STORAGE_PULIZIA_ORE = float(os.environ.get("STORAGE_PULIZIA_ORE", 24))
+STORAGE_PULIZIA_MARGINE = timedelta(hours=24)
+# La pulizia automatica non elimina nulla se gli orfani superano questa quota
+# del bucket (oltre STORAGE_PULIZIA_MINIMO file): più facile un database sbagliato
+# che tante foto perse. In quel caso serve `flask pulizia-foto --esegui --forza`.
+STORAGE_PULIZIA_QUOTA_MAX = float(os.environ.get("STORAGE_PULIZIA_QUOTA_MAX", 0.2))
+STORAGE_PULIZIA_MINIMO = 20
+# File per singolo lavoro di eliminazione (una chiamata all'API)
+STORAGE_ELIMINA_BLOCCO = 100
+
+storage_foto = _crea_storage()
+
+
+def _nome_oggetto(url):
+    """Nome del file nel bucket a partire dall'URL pubblico salvato in magazzino."""
+    return url.split("/")[-1]
+
+
+def foto_valida(dati):
+    """Controllo rapido nella richiesta: legge solo l'intestazione, non decodifica i pixel."""
+    try:
+        with Image.open(io.BytesIO(dati)) as img:
+            return img.format is not None
+    except (UnidentifiedImageError, OSError):
+        return False
+
+
+def elabora_foto(dati):
+    """
+    Decodifica la foto una volta, la raddrizza secondo l'EXIF e restituisce
+    {variante: (byte, estensione, content type)} con 'originale' (JPEG) e
+    le varianti di FOTO_VARIANTI (WebP), ognuna ricavata dalla precedente.
+    """
+    with Image.open(io.BytesIO(dati)) as img:
+        # sui JPEG la decodifica scalata evita di espandere tutti i pixel
+        img.draft("RGB", (FOTO_LATO_MAX, FOTO_LATO_MAX))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+
+    img.thumbnail((FOTO_LATO_MAX, FOTO_LATO_MAX), Image.LANCZOS)
+    uscita = io.BytesIO()
+    img.save(uscita, "JPEG", quality=FOTO_QUALITA_JPEG, optimize=True, progressive=True)
+    risultato = {"originale": (uscita.getvalue(), "jpg", "image/jpeg")}
+
+    for nome, lato in FOTO_VARIANTI:
+        img.thumbnail((lato, lato), Image.LANCZOS)
+        uscita = io.BytesIO()
+        img.save(uscita, "WEBP", quality=FOTO_QUALITA_WEBP, method=4)
+        risultato[nome] = (uscita.getvalue(), "webp", "image/webp")
+    return risultato
+
+
+# ---------------------------------------
+# Accodamento (nella transazione del chiamante)
+# ---------------------------------------
+def accoda_lavoro_storage(cur, tipo, magazzino_id=None, oggetti=None, dati=None):
+    """Scrive un lavoro in lavori_storage: parte solo se il chiamante fa commit."""
+    adesso = now_ita()
+    cur.execute("""
+        INSERT INTO lavori_storage (tipo, magazzino_id, oggetti, dati, tentativi, prossimo_tentativo, creato)
+        VALUES (%s, %s, %s, %s, 0, %s, %s)
+    """, (tipo, magazzino_id, json.dumps(oggetti) if oggetti else None, dati, adesso, adesso))
+
+
+def accoda_eliminazione_foto(cur, *urls):
+    """Accoda l'eliminazione dei file indicati per URL (i None vengono ignorati)."""
+    nomi = [_nome_oggetto(url) for url in urls if url]
+    for i in range(0, len(nomi), STORAGE_ELIMINA_BLOCCO):
+        accoda_lavoro_storage(cur, "elimina", oggetti=nomi[i:i + STORAGE_ELIMINA_BLOCCO])
+
+
+def accoda_foto_magazzino(cur, magazzino_id, dati):
+    """Accoda l'elaborazione della foto caricata; quelle precedenti non ancora elaborate vengono annullate."""
+    cur.execute("DELETE FROM lavori_storage WHERE tipo = 'foto_magazzino' AND magazzino_id = %s", (magazzino_id,))
+    accoda_lavoro_storage(cur, "foto_magazzino", magazzino_id=magazzino_id, dati=dati)
+
+
+# ---------------------------------------
+# Esecuzione dei lavori
+# ---------------------------------------
+def _blocca_storage(cur):
+    # collegamento di una foto e controllo prima di eliminarla vanno serializzati:
+    # i file sono condivisi tra righe con la stessa foto. Su SQLite basta che la
+    # prima istruzione della transazione sia una scrittura (un solo scrittore).
+    if DB_BACKEND == "postgres":
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (_LOCK_STORAGE,))
+
+
+def nomi_foto(dati):
+    """Nomi dei file di originale e varianti, ricavati dall'hash della foto caricata."""
+    base = hashlib.sha256(_FOTO_PARAMETRI + dati).hexdigest()
+    nomi = {"originale": f"{base}.jpg"}
+    nomi.update((variante, f"{base}_{variante}.webp") for variante, _ in FOTO_VARIANTI)
+    return nomi
+
+
+def _lavoro_foto_magazzino(conn, lavoro):
+    """Elabora e carica le varianti (se mancano), poi le collega alla riga e accoda l'eliminazione delle precedenti."""
+    magazzino_id = lavoro["magazzino_id"]
+    dati = bytes(lavoro["dati"])
+    nomi = nomi_foto(dati)
+    # foto già caricata (anche per un altro ricambio): niente da elaborare né caricare
+    if not all(storage_foto.esiste(nome) for nome in nomi.values()):
+        for variante, (contenuto, _, content_type) in elabora_foto(dati).items():
+            storage_foto.carica(nomi[variante], contenuto, content_type)
+    urls = {variante: storage_foto.url(nome) for variante, nome in nomi.items()}
+
+    cur = conn.cursor()
+    # se la riga del lavoro non c'è più è stato annullato (nuova foto o ricambio eliminato)
+    cur.execute("DELETE FROM lavori_storage WHERE id = %s", (lavoro["id"],))
+    if cur.rowcount == 0:
+        accoda_eliminazione_foto(cur, *urls.values())
+        conn.commit()
+        return
+    _blocca_storage(cur)
+    # un'eliminazione conclusa dopo il controllo iniziale: si ricarica al prossimo tentativo
+    mancanti = [nome for nome in nomi.values() if not storage_foto.esiste(nome)]
+    if mancanti:
+        raise RuntimeError(f"file eliminati durante l'elaborazione: {', '.join(mancanti)}")
+    cur.execute(
+        "SELECT foto, foto_media, foto_miniatura FROM magazzino WHERE id = %s FOR UPDATE",
+        (magazzino_id,)
+    )
+    precedenti = cur.fetchone()
+    if precedenti:
+        cur.execute("""
+            UPDATE magazzino SET foto = %s, foto_media = %s, foto_miniatura = %s
+            WHERE id = %s
+        """, (urls["originale"], urls["media"], urls["miniatura"], magazzino_id))
+        accoda_eliminazione_foto(cur, *(set(precedenti) - set(urls.values())))
+    else:
+        # riga eliminata nel frattempo: le foto servono solo se collegate altrove
+        accoda_eliminazione_foto(cur, *urls.values())
+    conn.commit()
+
 
-    # REGOLE STATO
-    stati_permesi = [
-        "Ordine Inviato",
-        "Ordine Arrivato",
-        "Appuntamento Fissato",
-        "In Stock"
-    ]
+def _lavoro_elimina(conn, lavoro):
+    nomi = json.loads(lavoro["oggetti"])
+    cur = conn.cursor()
+    cur.execute("DELETE FROM lavori_storage WHERE id = %s", (lavoro["id"],))
+    _blocca_storage(cur)
+    # un file può essere ancora collegato a un'altra riga con la stessa foto
+    urls = [storage_foto.url(nome) for nome in nomi]
+    segnaposti = ", ".join(["%s"] * len(urls))
+    cur.execute(f"""
+        SELECT foto, foto_media, foto_miniatura FROM magazzino
+        WHERE foto IN ({segnaposti}) OR foto_media IN ({segnaposti}) OR foto_miniatura IN ({segnaposti})
+    """, urls * 3)
+    collegati = {_nome_oggetto(url) for riga in cur.fetchall() for url in riga if url}
+    da_eliminare = [nome for nome in nomi if nome not in collegati]
+    if da_eliminare:
+        storage_foto.elimina(da_eliminare)
+    # commit dopo l'eliminazione: se fallisce il lavoro torna in tabella per un nuovo tentativo
+    conn.commit()
 
-    if nuovo_stato not in stati_permesi:
-        flash("Stato non valido.", "error")
-        return redirect(url_for("giacenza_ordino"))
 
-    conn = get_db_connection()
+def foto_orfane(conn):
+    """
+    Nomi dei file del bucket non collegati a nessuna riga di magazzino né già
+    in coda per l'eliminazione. I file più recenti di STORAGE_PULIZIA_MARGINE
+    sono esclusi: possono appartenere a un lavoro foto non ancora concluso.
+    Restituisce (orfane, motivo): motivo è None se eliminarle è sicuro,
+    altrimenti spiega perché la pulizia va confermata a mano.
+    """
     cur = conn.cursor()
+    cur.execute("""
+        SELECT foto, foto_media, foto_miniatura FROM magazzino
+        WHERE foto IS NOT NULL OR foto_media IS NOT NULL OR foto_miniatura IS NOT NULL
+    """)
+    righe_con_foto = 0
+    collegati = set()
+    for riga in cur:
+        righe_con_foto += 1
+        collegati.update(_nome_oggetto(url) for url in riga if url)
+    cur.execute("SELECT oggetti FROM lavori_storage WHERE tipo = 'elimina'")
+    collegati.update(nome for (oggetti,) in cur for nome in json.loads(oggetti))
+    cur.close()
+
+    limite = now_ita() - STORAGE_PULIZIA_MARGINE
+    orfane, totale = [], 0
+    for nome, creato in storage_foto.elenca():
+        totale += 1
+        if creato < limite and nome not in collegati:
+            orfane.append(nome)
 
+    motivo = None
+    if orfane and righe_con_foto == 0:
+        motivo = "nessuna riga di magazzino ha foto: il database non sembra quello del bucket"
+    elif len(orfane) > STORAGE_PULIZIA_MINIMO and len(orfane) > STORAGE_PULIZIA_QUOTA_MAX * totale:
+        motivo = f"{len(orfane)} file orfani su {totale}, oltre il {STORAGE_PULIZIA_QUOTA_MAX:.0%} del bucket"
+    return orfane, motivo
+
+
+def _lavoro_pulizia(conn, lavoro):
+    orfane, motivo = foto_orfane(conn)
+    cur = conn.cursor()
+    if motivo:
+        # niente eliminazioni: il motivo resta visibile in /diagnostica/storage
+        app.logger.error("Pulizia storage sospesa: %s. Verificare e usare `flask pulizia-foto --esegui --forza`.", motivo)
+    else:
+        accoda_eliminazione_foto(cur, *orfane)
+    # il lavoro di pulizia non si chiude mai: viene ripianificato
     cur.execute("""
-        UPDATE ordini_magazzino
-        SET stato = %s
+        UPDATE lavori_storage SET tentativi = 0, prossimo_tentativo = %s, ultimo_errore = %s
         WHERE id = %s
-    """, (nuovo_stato, id))
-
+    """, (now_ita() + timedelta(hours=STORAGE_PULIZIA_ORE), motivo, lavoro["id"]))
     conn.commit()
-    conn.close()
+    if orfane and not motivo:
+        app.logger.info("Pulizia storage: %s file orfani accodati per l'eliminazione.", len(orfane))
 
-    # 🔥 STORICO — CAMBIO STATO
-    log_storico(
-        user_id=session.get("user_id"),
-        azione=f"Cambio stato ordine → {nuovo_stato}",
-        tabella="ordini_magazzino",
-        record_id=id
-    )
 
-    flash("Stato aggiornato!", "success")
-    return redirect(url_for("giacenza_ordini"))
+_LAVORI_STORAGE = {
+    "foto_magazzino": _lavoro_foto_magazzino,
+    "elimina": _lavoro_elimina,
+    "pulizia": _lavoro_pulizia,
+}
 
 
+class CodaStorage:
+    """
+    Thread in background che eseguono i lavori di lavori_storage. La tabella
+    è la coda: i lavori sopravvivono ai riavvii e più processi gunicorn
+    possono lavorarla insieme (la presa in carico è un UPDATE condizionato).
+    """
 
-# ========== 5) ELIMINA ORDINE ==========
-@app.route("/ordini/elimina/<int:id>")
-@login_required
-def elimina_ordine(id):
+    def __init__(self, worker, intervallo):
+        self._worker = worker
+        self._intervallo = intervallo
+        self._thread = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sveglia = threading.Event()
+        self._stat = {"eseguiti": 0, "errori": 0, "abbandonati": 0}
+
+    def avvia(self):
+        # i thread partono alla prima richiesta (dopo il fork dei worker gunicorn)
+        if len(self._thread) == self._worker and all(t.is_alive() for t in self._thread):
+            return
+        with self._lock:
+            self._stop.clear()
+            self._thread = [t for t in self._thread if t.is_alive()]
+            while len(self._thread) < self._worker:
+                t = threading.Thread(target=self._ciclo, name=f"coda-storage-{len(self._thread)}", daemon=True)
+                t.start()
+                self._thread.append(t)
+
+    def sveglia(self):
+        """Da chiamare dopo il commit che ha accodato lavori: evita l'attesa del prossimo controllo."""
+        self._sveglia.set()
+
+    def _prendi(self):
+        """Prende in carico il primo lavoro scaduto, o None se non ce ne sono."""
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        try:
+            adesso = now_ita()
+            cur.execute("""
+                SELECT id, tentativi FROM lavori_storage
+                WHERE prossimo_tentativo <= %s AND tentativi < %s
+                ORDER BY prossimo_tentativo, id
+                LIMIT 10
+            """, (adesso, STORAGE_TENTATIVI_MAX))
+            for candidato in cur.fetchall():
+                # vince chi incrementa per primo i tentativi; il lease protegge dai processi terminati
+                cur.execute("""
+                    UPDATE lavori_storage SET tentativi = tentativi + 1, prossimo_tentativo = %s
+                    WHERE id = %s AND tentativi = %s
+                """, (adesso + STORAGE_LEASE, candidato["id"], candidato["tentativi"]))
+                if cur.rowcount == 1:
+                    conn.commit()
+                    cur.execute("SELECT * FROM lavori_storage WHERE id = %s", (candidato["id"],))
+                    return cur.fetchone()
+            conn.rollback()
+            return None
+        finally:
+            cur.close()
+            conn.close()
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    def _esegui(self, lavoro):
+        conn = get_db_connection()
+        try:
+            _LAVORI_STORAGE[lavoro["tipo"]](conn, lavoro)
+            with self._lock:
+                self._stat["eseguiti"] += 1
+        except Exception as e:
+            conn.rollback()
+            tentativi = lavoro["tentativi"]
+            app.logger.exception("Lavoro storage %s (%s) non riuscito, tentativo %s.", lavoro["id"], lavoro["tipo"], tentativi)
+            attesa = min(STORAGE_ATTESA_BASE * 2 ** (tentativi - 1), STORAGE_ATTESA_MAX)
+            if lavoro["tipo"] == "pulizia":
+                tentativi = 0   # la pulizia non viene mai abbandonata
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE lavori_storage SET tentativi = %s, prossimo_tentativo = %s, ultimo_errore = %s
+                WHERE id = %s
+            """, (tentativi, now_ita() + timedelta(seconds=attesa), str(e)[:500], lavoro["id"]))
+            conn.commit()
+            with self._lock:
+                self._stat["errori"] += 1
+                if tentativi >= STORAGE_TENTATIVI_MAX:
+                    self._stat["abbandonati"] += 1
+                    app.logger.error("Lavoro storage %s abbandonato dopo %s tentativi.", lavoro["id"], tentativi)
+        finally:
+            conn.close()
 
-    cur.execute("DELETE FROM ordini_magazzino WHERE id = %s", (id,))
+    def _ciclo(self):
+        while not self._stop.is_set():
+            try:
+                lavoro = self._prendi()
+                if lavoro is not None:
+                    self._esegui(lavoro)
+                    continue
+            except Exception:
+                app.logger.exception("Errore nella coda dei lavori storage.")
+            self._sveglia.wait(self._intervallo)
+            self._sveglia.clear()
+
+    def esegui_scaduti(self):
+        """Esegue nel thread chiamante tutti i lavori già scaduti (comandi CLI e deploy senza thread)."""
+        eseguiti = 0
+        while (lavoro := self._prendi()) is not None:
+            self._esegui(lavoro)
+            eseguiti += 1
+        return eseguiti
+
+    def chiudi(self, timeout=10):
+        # i lavori interrotti restano in tabella e ripartono allo scadere del lease
+        self._stop.set()
+        self._sveglia.set()
+        for t in self._thread:
+            t.join(timeout)
+
+    def statistiche(self):
+        with self._lock:
+            stat = dict(self._stat)
+        stat["backend"] = STORAGE_BACKEND
+        stat["thread_attivi"] = sum(t.is_alive() for t in self._thread)
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                SELECT tipo, COUNT(*), SUM(CASE WHEN tentativi >= %s THEN 1 ELSE 0 END)
+                FROM lavori_storage GROUP BY tipo
+            """, (STORAGE_TENTATIVI_MAX,))
+            stat["in_tabella"] = {tipo: {"totale": totale, "abbandonati": abbandonati or 0}
+                                  for tipo, totale, abbandonati in cur.fetchall()}
+            cur.execute("SELECT ultimo_errore FROM lavori_storage WHERE tipo = 'pulizia'")
+            riga = cur.fetchone()
+            stat["pulizia_ultimo_errore"] = riga[0] if riga else None
+        finally:
+            cur.close()
+            conn.close()
+        return stat
 
-    conn.commit()
-    conn.close()
 
-    # 🔥 STORICO — ELIMINAZIONE
-    log_storico(
-        user_id=session.get("user_id"),
-        azione="Eliminazione ordine magazzino",
-        tabella="ordini_magazzino",
-        record_id=id
-    )
+coda_storage = CodaStorage(STORAGE_WORKER, STORAGE_INTERVALLO)
+atexit.register(coda_storage.chiudi)
+
+
+@app.before_request
+def avvia_coda_storage():
+    coda_storage.avvia()
 
-    flash("Ordine eliminato!", "success")
-    return redirect(url_for("giacenza_ordini"))
 # ===============================
 #   📦 GESTIONE MAGAZZINO
 # ===============================
@@ -2536,14 +6844,108 @@ def elimina_ordine(id):
 # ---------------------------------------
 @app.route("/giacenza_magazzino")
 def giacenza_magazzino():
+    # le righe arrivano a pagine da cerca_magazzino
+    return render_template("giacenza_magazzino.html", pagina=MAGAZZINO_PAGINA)
+
+# Risultati per pagina della ricerca magazzino (limite massimo per richiesta)
+MAGAZZINO_PAGINA = 20
+MAGAZZINO_PAGINA_MAX = 100
+
+# Testo unico su cui lavora l'indice trigram (stessa espressione della migrazione 7)
+_TESTO_MAGAZZINO = """(
+    COALESCE(descrizione, '') || ' ' || COALESCE(codice, '') || ' ' || COALESCE(note, '') || ' ' ||
+    COALESCE(marca_veicolo, '') || ' ' || COALESCE(tipo_veicolo, '')
+)"""
+
+def _termini_ricerca(testo):
+    # solo lettere e cifre: il resto romperebbe la sintassi di tsquery / MATCH
+    return re.findall(r"\w+", testo.lower())
+
+def _query_ricerca_magazzino(q, filtri):
+    """
+    Costruisce (from_where, parametri, punteggio) per la ricerca nel magazzino.
+    Con testo libero i risultati sono ordinati per rilevanza: full-text con
+    prefissi (tsvector su Postgres, FTS5 su SQLite) più, su Postgres, le
+    sottostringhe trovate dall'indice trigram.
+    """
+    condizioni, parametri, punteggio = [], [], None
+    termini = _termini_ricerca(q)
+
+    if termini and DB_BACKEND == "postgres":
+        tsquery = " & ".join(f"{t}:*" for t in termini)
+        origine = "magazzino m"
+        condizioni.append(f"(m.ricerca @@ to_tsquery('simple', %s) OR {_TESTO_MAGAZZINO} ILIKE %s ESCAPE '\\')")
+        parametri.extend([tsquery, pattern_contiene(q.strip())])
+        punteggio = (
+            "ts_rank(m.ricerca, to_tsquery('simple', %s)) + "
+            f"similarity({_TESTO_MAGAZZINO}, %s)",
+            [tsquery, q.strip()]
+        )
+    elif termini:
+        origine = "magazzino_fts JOIN magazzino m ON m.id = magazzino_fts.rowid"
+        condizioni.append("magazzino_fts MATCH %s")
+        parametri.append(" ".join(f'"{t}"*' for t in termini))
+        # bm25: più basso è meglio; pesi nello stesso ordine delle colonne FTS
+        punteggio = ("-bm25(magazzino_fts, 10.0, 10.0, 4.0, 4.0, 1.0)", [])
+    else:
+        origine = "magazzino m"
+
+    for campo in ("descrizione", "codice", "tipo_veicolo"):
+        valore = (filtri.get(campo) or "").strip()
+        if valore:
+            condizioni.append(f"m.{campo} ILIKE %s ESCAPE '\\'")
+            parametri.append(pattern_contiene(valore))
+    marca = (filtri.get("marca_veicolo") or "").strip()
+    if marca:
+        condizioni.append("m.marca_veicolo = %s")
+        parametri.append(marca)
+
+    where = f"WHERE {' AND '.join(condizioni)}" if condizioni else ""
+    return f"FROM {origine} {where}", parametri, punteggio
+
+# ---------------------------------------
+# 🔍 RICERCA MAGAZZINO (JSON paginato)
+# ---------------------------------------
+@app.route("/giacenza_magazzino/cerca")
+@login_required
+def cerca_magazzino():
+    """
+    Parametri: q (testo libero), descrizione, codice, marca_veicolo,
+    tipo_veicolo, offset, limite. Restituisce una pagina di risultati
+    e se ce ne sono altri.
+    """
+    limite = min(max(request.args.get("limite", MAGAZZINO_PAGINA, type=int), 1), MAGAZZINO_PAGINA_MAX)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    q = request.args.get("q", "")
+
+    from_where, parametri, punteggio = _query_ricerca_magazzino(q, request.args)
+    if punteggio:
+        colonna_punteggio = f"{punteggio[0]} AS punteggio"
+        parametri = punteggio[1] + parametri
+        ordine = "punteggio DESC, m.id DESC"
+    else:
+        colonna_punteggio = "NULL AS punteggio"
+        # senza testo libero resta l'ordine della pagina: i più recenti prima
+        ordine = "m.id DESC"
+
     conn = get_db_connection()
     cur = conn.cursor()
-
-    cur.execute("""
-        SELECT id, descrizione, codice, marca_veicolo, tipo_veicolo, note, foto
-        FROM magazzino
-        ORDER BY id DESC
-    """)
+    try:
+        # una riga in più per sapere se esiste una pagina successiva
+        cur.execute(f"""
+            SELECT m.id, m.descrizione, m.codice, m.marca_veicolo, m.tipo_veicolo, m.note, m.foto,
+                   m.foto_media, m.foto_miniatura, {colonna_punteggio}
+            {from_where}
+            ORDER BY {ordine}
+            LIMIT %s OFFSET %s
+        """, parametri + [limite + 1, offset])
+        righe = cur.fetchall()
+    except Exception:
+        app.logger.exception("Errore nella ricerca magazzino.")
+        return jsonify({"error": "Ricerca non disponibile"}), 500
+    finally:
+        cur.close()
+        conn.close()
 
     ricambi = [
         {
@@ -2554,14 +6956,16 @@ def giacenza_magazzino():
             "tipo_veicolo": r[4],
             "note": r[5],
             "foto": r[6],
+            "foto_media": r[7],
+            "foto_miniatura": r[8],
         }
-        for r in cur.fetchall()
+        for r in righe[:limite]
     ]
-
-    cur.close()
-    conn.close()
-
-    return render_template("giacenza_magazzino.html", ricambi=ricambi)
+    return jsonify({
+        "risultati": ricambi,
+        "altri": len(righe) > limite,
+        "offset_successivo": offset + len(ricambi)
+    })
 
 # ---------------------------------------
 # ➕ PAGINA INSERISCI RICAMBIO MAGAZZINO
@@ -2571,7 +6975,7 @@ def inserisci_magazzino():
     return render_template("inserisci_magazzino.html")
 
 # ---------------------------------------
-# 💾 SALVATAGGIO RICAMBIO + FOTO (SUPABASE STORAGE VIA REST)
+# 💾 SALVATAGGIO RICAMBIO + FOTO (ELABORATA IN BACKGROUND)
 # ---------------------------------------
 @app.route("/salva_magazzino", methods=["POST"])
 def salva_magazzino():
@@ -2587,51 +6991,37 @@ def salva_magazzino():
         flash("Inserire almeno una descrizione o un codice.")
         return redirect(url_for("inserisci_magazzino"))
 
-    # 📸 UPLOAD FOTO SU SUPABASE STORAGE
-    foto_url = None
-
-    if foto and foto.filename != "":
-        estensione = foto.filename.rsplit(".", 1)[1].lower()
-        nome_unico = f"{uuid.uuid4().hex}.{estensione}"
-
-        upload_url = f"{SUPABASE_STORAGE_URL}/foto_magazzino/{nome_unico}"
-
-        res = requests.post(
-            upload_url,
-            headers={
-                "Authorization": f"Bearer {SUPABASE_KEY}",
-                "Content-Type": foto.content_type,
-                "x-upsert": "true"  # permette di sovrascrivere se serve
-            },
-            data=foto.read()
-        )
-
-        if res.status_code not in [200, 201]:
-            flash(f"Errore durante l'upload della foto su Supabase.")
-            return redirect(url_for("inserisci_magazzino"))
-
-        foto_url = (
-            f"{SUPABASE_URL}/storage/v1/object/public/foto_magazzino/{nome_unico}"
-        )
+    dati_foto = foto.read() if foto and foto.filename != "" else None
+    if dati_foto is not None and not foto_valida(dati_foto):
+        flash("Il file caricato non è un'immagine valida.")
+        return redirect(url_for("inserisci_magazzino"))
 
-    # 📌 SALVATAGGIO NEL DB
+    # 📌 SALVATAGGIO NEL DB (le colonne foto le compila coda_storage a elaborazione finita)
     conn = get_db_connection()
     cur = conn.cursor()
 
     cur.execute("""
-        INSERT INTO magazzino (descrizione, codice, marca_veicolo, tipo_veicolo, note, foto)
-        VALUES (%s, %s, %s, %s, %s, %s)
-    """, (descrizione, codice, marca, tipo, note, foto_url))
+        INSERT INTO magazzino (descrizione, codice, marca_veicolo, tipo_veicolo, note)
+        VALUES (%s, %s, %s, %s, %s)
+        RETURNING id
+    """, (descrizione, codice, marca, tipo, note))
+    nuovo_id = cur.fetchone()[0]
+    if dati_foto is not None:
+        accoda_foto_magazzino(cur, nuovo_id, dati_foto)
 
     conn.commit()
     cur.close()
     conn.close()
 
-    flash("Ricambio inserito correttamente!")
+    if dati_foto is not None:
+        coda_storage.sveglia()
+        flash("Ricambio inserito correttamente! La foto sarà visibile tra pochi secondi.")
+    else:
+        flash("Ricambio inserito correttamente!")
     return redirect(url_for("giacenza_magazzino"))
 
 # ---------------------------------------
-# ✏️ MODIFICA RICAMBIO + GESTIONE FOTO (SUPABASE STORAGE VIA REST)
+# ✏️ MODIFICA RICAMBIO + GESTIONE FOTO
 # ---------------------------------------
 @app.route("/modifica_magazzino/<int:id>", methods=["POST"])
 def modifica_magazzino(id):
@@ -2649,76 +7039,14 @@ def modifica_magazzino(id):
         flash("Inserire almeno una descrizione o un codice.")
         return redirect(url_for("giacenza_magazzino"))
 
+    dati_foto = nuova_foto.read() if nuova_foto and nuova_foto.filename != "" else None
+    if dati_foto is not None and not foto_valida(dati_foto):
+        flash("Il file caricato non è un'immagine valida.")
+        return redirect(url_for("giacenza_magazzino"))
+
     conn = get_db_connection()
     cur = conn.cursor()
 
-    # Recupera foto attuale
-    cur.execute("SELECT foto FROM magazzino WHERE id = %s", (id,))
-    row = cur.fetchone()
-    foto_attuale = row[0] if row else None
-    foto_finale = foto_attuale
-
-    # ---------------------------------------------------------
-    # 🗑️ RIMOZIONE FOTO
-    # ---------------------------------------------------------
-    if rimuovi_foto and foto_attuale:
-        nome_file = foto_attuale.split("/")[-1]
-
-        try:
-            requests.delete(
-                f"{SUPABASE_STORAGE_URL}/foto_magazzino/{nome_file}",
-                headers={"Authorization": f"Bearer {SUPABASE_KEY}"}
-            )
-            foto_finale = None
-        except Exception as e:
-            print("Errore rimozione foto da Supabase:", e)
-
-    # ---------------------------------------------------------
-    # 📸 NUOVA FOTO — CARICAMENTO SU SUPABASE
-    # ---------------------------------------------------------
-    if nuova_foto and nuova_foto.filename != "":
-        estensione = nuova_foto.filename.rsplit(".", 1)[1].lower()
-        nome_unico = f"{uuid.uuid4().hex}.{estensione}"
-
-        # Se c'era una vecchia foto → eliminala
-        if foto_attuale:
-            try:
-                vecchio = foto_attuale.split("/")[-1]
-                requests.delete(
-                    f"{SUPABASE_STORAGE_URL}/foto_magazzino/{vecchio}",
-                    headers={"Authorization": f"Bearer {SUPABASE_KEY}"}
-                )
-            except:
-                pass
-
-        # Upload REST
-        upload_url = f"{SUPABASE_STORAGE_URL}/foto_magazzino/{nome_unico}"
-
-        try:
-            res = requests.post(
-                upload_url,
-                headers={
-                    "Authorization": f"Bearer {SUPABASE_KEY}",
-                    "Content-Type": nuova_foto.content_type
-                },
-                data=nuova_foto.read()
-            )
-
-            if res.status_code not in (200, 201):
-                print("Errore Upload:", res.text)
-                flash("Errore caricamento nuova foto su Supabase.")
-                return redirect(url_for("giacenza_magazzino"))
-
-            # URL pubblica finale
-            foto_finale = (
-                f"{SUPABASE_URL}/storage/v1/object/public/foto_magazzino/{nome_unico}"
-            )
-
-        except Exception as e:
-            print("Errore Upload:", e)
-            flash("Errore caricamento nuova foto su Supabase.")
-            return redirect(url_for("giacenza_magazzino"))
-
     # ---------------------------------------------------------
     # 💾 AGGIORNA DATABASE
     # ---------------------------------------------------------
@@ -2728,103 +7056,62 @@ def modifica_magazzino(id):
             codice = %s,
             marca_veicolo = %s,
             tipo_veicolo = %s,
-            note = %s,
-            foto = %s
+            note = %s
         WHERE id = %s
-    """, (descrizione, codice, marca, tipo, note, foto_finale, id))
-
-    conn.commit()
-    cur.close()
-    conn.close()
+    """, (descrizione, codice, marca, tipo, note, id))
 
-    flash("Ricambio aggiornato correttamente!")
-    return redirect(url_for("giacenza_magazzino"))
     # ---------------------------------------------------------
-    # 📸 CASO 2: NUOVA FOTO CARICATA
+    # 🗑️ RIMOZIONE FOTO (originale e varianti)
     # ---------------------------------------------------------
-    if nuova_foto and nuova_foto.filename != "":
-        # elimina vecchia foto se esiste
-        if foto_attuale:
-            nome_file = foto_attuale.split("/")[-1]
-            requests.delete(
-                f"{SUPABASE_STORAGE_URL}/foto_magazzino/{nome_file}",
-                headers={"Authorization": f"Bearer {SUPABASE_KEY}"}
-            )
-
-        estensione = nuova_foto.filename.rsplit(".", 1)[1].lower()
-        nome_unico = f"{uuid.uuid4().hex}.{estensione}"
-
-        upload_url = f"{SUPABASE_STORAGE_URL}/foto_magazzino/{nome_unico}"
-
-        res = requests.post(
-            upload_url,
-            headers={
-                "Authorization": f"Bearer {SUPABASE_KEY}",
-                "Content-Type": nuova_foto.content_type,
-                "x-upsert": "true"
-            },
-            data=nuova_foto.read()
-        )
-
-        if res.status_code not in [200, 201]:
-            flash("Errore caricamento nuova foto su Supabase.")
-            return redirect(url_for("giacenza_magazzino"))
-
-        foto_finale = (
-            f"{SUPABASE_URL}/storage/v1/object/public/foto_magazzino/{nome_unico}"
+    if rimuovi_foto and dati_foto is None:
+        cur.execute("SELECT foto, foto_media, foto_miniatura FROM magazzino WHERE id = %s FOR UPDATE", (id,))
+        rimosse = cur.fetchone()
+        cur.execute(
+            "UPDATE magazzino SET foto = NULL, foto_media = NULL, foto_miniatura = NULL WHERE id = %s", (id,)
         )
+        if rimosse:
+            accoda_eliminazione_foto(cur, *rimosse)
+        # una foto caricata prima e non ancora elaborata non deve ricomparire
+        cur.execute("DELETE FROM lavori_storage WHERE tipo = 'foto_magazzino' AND magazzino_id = %s", (id,))
 
-    # ---------------------------------------------------------
-    # 💾 AGGIORNA DB
-    # ---------------------------------------------------------
-    cur.execute("""
-        UPDATE magazzino
-        SET descrizione = %s,
-            codice = %s,
-            marca_veicolo = %s,
-            tipo_veicolo = %s,
-            note = %s,
-            foto = %s
-        WHERE id = %s
-    """, (descrizione, codice, marca, tipo, note, foto_finale, id))
+    # 📸 NUOVA FOTO: sostituisce la precedente a elaborazione finita
+    if dati_foto is not None:
+        accoda_foto_magazzino(cur, id, dati_foto)
 
     conn.commit()
     cur.close()
     conn.close()
+    coda_storage.sveglia()
 
-    flash("Ricambio aggiornato correttamente!")
+    if dati_foto is not None:
+        flash("Ricambio aggiornato correttamente! La nuova foto sarà visibile tra pochi secondi.")
+    else:
+        flash("Ricambio aggiornato correttamente!")
     return redirect(url_for("giacenza_magazzino"))
 
 # ---------------------------------------
-# ❌ ELIMINA RICAMBIO + FOTO DA SUPABASE
+# ❌ ELIMINA RICAMBIO + FOTO DALLO STORAGE
 # ---------------------------------------
 @app.route("/elimina_magazzino/<int:id>", methods=["POST"])
 def elimina_magazzino(id):
     conn = get_db_connection()
     cur = conn.cursor()
 
-    # recupera eventuale foto dal DB
-    cur.execute("SELECT foto FROM magazzino WHERE id = %s", (id,))
+    # recupera eventuali foto dal DB
+    cur.execute("SELECT foto, foto_media, foto_miniatura FROM magazzino WHERE id = %s FOR UPDATE", (id,))
     row = cur.fetchone()
-    foto_url = row[0] if row else None
-
-    # elimina foto da Supabase Storage
-    if foto_url:
-        nome_file = foto_url.split("/")[-1]
-
-        requests.delete(
-            f"{SUPABASE_STORAGE_URL}/foto_magazzino/{nome_file}",
-            headers={
-                "Authorization": f"Bearer {SUPABASE_KEY.strip()}"
-            }
-        )
 
-    # elimina record dal database
+    # elimina record dal database; originale e varianti escono dallo storage in background
     cur.execute("DELETE FROM magazzino WHERE id = %s", (id,))
+    if row:
+        accoda_eliminazione_foto(cur, *row)
+    # una foto ancora da elaborare non serve più
+    cur.execute("DELETE FROM lavori_storage WHERE tipo = 'foto_magazzino' AND magazzino_id = %s", (id,))
     conn.commit()
 
     cur.close()
     conn.close()
+    coda_storage.sveglia()
 
     flash("Ricambio eliminato.")
     return redirect(url_for("giacenza_magazzino"))
@@ -2863,7 +7150,7 @@ def prima_nota_list():
         SELECT *
         FROM prima_nota
         WHERE username = %s
-          AND data::date = %s
+          AND data = %s
         ORDER BY created_at ASC
     """, (session["username"], data_filtro))
 
@@ -3124,6 +7411,204 @@ def prima_nota_stampa():
     )
                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                   
 # =====================================
+# DIAGNOSTICA
+# =====================================
+# Testo delle query, host e stato dei pool: solo per chi ha il permesso 'diagnostica'
+def permesso_diagnostica(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not ha_permesso("diagnostica"):
+            abort(403)
+        return f(*args, **kwargs)
+    return wrapper
+
+@app.route('/diagnostica/db')
+@login_required
+@permesso_diagnostica
+def diagnostica_db():
+    """Metriche del pool di connessioni in formato JSON."""
+    return jsonify(statistiche_db())
+
+@app.route('/diagnostica/cache')
+@login_required
+@permesso_diagnostica
+def diagnostica_cache():
+    """Contatori hit/miss della cache dei dati di riferimento."""
+    return jsonify(cache_riferimento.statistiche())
+
+@app.route('/diagnostica/sql')
+@login_required
+@permesso_diagnostica
+def diagnostica_sql():
+    """Costo SQL aggregato per endpoint (query, tempo DB, connessioni, N+1)."""
+    return jsonify(riepilogo_sql())
+
+@app.route('/diagnostica/storage')
+@login_required
+@permesso_diagnostica
+def diagnostica_storage():
+    """Lavori sullo storage foto: contatori del processo e lavori in tabella per tipo."""
+    return jsonify(coda_storage.statistiche())
+
+# =====================================
+# COMANDI CLI (flask --app app <comando>)
+# =====================================
+@app.cli.command("migra")
+def cli_migra():
+    """Applica le migrazioni di schema mancanti (backend selezionato da DB_BACKEND)."""
+    # fuori dal pool: con MIGRAZIONI_AUTOMATICHE=0 il pool rifiuta uno schema indietro
+    conn = _nuova_connessione()
+    try:
+        applicate = applica_migrazioni(conn)
+        versione = versione_schema(conn)
+    finally:
+        conn.close()
+    if applicate:
+        print(f"✅ Migrazioni applicate: {', '.join(map(str, applicate))}")
+    print(f"ℹ️ Versione schema: {versione}")
+
+
+@app.cli.command("concedi-permesso")
+@click.argument("username")
+@click.argument("permesso")
+def cli_concedi_permesso(username, permesso):
+    """Concede un permesso (es. modelli, ricambi_modelli, giacenza_ricambi)."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "INSERT INTO permessi (username, permesso) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+            (username, permesso)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    cache_permessi.invalida()
+    print(f"✅ Permesso '{permesso}' concesso a '{username}' (attivo dalla prossima richiesta)")
+
+
+@app.cli.command("revoca-permesso")
+@click.argument("username")
+@click.argument("permesso")
+def cli_revoca_permesso(username, permesso):
+    """Revoca un permesso."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM permessi WHERE username = %s AND permesso = %s", (username, permesso))
+        conn.commit()
+    finally:
+        conn.close()
+    cache_permessi.invalida()
+    print(f"✅ Permesso '{permesso}' revocato a '{username}'")
+
+
+@app.cli.command("crea-utente")
+@click.argument("username")
+@click.argument("password")
+@click.argument("ruolo", type=click.Choice(["accettazione", "officina", "officina_gomme"]))
+def cli_crea_utente(username, password, ruolo):
+    """Crea un utente (password salvata con bcrypt)."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "INSERT INTO utenti (username, password, ruolo) VALUES (%s, %s, %s) RETURNING id",
+            (username, hash_password(password), ruolo)
+        )
+        new_id = cur.fetchone()[0]
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"✅ Utente '{username}' creato con id {new_id}")
+
+
+@app.cli.command("importa-ricambi")
+@click.argument("file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--errori", "percorso_errori", default=None, help="CSV dove scrivere le righe scartate.")
+@click.option("--utente", "username", default=None, help="Utente a cui attribuire i ricambi nuovi.")
+def cli_importa_ricambi(file, percorso_errori, username):
+    """Importa un catalogo ricambi da CSV (codice, nome, prefisso, quantita, sostituto)."""
+    utente_id = None
+    if username:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT id FROM utenti WHERE username = %s", (username,))
+            riga = cur.fetchone()
+        finally:
+            conn.close()
+        if not riga:
+            raise click.ClickException(f"Utente '{username}' inesistente")
+        utente_id = riga[0]
+
+    percorso_errori = percorso_errori or os.path.splitext(file)[0] + "_errori.csv"
+    with open(file, encoding="utf-8-sig", newline="") as testo:
+        try:
+            esito = importa_ricambi(testo, utente_id, percorso_errori)
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            raise click.ClickException(f"File non valido: {e}")
+
+    if utente_id is not None:
+        log_storico(utente_id, f"Importati ricambi da {os.path.basename(file)} (CLI)", "ricambi")
+    print(f"✅ Righe valide: {esito['validi']} — nuovi {esito['inseriti']}, aggiornati {esito['aggiornati']}, "
+          f"sostituti {esito['sostituti']}")
+    if esito['errori']:
+        print(f"⚠️ Righe scartate: {esito['errori']} (dettaglio in {esito['file_errori']})")
+
+
+@app.cli.command("istantanea-giacenze")
+@click.option("--data", "giorno", default=None, help="Giorno da fotografare (AAAA-MM-GG, default ieri).")
+def cli_istantanea_giacenze(giorno):
+    """Salva le giacenze ricambi a fine giornata (da lanciare ogni notte via cron)."""
+    try:
+        giorno = date.fromisoformat(giorno) if giorno else now_ita().date() - timedelta(days=1)
+    except ValueError:
+        raise click.ClickException("Data non valida (formato AAAA-MM-GG)")
+    if giorno >= now_ita().date():
+        raise click.ClickException("Si possono fotografare solo giornate già concluse")
+
+    conn = get_db_connection()
+    try:
+        righe = salva_istantanea_giacenze(conn, giorno)
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"✅ Istantanea del {giorno.isoformat()}: {righe} ricambi")
+
+@app.cli.command("pulizia-foto")
+@click.option("--esegui", is_flag=True, help="Accoda l'eliminazione dei file trovati (senza: solo elenco).")
+@click.option("--forza", is_flag=True, help="Elimina anche quando i controlli di sicurezza sospendono la pulizia.")
+def cli_pulizia_foto(esegui, forza):
+    """Cerca nel bucket le foto non collegate a nessun ricambio di magazzino."""
+    conn = get_db_connection()
+    try:
+        orfane, motivo = foto_orfane(conn)
+        for nome in orfane:
+            print(nome)
+        if motivo:
+            print(f"⚠️ {motivo}")
+            if esegui and not forza:
+                raise click.ClickException("Pulizia sospesa: ricontrollare e rilanciare con --forza")
+        if esegui and orfane:
+            cur = conn.cursor()
+            accoda_eliminazione_foto(cur, *orfane)
+            conn.commit()
+    finally:
+        conn.close()
+    if esegui:
+        print(f"✅ {len(orfane)} file orfani accodati per l'eliminazione")
+    else:
+        print(f"ℹ️ {len(orfane)} file orfani (usa --esegui per eliminarli)")
+
+
+@app.cli.command("lavori-storage")
+def cli_lavori_storage():
+    """Esegue subito i lavori storage in attesa (upload foto, eliminazioni, pulizia)."""
+    eseguiti = coda_storage.esegui_scaduti()
+    print(f"✅ Lavori eseguiti: {eseguiti}")
+
+# =====================================
 # AVVIO SERVER
 # =====================================
 if __name__ == '__main__':
@@ -0,0 +1,28 @@
+# Configurazione Gunicorn (letta automaticamente da `gunicorn wsgi:app`)
+#
+# Le dashboard tengono aperto uno stream SSE (/eventi/lavorazioni) per tutto
+# il tempo in cui la scheda resta aperta: con i worker sync ogni stream
+# bloccherebbe un intero processo. I worker gthread servono una richiesta per
+# thread, quindi ogni processo regge GUNICORN_THREADS connessioni tra stream
+# aperti e richieste normali. Uno stream fermo non tiene connessioni al
+# database: il pool resta dimensionato sulle richieste vere (DB_POOL_MAX).
+# Con un carico diverso si possono disattivare gli stream (EVENTI_SSE=0):
+# le dashboard tornano al polling.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+
+worker_class = "gthread"
+# Render imposta WEB_CONCURRENCY in base al piano
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# dimensionato per qualche decina di dashboard aperte per processo più le richieste normali
+threads = int(os.environ.get("GUNICORN_THREADS", 50))
+
+# uno stream SSE manda un keep-alive ogni EVENTI_HEARTBEAT secondi (default 25):
+# il timeout deve restare più lungo, altrimenti il worker verrebbe considerato bloccato
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
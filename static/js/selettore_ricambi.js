@@ -0,0 +1,87 @@
+// =====================================
+// SELETTORE RICAMBI CON RICERCA
+// =====================================
+// Sostituisce le <select> con l'intero catalogo: i ricambi arrivano a pagine
+// da /ricambi/lookup mentre si scrive o si scorre l'elenco.
+//
+// Markup atteso:
+//   <div class="selettore-ricambi" data-url="..." data-valore="codice|id">
+//     <input type="text" class="selettore-testo">
+//     <input type="hidden" name="...">
+//     <ul class="selettore-risultati"></ul>
+//   </div>
+// parametri() (opzionale) restituisce filtri extra, es. { tipo_filtro: 'Olio' }.
+function creaSelettoreRicambi(contenitore, parametri) {
+    const testo = contenitore.querySelector('.selettore-testo');
+    const nascosto = contenitore.querySelector('input[type=hidden]');
+    const lista = contenitore.querySelector('.selettore-risultati');
+    const url = contenitore.dataset.url;
+    const campoValore = contenitore.dataset.valore || 'codice';
+
+    let offset = 0;
+    let altri = false;
+    let richiesta = 0;   // scarta le risposte di ricerche ormai superate
+    let timer = null;
+
+    async function carica(daCapo) {
+        if (daCapo) offset = 0;
+        const id = ++richiesta;
+        const query = new URLSearchParams(Object.assign(
+            { q: testo.value.trim(), offset: offset },
+            parametri ? parametri() : {}
+        ));
+        try {
+            const res = await fetch(url + '?' + query);
+            const dati = await res.json();
+            if (id !== richiesta) return;
+            if (!res.ok) throw new Error(dati.error);
+
+            if (daCapo) lista.innerHTML = '';
+            dati.risultati.forEach(r => {
+                const li = document.createElement('li');
+                li.textContent = r.codice + ' — ' + r.nome;
+                li.addEventListener('mousedown', e => {
+                    e.preventDefault();
+                    nascosto.value = r[campoValore];
+                    testo.value = r.codice + ' — ' + r.nome;
+                    lista.style.display = 'none';
+                });
+                lista.appendChild(li);
+            });
+            if (lista.children.length === 0) {
+                lista.innerHTML = '<li class="vuoto">Nessun ricambio trovato</li>';
+            }
+            offset += dati.risultati.length;
+            altri = dati.altri;
+            lista.style.display = 'block';
+        } catch (err) {
+            console.error(err);
+        }
+    }
+
+    testo.addEventListener('input', () => {
+        // il testo modificato a mano non corrisponde più alla scelta fatta
+        nascosto.value = '';
+        clearTimeout(timer);
+        timer = setTimeout(() => carica(true), 200);
+    });
+    testo.addEventListener('focus', () => carica(true));
+    testo.addEventListener('blur', () => { lista.style.display = 'none'; });
+
+    // pagina successiva quando si arriva in fondo all'elenco
+    lista.addEventListener('scroll', () => {
+        if (altri && lista.scrollTop + lista.clientHeight >= lista.scrollHeight - 20) {
+            altri = false;
+            carica(false);
+        }
+    });
+
+    return {
+        azzera() {
+            nascosto.value = '';
+            testo.value = '';
+            lista.innerHTML = '';
+            lista.style.display = 'none';
+        }
+    };
+}
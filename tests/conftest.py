@@ -0,0 +1,88 @@
+"""
+Ambiente dei test: l'applicazione gira sul backend locale (SQLite e storage
+foto su disco), senza servizi esterni. Da lanciare dalla radice del repository:
+
+    python -m pytest -q
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+# la configurazione si legge all'import di app: va impostata prima
+_CARTELLA = tempfile.mkdtemp(prefix="gestionale_test_")
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_SQLITE_PATH"] = os.path.join(_CARTELLA, "gestionale.db")
+os.environ["STORAGE_BACKEND"] = "locale"
+os.environ["STORAGE_LOCALE_PATH"] = os.path.join(_CARTELLA, "storage")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as gestionale  # noqa: E402
+
+# utente con i permessi sui ricambi (seminati dalle migrazioni)
+AMMINISTRATORE = "G.AS_Giuseppe.Palladino"
+
+# username → ruolo degli utenti di prova (password "pw")
+UTENTI = {
+    "accettazione": "accettazione",
+    "officina": "officina",
+    "gomme": "officina_gomme",
+    AMMINISTRATORE: "accettazione",
+}
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    with gestionale.app.app_context():
+        gestionale._pool_db()
+        conn = gestionale.get_db_connection()
+        cur = conn.cursor()
+        for username, ruolo in UTENTI.items():
+            cur.execute(
+                "INSERT INTO utenti (username, password, ruolo) VALUES (%s, %s, %s)",
+                (username, gestionale.hash_password("pw"), ruolo)
+            )
+        conn.commit()
+        conn.close()
+    yield
+    gestionale.coda_storage.chiudi()
+
+
+@pytest.fixture
+def accedi():
+    """Client già autenticato come l'utente indicato."""
+    def accedi(username):
+        client = gestionale.app.test_client()
+        r = client.post(f"/login/{UTENTI[username]}", data={"username": username, "password": "pw"})
+        assert r.status_code == 302
+        return client
+    return accedi
+
+
+@pytest.fixture
+def amministratore(accedi):
+    return accedi(AMMINISTRATORE)
+
+
+@pytest.fixture
+def accettazione(accedi):
+    return accedi("accettazione")
+
+
+@pytest.fixture
+def conn():
+    with gestionale.app.app_context():
+        conn = gestionale.get_db_connection()
+        yield conn
+        conn.close()
+
+
+@pytest.fixture
+def riga(conn):
+    """Prima riga di una query sulla connessione del test."""
+    def riga(query, parametri=()):
+        cur = conn.cursor()
+        cur.execute(query, parametri)
+        return cur.fetchone()
+    return riga
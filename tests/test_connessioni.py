@@ -0,0 +1,42 @@
+"""Connessione condivisa della richiesta e lettura a blocchi."""
+import app as gestionale
+
+
+def _promemoria(titolo):
+    """Promemoria confermati con questo titolo, letti da una richiesta nuova."""
+    with gestionale.app.app_context():
+        cur = gestionale.get_db_connection().cursor()
+        cur.execute("SELECT COUNT(*) FROM promemoria WHERE titolo = %s", (titolo,))
+        return cur.fetchone()[0]
+
+
+def test_helper_non_annullano_il_lavoro_del_chiamante():
+    with gestionale.app.app_context():
+        conn = gestionale.get_db_connection()
+        conn.cursor().execute("INSERT INTO promemoria (utente_id, titolo) VALUES (1, 'helper-condiviso')")
+        # un helper che apre e chiude la connessione condivisa non deve annullare l'INSERT
+        gestionale.get_nome_reale(1)
+        conn.commit()
+    assert _promemoria("helper-condiviso") == 1
+
+
+def test_lavoro_non_confermato_annullato_al_teardown():
+    with gestionale.app.app_context():
+        gestionale.get_db_connection().cursor().execute(
+            "INSERT INTO promemoria (utente_id, titolo) VALUES (1, 'mai-confermato')"
+        )
+    assert _promemoria("mai-confermato") == 0
+
+
+def test_lettura_a_blocchi_su_connessione_propria():
+    # regressione: su Postgres il cursore con nome stava sulla connessione della
+    # richiesta e il rollback di un helper (cache equivalenti a freddo durante
+    # l'esportazione CSV) lo distruggeva a metà stream. Qui si verifica che il
+    # generatore non legga dalla connessione condivisa: non ne vede il lavoro
+    # non confermato.
+    with gestionale.app.app_context():
+        conn = gestionale.get_db_connection()
+        conn.cursor().execute("INSERT INTO promemoria (utente_id, titolo) VALUES (1, 'non-confermato')")
+        righe = gestionale.righe_a_blocchi("SELECT titolo FROM promemoria WHERE titolo = 'non-confermato'")
+        assert list(righe) == []
+        conn.rollback()
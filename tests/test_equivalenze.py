@@ -0,0 +1,86 @@
+"""Gruppi di equivalenza dei ricambi: unione, separazione e modifica dal form."""
+import app as gestionale
+
+
+def _gruppi(conn, codici):
+    cur = conn.cursor()
+    cur.execute(
+        f"SELECT codice, gruppo FROM ricambi_gruppi WHERE codice IN ({', '.join(['%s'] * len(codici))})",
+        list(codici)
+    )
+    return dict(cur.fetchall())
+
+
+def test_unione_e_separazione_gruppi(conn):
+    codici = ["G1 A", "G1 B", "G1 C", "G1 D"]
+    cur = conn.cursor()
+    cur.executemany("INSERT INTO ricambi (nome, codice, quantita) VALUES (%s, %s, 0)", [("n", c) for c in codici])
+
+    gestionale.collega_equivalenti(conn, [("G1 A", "G1 B"), ("G1 C", "G1 D")])
+    gruppi = _gruppi(conn, codici)
+    assert gruppi["G1 A"] == gruppi["G1 B"] != gruppi["G1 C"] == gruppi["G1 D"]
+
+    # un collegamento tra due gruppi li unisce
+    gestionale.collega_equivalenti(conn, [("G1 B", "G1 C")])
+    assert len(set(_gruppi(conn, codici).values())) == 1
+
+    gestionale.scollega_equivalente(conn, "G1 D")
+    gruppi = _gruppi(conn, codici)
+    assert "G1 D" not in gruppi and len(set(gruppi.values())) == 1
+    conn.commit()
+
+    gestionale.invalida_equivalenti()
+    assert set(gestionale.equivalenti("G1 A")) == {"G1 B", "G1 C"}
+    assert gestionale.equivalenti("G1 D") == ()
+
+
+def test_gruppo_sciolto_con_un_solo_codice(conn):
+    cur = conn.cursor()
+    cur.executemany("INSERT INTO ricambi (nome, codice, quantita) VALUES (%s, %s, 0)", [("n", "G2 A"), ("n", "G2 B")])
+    gestionale.collega_equivalenti(conn, [("G2 A", "G2 B")])
+    gestionale.scollega_equivalente(conn, "G2 A")
+    conn.commit()
+    assert _gruppi(conn, ["G2 A", "G2 B"]) == {}
+
+
+def test_nuovo_gruppo_non_riusa_un_gruppo_esistente(amministratore, conn, riga):
+    # AAA, BBB e CCC equivalenti; AAA esce dal gruppo e poi si lega a EEE:
+    # il nuovo gruppo AAA-EEE non deve riprendere l'id di quello di BBB e CCC
+    for codice, sostituto in (("AAA", ""), ("BBB", "X AAA"), ("CCC", "X AAA")):
+        amministratore.post("/aggiungi_ricambio", data={
+            "nome": "n", "codice": codice, "prefisso": "X", "sost_codice_select": sostituto
+        })
+    aaa = riga("SELECT id FROM ricambi WHERE codice = 'X AAA'")[0]
+    amministratore.post(f"/modifica_ricambio/{aaa}", data={
+        "nome": "n", "codice": "AAA", "prefisso": "X", "quantita": "0", "sost_codice_select": "", "password": "pw"
+    })
+    amministratore.post("/aggiungi_ricambio", data={
+        "nome": "n", "codice": "EEE", "prefisso": "X", "sost_codice_select": "X AAA"
+    })
+
+    gruppi = _gruppi(conn, ["X AAA", "X BBB", "X CCC", "X EEE"])
+    assert gruppi["X BBB"] == gruppi["X CCC"]
+    assert gruppi["X AAA"] == gruppi["X EEE"]
+    assert gruppi["X AAA"] != gruppi["X BBB"]
+
+
+def test_modifica_di_un_ricambio_altrui_non_tocca_i_gruppi(amministratore, conn, riga):
+    altro = riga("SELECT id FROM utenti WHERE username = 'accettazione'")[0]
+    cur = conn.cursor()
+    cur.executemany(
+        "INSERT INTO ricambi (nome, codice, quantita, utente_id) VALUES ('n', %s, 0, %s)",
+        [("Y AAA", altro), ("Y BBB", altro), ("Y CCC", altro)]
+    )
+    gestionale.collega_equivalenti(conn, [("Y AAA", "Y BBB")])
+    conn.commit()
+    aaa = riga("SELECT id FROM ricambi WHERE codice = 'Y AAA'")[0]
+
+    r = amministratore.post(f"/modifica_ricambio/{aaa}", data={
+        "nome": "n", "codice": "ZZZ", "prefisso": "Y", "quantita": "5", "sost_codice_select": "Y CCC", "password": "pw"
+    })
+    assert r.status_code == 302
+
+    conn.commit()
+    assert riga("SELECT codice, quantita FROM ricambi WHERE id = %s", (aaa,)) == ("Y AAA", 0)
+    gruppi = _gruppi(conn, ["Y AAA", "Y BBB", "Y CCC", "Y ZZZ"])
+    assert set(gruppi) == {"Y AAA", "Y BBB"} and gruppi["Y AAA"] == gruppi["Y BBB"]
@@ -0,0 +1,26 @@
+"""Widget interrogati periodicamente: 304 finché la tabella non cambia."""
+
+
+def test_promemoria_304_finche_invariati(accettazione, conn):
+    r = accettazione.get("/lista_promemoria")
+    assert r.status_code == 200
+    etag = r.headers["ETag"]
+    assert r.headers["Cache-Control"] == "private, no-cache"
+
+    r = accettazione.get("/lista_promemoria", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.get_data() == b""
+
+    conn.cursor().execute("INSERT INTO promemoria (utente_id, titolo) VALUES (1, 'etag-nuovo')")
+    conn.commit()
+    r = accettazione.get("/lista_promemoria", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+    assert "etag-nuovo" in [p["titolo"] for p in r.get_json()]
+
+
+def test_etag_distinto_per_utente(accettazione, accedi):
+    etag = accettazione.get("/lista_promemoria").headers["ETag"]
+    # stessa versione della tabella, ma un altro utente vede un'altra lista
+    r = accedi("officina").get("/lista_promemoria", headers={"If-None-Match": etag})
+    assert r.status_code == 200
@@ -0,0 +1,72 @@
+"""Foto del magazzino sullo storage locale: deduplica per contenuto ed eliminazione."""
+import io
+import os
+import time
+
+from PIL import Image
+
+import app as gestionale
+
+
+def _jpeg(colore):
+    buffer = io.BytesIO()
+    Image.new("RGB", (1200, 900), colore).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def _file_storage():
+    cartella = gestionale.STORAGE_LOCALE_PATH
+    return sorted(n for n in os.listdir(cartella) if not n.startswith(".")) if os.path.isdir(cartella) else []
+
+
+def _attendi(condizione, secondi=15):
+    fine = time.time() + secondi
+    while time.time() < fine:
+        gestionale.coda_storage.esegui_scaduti()
+        if condizione():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def _salva_con_foto(client, conn, riga, descrizione, dati):
+    r = client.post("/salva_magazzino", data={
+        "descrizione": descrizione, "codice": descrizione, "foto": (io.BytesIO(dati), "foto.jpg")
+    }, content_type="multipart/form-data")
+    assert r.status_code == 302
+    conn.commit()
+    return riga("SELECT MAX(id) FROM magazzino")[0]
+
+
+def test_foto_deduplicate_ed_eliminate(accettazione, conn, riga):
+    assert gestionale.STORAGE_BACKEND == "locale"
+    gialla = _jpeg("yellow")
+
+    def _foto(conn, magazzino_id):
+        conn.commit()   # nuova transazione: le scritture dei worker diventano visibili
+        return riga("SELECT foto, foto_media, foto_miniatura FROM magazzino WHERE id = %s", (magazzino_id,))
+
+    primo = _salva_con_foto(accettazione, conn, riga, "foto-1", gialla)
+    assert _attendi(lambda: _foto(conn, primo)[0])
+    secondo = _salva_con_foto(accettazione, conn, riga, "foto-2", gialla)
+    assert _attendi(lambda: _foto(conn, secondo)[0])
+
+    # stesso contenuto → stessi file (originale, media, miniatura), caricati una volta
+    assert _foto(conn, primo) == _foto(conn, secondo)
+    nomi = {os.path.basename(u) for u in _foto(conn, primo)}
+    assert nomi <= set(_file_storage())
+
+    r = accettazione.get(_foto(conn, primo)[2])
+    assert r.status_code == 200 and r.headers["Content-Type"] == "image/webp"
+
+    # i file restano finché un'altra riga li usa
+    accettazione.post(f"/elimina_magazzino/{primo}")
+    _attendi(lambda: False, secondi=1)
+    assert nomi <= set(_file_storage())
+
+    # tolta anche l'ultima foto, i file spariscono
+    accettazione.post(f"/modifica_magazzino/{secondo}", data={
+        "descrizione": "foto-2", "codice": "foto-2", "rimuovi_foto": "1"
+    })
+    assert _attendi(lambda: not nomi & set(_file_storage()))
+    assert _foto(conn, secondo) == (None, None, None)
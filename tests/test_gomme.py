@@ -0,0 +1,51 @@
+"""Misure gomme: lettura della misura scritta a mano e ricerca con misure equivalenti."""
+import pytest
+
+import app as gestionale
+
+
+@pytest.mark.parametrize("testo, misura", [
+    ("205/55 R16", (205, 55, 16)),
+    ("205/55R16", (205, 55, 16)),
+    ("205 55 16", (205, 55, 16)),
+    ("205-55-16", (205, 55, 16)),
+    ("20555R16", (205, 55, 16)),
+    ("225/45 zr17 94W", (225, 45, 17)),
+    (" 195/65 R15 91H ", (195, 65, 15)),
+])
+def test_leggi_misura(testo, misura):
+    assert gestionale.leggi_misura(testo) == misura
+
+
+@pytest.mark.parametrize("testo", ["", None, "205/55", "abc", "2055/55 R16", "205/55 R16 extra"])
+def test_leggi_misura_non_riconosciuta(testo):
+    assert gestionale.leggi_misura(testo) is None
+
+
+def test_cerca_gomme_con_alternative(accedi, conn):
+    conn.cursor().executemany("""
+        INSERT INTO gomme (marca, larghezza, rapporto, diametro, prezzo_unitario, prezzo_treno, disponibilita)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """, [
+        ("Cerca B", 205, 55, 16, 90, 340, 4),
+        ("Cerca A", 205, 55, 16, 80, 300, 2),
+        ("Cerca esaurita", 205, 55, 16, 70, 260, 0),
+        ("Cerca A", 225, 45, 17, 110, 420, 4),   # circonferenza +0,38%
+        ("Cerca A", 195, 65, 15, 75, 280, 4),    # circonferenza +0,41%
+        ("Cerca A", 255, 35, 20, 150, 580, 4),   # cerchio troppo diverso
+    ])
+    conn.commit()
+
+    r = accedi("gomme").get("/gomme/cerca", query_string={"misura": "205 55 r16"})
+    assert r.status_code == 200
+    dati = r.get_json()
+    assert dati["misura"] == "205/55 R16"
+    # solo le disponibili, dalla più economica
+    assert [g["marca"] for g in dati["disponibili"]] == ["Cerca A", "Cerca B"]
+    # alternative dalla più vicina per circonferenza
+    assert [a["misura"] for a in dati["alternative"]] == ["225/45 R17", "195/65 R15"]
+    assert dati["alternative"][0]["scarto_percentuale"] == 0.38
+
+
+def test_cerca_gomme_misura_non_valida(accedi):
+    assert accedi("gomme").get("/gomme/cerca", query_string={"misura": "boh"}).status_code == 400
@@ -0,0 +1,98 @@
+"""Import del catalogo ricambi da CSV (tabella d'appoggio, COPY su Postgres)."""
+import csv
+import io
+
+import app as gestionale
+
+
+def _importa(client, testo):
+    r = client.post("/ricambi/importa", data={
+        "file": (io.BytesIO(testo.encode("utf-8-sig")), "catalogo.csv")
+    }, content_type="multipart/form-data")
+    assert r.status_code == 302
+
+
+def _ricambi(conn, prefisso):
+    conn.commit()
+    cur = conn.cursor()
+    cur.execute("SELECT codice, nome, quantita FROM ricambi WHERE codice LIKE %s ORDER BY codice", (prefisso + "%",))
+    return {codice: (nome, quantita) for codice, nome, quantita in cur.fetchall()}
+
+
+def test_import_aggiorna_inserisce_e_scarta(amministratore, conn, monkeypatch):
+    # blocchi piccoli: anche su SQLite la tabella d'appoggio si riempie in più executemany
+    monkeypatch.setattr(gestionale, "IMPORT_BLOCCO_SQLITE", 2)
+    conn.cursor().execute("INSERT INTO ricambi (nome, codice, quantita) VALUES ('Filtro', 'IMP W712/75', 3)")
+    conn.commit()
+
+    _importa(amministratore, (
+        "codice;nome;prefisso;quantita;sostituto\n"
+        "W 712-75;Filtro olio;IMP;7;\n"          # stesso codice dell'archivio, scritto diverso
+        "A1;Filtro aria;IMP;2;IMP W712/75\n"     # nuovo, equivalente a un codice in archivio
+        "a-1;Doppione;IMP;1;\n"                  # ripetuto nel file (normalizzato)
+        "B2;Candela;IMP;tre;\n"                  # quantità non valida
+        "C3;Pastiglie;IMP;1;IMP ZZZ\n"           # sostituto inesistente
+        "D4;Disco;IMP;;IMP A1\n"                 # equivalente a una riga dello stesso file
+        ";Senza codice;;1;\n"
+    ))
+
+    assert _ricambi(conn, "IMP") == {
+        "IMP W712/75": ("Filtro olio", 7),
+        "IMP A1": ("Filtro aria", 2),
+        "IMP D4": ("Disco", 0),
+    }
+    gestionale.invalida_equivalenti()
+    assert set(gestionale.equivalenti("IMP W712/75")) == {"IMP A1", "IMP D4"}
+
+    # le variazioni di quantità passano dal registro movimenti
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT r.codice, m.delta FROM movimenti_ricambi m JOIN ricambi r ON r.id = m.ricambio_id
+        WHERE m.tipo = 'importazione' AND r.codice LIKE 'IMP%' ORDER BY r.codice
+    """)
+    assert cur.fetchall() == [("IMP A1", 2), ("IMP D4", 0), ("IMP W712/75", 4)]
+
+    # file con le righe scartate, scaricabile dall'utente che ha importato
+    r = amministratore.get("/ricambi/importa/errori")
+    assert r.status_code == 200
+    errori = list(csv.reader(io.StringIO(r.get_data(as_text=True)), delimiter=";"))
+    assert errori[0] == ["riga", "errore", "dati"]
+    assert [(riga, messaggio) for riga, messaggio, _ in errori[1:]] == [
+        ("4", "Codice IMP a-1 ripetuto nel file"),
+        ("5", "Quantità non valida: tre"),
+        ("6", "Sostituto IMP ZZZ inesistente"),
+        ("8", "Codice mancante"),
+    ]
+
+
+def test_import_senza_permesso(accettazione, conn):
+    r = accettazione.post("/ricambi/importa", data={
+        "file": (io.BytesIO(b"codice\nNOPERM1\n"), "catalogo.csv")
+    }, content_type="multipart/form-data")
+    assert r.status_code == 302
+    assert _ricambi(conn, "NOPERM") == {}
+
+
+def test_intestazione_senza_codice(amministratore, conn):
+    _importa(amministratore, "nome;quantita\nSenza colonna codice;1\n")
+    assert _ricambi(conn, "Senza") == {}
+
+
+def test_flusso_copy_a_pezzi():
+    # COPY legge il file a blocchi di dimensione fissa: il CSV ricomposto deve
+    # restituire esattamente le righe, con separatori, virgolette e NULL
+    righe = [
+        (2, "Filtro; olio \"long life\"", "MANN W712", 4, None, "MANNW712", None),
+        (3, None, "BOSCH A1", None, "MANN W712", "BOSCHA1", "MANNW712"),
+        (4, "Riga\nsu due linee", "NGK B2", 0, None, "NGKB2", None),
+    ]
+    flusso = gestionale._FlussoCopy(gestionale._riga_csv(r) for r in righe)
+    pezzi = []
+    while True:
+        pezzo = flusso.read(7)
+        if not pezzo:
+            break
+        pezzi.append(pezzo)
+    letti = list(csv.reader(io.StringIO("".join(pezzi))))
+    assert letti == [["" if v is None else str(v) for v in r] for r in righe]
+    assert len(gestionale._COLONNE_IMPORT) == len(righe[0])
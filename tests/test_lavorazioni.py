@@ -0,0 +1,50 @@
+"""Sincronizzazione incrementale del widget lavorazioni (?since=)."""
+
+
+def _inserisci(officina, conn, riga, targa):
+    r = officina.post("/officina/inserisci", data={
+        "marca": "FIAT", "modello": "Panda", "targa": targa, "cliente_nome": "Mario", "tagliando": "on"
+    })
+    assert r.status_code == 302
+    conn.commit()
+    return riga("SELECT MAX(id) FROM lavorazioni")[0]
+
+
+def _sincronizza(client, cursore):
+    r = client.get("/ajax_lavorazioni", query_string={"since": cursore})
+    assert r.status_code == 200
+    return r.get_json()
+
+
+def test_delta_con_modifiche_e_tombstone(accedi, accettazione, conn, riga):
+    officina = accedi("officina")
+    prima = _inserisci(officina, conn, riga, "SY001AA")
+
+    # prima sincronizzazione: lista completa e cursore
+    iniziale = _sincronizza(officina, "")
+    assert prima in [l["id"] for l in iniziale["lavorazioni"]]
+    assert iniziale["eliminate"] == []
+
+    seconda = _inserisci(officina, conn, riga, "SY002BB")
+    assert officina.post(f"/officina/aggiorna_stato/{prima}", json={"stato": "completata"}).status_code == 200
+    assert accettazione.post(f"/accettazione/elimina_lavorazione/{seconda}").status_code in (200, 302)
+
+    # dal cursore: la modificata torna con il nuovo stato, l'eliminata arriva come tombstone
+    delta = _sincronizza(officina, iniziale["cursore"])
+    modificate = {l["id"]: l for l in delta["lavorazioni"]}
+    assert modificate[prima]["stato"] == "completata"
+    assert seconda not in modificate
+    assert seconda in delta["eliminate"]
+
+
+def test_lavorazioni_di_altre_officine_escluse(accedi, conn, riga):
+    officina = accedi("officina")
+    altra = _inserisci(officina, conn, riga, "SY003CC")
+    conn.cursor().execute("UPDATE lavorazioni SET id_officina = -1 WHERE id = %s", (altra,))
+    conn.commit()
+    assert altra not in [l["id"] for l in _sincronizza(officina, "")["lavorazioni"]]
+
+
+def test_cursore_since_non_valido(accedi):
+    r = accedi("officina").get("/ajax_lavorazioni", query_string={"since": "ieri"})
+    assert r.status_code == 400
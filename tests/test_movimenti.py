@@ -0,0 +1,97 @@
+"""Registro movimenti dei ricambi: giacenza a una data e paginazione per chiave."""
+from datetime import date, timedelta
+
+import app as gestionale
+
+
+def _giacenza_alla_data(conn, ricambio_id, giorno):
+    cur = conn.cursor()
+    cur.execute(*gestionale.query_giacenze_alla_data(conn, giorno, ricambio_id))
+    row = cur.fetchone()
+    return row[3] if row else None
+
+
+def test_giacenza_alla_data(conn):
+    oggi = gestionale.now_ita().date()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO ricambi (nome, codice, quantita) VALUES ('n', 'MOV 1', 0) RETURNING id")
+    rid = cur.fetchone()[0]
+
+    # +10 cinque giorni fa, -3 tre giorni fa, +5 ieri
+    gestionale.rettifica_giacenza(conn, rid, 10)
+    gestionale.muovi_giacenze(conn, [rid], "scarico", -3)
+    gestionale.muovi_giacenze(conn, [rid], "carico", 5)
+    cur.execute("SELECT id FROM movimenti_ricambi WHERE ricambio_id = %s ORDER BY id", (rid,))
+    for (movimento,), giorni in zip(cur.fetchall(), (5, 3, 1)):
+        cur.execute(
+            "UPDATE movimenti_ricambi SET data_ora = %s WHERE id = %s",
+            (gestionale.inizio_giorno(oggi - timedelta(days=giorni)) + timedelta(hours=10), movimento)
+        )
+    conn.commit()
+
+    attese = {6: None, 5: 10, 4: 10, 3: 7, 2: 7, 1: 12, 0: 12}
+    for giorni, quantita in attese.items():
+        assert _giacenza_alla_data(conn, rid, oggi - timedelta(days=giorni)) == quantita, giorni
+
+    # dopo un'istantanea il calcolo parte da lì e somma solo i movimenti successivi
+    gestionale.salva_istantanea_giacenze(conn, oggi - timedelta(days=2))
+    conn.commit()
+    assert _giacenza_alla_data(conn, rid, oggi - timedelta(days=2)) == 7
+    assert _giacenza_alla_data(conn, rid, oggi - timedelta(days=1)) == 12
+    assert _giacenza_alla_data(conn, rid, oggi - timedelta(days=4)) == 10
+
+
+def test_movimenti_paginati_e_giacenza_alla_data(amministratore, conn):
+    cur = conn.cursor()
+    cur.execute("INSERT INTO ricambi (nome, codice, quantita) VALUES ('n', 'MOV 2', 0) RETURNING id")
+    rid = cur.fetchone()[0]
+    for _ in range(3):
+        gestionale.muovi_giacenze(conn, [rid], "carico", 2)
+    conn.commit()
+
+    visti, cursore = [], None
+    while True:
+        parametri = {"limite": 1, "data": date.today().isoformat()}
+        if cursore:
+            parametri["cursore"] = cursore
+        dati = amministratore.get(f"/ricambi/{rid}/movimenti", query_string=parametri).get_json()
+        visti += [m["quantita_dopo"] for m in dati["movimenti"]]
+        assert dati["giacenza_alla_data"]["quantita"] == 6
+        cursore = dati["cursore_successivo"]
+        if not cursore:
+            break
+    assert visti == [6, 4, 2]
+
+
+def test_paginazione_con_date_non_in_ordine_di_id(amministratore, conn):
+    # movimenti con data_ora non crescente rispetto all'id: la chiave è (data_ora, id)
+    oggi = gestionale.now_ita().date()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO ricambi (nome, codice, quantita) VALUES ('n', 'MOV 3', 0) RETURNING id")
+    rid = cur.fetchone()[0]
+    for _ in range(6):
+        gestionale.muovi_giacenze(conn, [rid], "carico", 1)
+    cur.execute("SELECT id FROM movimenti_ricambi WHERE ricambio_id = %s ORDER BY id", (rid,))
+    ids = [r[0] for r in cur.fetchall()]
+    date_movimenti = {}
+    for n, movimento in enumerate(ids):
+        # id pari oggi, id dispari tre giorni fa; a parità di data vince l'id più alto
+        date_movimenti[movimento] = gestionale.inizio_giorno(oggi - timedelta(days=3 * (n % 2)))
+        cur.execute("UPDATE movimenti_ricambi SET data_ora = %s WHERE id = %s", (date_movimenti[movimento], movimento))
+    conn.commit()
+
+    visti, cursore = [], None
+    while True:
+        parametri = {"limite": 2}
+        if cursore:
+            parametri["cursore"] = cursore
+        dati = amministratore.get(f"/ricambi/{rid}/movimenti", query_string=parametri).get_json()
+        visti += [m["id"] for m in dati["movimenti"]]
+        cursore = dati["cursore_successivo"]
+        if not cursore:
+            break
+    assert visti == sorted(ids, key=lambda i: (date_movimenti[i], i), reverse=True)
+
+
+def test_cursore_movimenti_non_valido(amministratore):
+    assert amministratore.get("/ricambi/1/movimenti", query_string={"cursore": "boh"}).status_code == 400
@@ -0,0 +1,53 @@
+"""Piano del cambio stagionale: paginazione per chiave e cursori manomessi."""
+import html
+import re
+
+import pytest
+
+import app as gestionale
+
+# depositi di primavera, da rimontare al cambio d'autunno
+TRENI = [
+    ("Rossi", "PZ003AA"), ("rossi", "PZ001AA"), ("Bianchi", "PZ002AA"),
+    (None, "PZ005AA"), ("ROSSI", "PZ001AA"), ("Verdi", "PZ004AA"),
+]
+
+
+def _targhe(pagina):
+    return re.findall(r'<span class="targa">(\w+)</span>', pagina)
+
+
+def _successiva(pagina):
+    link = re.search(r'<a href="([^"]+)" class="button">Successiva', pagina)
+    return html.unescape(link.group(1)) if link else None
+
+
+def test_pagine_senza_salti_ne_doppioni(accedi, conn, monkeypatch):
+    conn.cursor().executemany(
+        "INSERT INTO gomme_clienti (cognome, targa, data_inizio) VALUES (%s, %s, %s)",
+        [(cognome, targa, "2020-04-10") for cognome, targa in TRENI]
+    )
+    conn.commit()
+    monkeypatch.setattr(gestionale, "PIANIFICAZIONE_PAGINA", 2)
+
+    client = accedi("gomme")
+    url = "/gomme_clienti/pianificazione?cambio=autunno&mesi=0&targa=PZ"
+    viste = []
+    while url:
+        r = client.get(url)
+        assert r.status_code == 200
+        pagina = r.get_data(as_text=True)
+        viste += _targhe(pagina)
+        url = _successiva(pagina)
+
+    # cognome senza distinzione di maiuscole, poi targa e id
+    attese = [t for _, t, _ in sorted(((c or "").lower(), t, i) for i, (c, t) in enumerate(TRENI))]
+    assert viste == attese
+
+
+@pytest.mark.parametrize("cursore", ["boh", "[1, 2, 3]", '["a", ["b"], 1]', '["a", "b", true]',
+                                     '["a", "b"]', '{"a": 1}', '["a", "b", "1"]'])
+def test_cursore_manomesso(accedi, cursore):
+    r = accedi("gomme").get("/gomme_clienti/pianificazione",
+                            query_string={"cambio": "autunno", "cursore": cursore})
+    assert r.status_code == 400
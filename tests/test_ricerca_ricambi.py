@@ -0,0 +1,23 @@
+"""Ricerca ricambi per codice normalizzato e nome."""
+
+
+def _cerca(client, testo):
+    dati = client.get("/ricambi/lookup", query_string={"q": testo, "limite": 50}).get_json()
+    return [r["nome"] for r in dati["risultati"]]
+
+
+def test_caratteri_jolly_presi_alla_lettera(amministratore, conn):
+    cur = conn.cursor()
+    cur.executemany("INSERT INTO ricambi (nome, codice, quantita) VALUES (%s, %s, 0)", [
+        ("Olio 5W_30", "LK 1"), ("Olio 5WX30", "LK 2"), ("Sconto 100%", "LK 3"), ("Sconto 1000", "LK 4"),
+    ])
+    conn.commit()
+
+    assert _cerca(amministratore, "5W_30") == ["Olio 5W_30"]
+    assert _cerca(amministratore, "100%") == ["Sconto 100%"]
+
+
+def test_codice_scritto_in_altro_formato(amministratore, conn):
+    conn.cursor().execute("INSERT INTO ricambi (nome, codice, quantita) VALUES ('Filtro', 'MANN W712/75', 0)")
+    conn.commit()
+    assert _cerca(amministratore, "mann w 712-75") == ["Filtro"]
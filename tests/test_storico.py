@@ -0,0 +1,60 @@
+"""Storico azioni paginato per chiave (data_ora, id) con i filtri della pagina."""
+from datetime import timedelta
+
+import app as gestionale
+
+
+def _pagine(client, **filtri):
+    """Id delle voci di tutte le pagine, seguendo cursore_successivo."""
+    visti, cursore = [], None
+    while True:
+        parametri = dict(filtri, ajax=1, per_pagina=2)
+        if cursore:
+            parametri["cursore"] = cursore
+        r = client.get("/storico", query_string=parametri)
+        assert r.status_code == 200
+        dati = r.get_json()
+        visti += [v["id"] for v in dati["voci"]]
+        cursore = dati["cursore_successivo"]
+        if not cursore:
+            return visti
+
+
+def test_pagine_complete_con_date_non_in_ordine_di_id(accettazione, conn):
+    ieri = gestionale.now_ita().replace(microsecond=0) - timedelta(days=1)
+    cur = conn.cursor()
+    date_voci = {}
+    # date alternate e ripetute: l'ordine per id non coincide con quello per data
+    for n in range(7):
+        data_ora = ieri - timedelta(hours=n % 3)
+        cur.execute(
+            "INSERT INTO storico_azioni (utente, azione, tabella_nome, data_ora) "
+            "VALUES ('test', %s, 'test_storico', %s) RETURNING id",
+            (f"azione {n}", data_ora)
+        )
+        date_voci[cur.fetchone()[0]] = data_ora
+    conn.commit()
+
+    visti = _pagine(accettazione, tabella="test_storico")
+    assert visti == sorted(date_voci, key=lambda i: (date_voci[i], i), reverse=True)
+
+    # i filtri restano applicati su tutte le pagine
+    assert _pagine(accettazione, tabella="test_storico", testo="azione 4") == [list(date_voci)[4]]
+
+
+def test_filtro_per_giorno(accettazione, conn):
+    oggi = gestionale.now_ita().date()
+    cur = conn.cursor()
+    for giorni in (0, 2):
+        cur.execute(
+            "INSERT INTO storico_azioni (utente, azione, tabella_nome, data_ora) VALUES ('test', %s, 'test_giorni', %s)",
+            (f"giorno {giorni}", gestionale.inizio_giorno(oggi - timedelta(days=giorni)) + timedelta(hours=12))
+        )
+    conn.commit()
+    dal = (oggi - timedelta(days=1)).isoformat()
+    voci = accettazione.get("/storico", query_string={"ajax": 1, "tabella": "test_giorni", "dal": dal}).get_json()["voci"]
+    assert [v["azione"] for v in voci] == ["giorno 0"]
+
+
+def test_cursore_non_valido(accettazione):
+    assert accettazione.get("/storico", query_string={"ajax": 1, "cursore": "boh"}).status_code == 400
@@ -0,0 +1,41 @@
+"""Scheda targa: ricerca sulla targa normalizzata, limitata ai dati di chi la chiede."""
+
+
+def _id_utente(riga, username):
+    return riga("SELECT id FROM utenti WHERE username = %s", (username,))[0]
+
+
+def test_scheda_targa(accedi, conn, riga):
+    accettazione = _id_utente(riga, "accettazione")
+    officina = _id_utente(riga, "officina")
+    cur = conn.cursor()
+    cur.executemany("INSERT INTO vetture (targa, marca, utente_id) VALUES (%s, %s, %s)", [
+        ("sc 123 ta", "Fiat", accettazione),
+        ("SC-123-TA", "Lancia", officina),
+    ])
+    cur.executemany(
+        "INSERT INTO lavorazioni (id_officina, targa, stato, tipo) VALUES (%s, %s, %s, %s)", [
+            (officina, "SC123TA", "in lavorazione", "Tagliando"),
+            (officina + 1000, "sc123ta", "completata", "Freni"),
+            (officina, "SC999TA", "in lavorazione", "Altra vettura"),
+        ]
+    )
+    cur.execute("INSERT INTO gomme_clienti (cognome, targa, data_inizio) VALUES ('Rossi', 'Sc 123 Ta', '2024-04-01')")
+    conn.commit()
+
+    dati = accedi("accettazione").get("/targa", query_string={"targa": "sc-123 ta"}).get_json()
+    assert dati["targa"] == "SC123TA"
+    assert dati["vettura"]["marca"] == "Fiat"
+    assert [l["tipo"] for l in dati["lavorazioni_aperte"]] == ["Tagliando"]
+    assert [l["tipo"] for l in dati["lavorazioni_chiuse"]] == ["Freni"]
+    assert [g["cognome"] for g in dati["gomme_deposito"]] == ["Rossi"]
+
+    # l'officina vede la propria vettura e solo le proprie lavorazioni
+    dati = accedi("officina").get("/targa", query_string={"targa": "SC123TA"}).get_json()
+    assert dati["vettura"]["marca"] == "Lancia"
+    assert [l["tipo"] for l in dati["lavorazioni_aperte"]] == ["Tagliando"]
+    assert dati["lavorazioni_chiuse"] == []
+
+
+def test_scheda_targa_mancante(accettazione):
+    assert accettazione.get("/targa", query_string={"targa": " - "}).status_code == 400